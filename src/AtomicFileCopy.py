@@ -0,0 +1,231 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module AtomicFileCopy
+#
+#------------------------------------------------------------------------
+
+"""AtomicFileCopy - in-process atomic copy/move of files in the calibration directory tree
+
+File is copied by the kernel (os.copy_file_range or os.sendfile, with fallback to buffered copy)
+to temporary file in the target directory, data are fsync-ed, permissions are set and temporary
+file is renamed to the target name by os.replace, so readers of calib directory see either
+the old or the new complete file, never partial one.
+
+Temporary file is created in the target directory, so it inherits the default ACL of directory
+as file created by 'cat in > out'. If target file exists its mode, group and access ACL are copied
+to the new file, otherwise mode is set to filemode and group to the specified group.
+
+Deployment commands 'cp path_inp path_out' and 'mv path_inp path_out' are parsed by
+parse_deploy_command and executed by copy_for_command, list of commands can be executed
+concurrently in thread pool by copy_for_commands.
+
+Usage ::
+
+    from CalibManager.AtomicFileCopy import atomic_copy, copy_for_command, copy_for_commands
+
+    nbytes = atomic_copy('./work/clb-xpptut15-r0054-peds-ave-XppGon.0:Cspad.0.txt',
+                         '/reg/d/psdm/XPP/xpptut15/calib/CsPad::CalibV1/XppGon.0:Cspad.0/pedestals/54-end.data',
+                         filemode=0o664, group='ps-users', move=False)
+    nbytes = copy_for_command('mv ./work/a.txt ./calib/b.data')
+    results = copy_for_commands(list_of_cmds, nthreads=8) # list of (cmd, nbytes, err)
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import grp
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+XATTR_ACL_ACCESS = 'system.posix_acl_access'
+
+list_of_deploy_actions = ('cp', 'mv')
+
+#------------------------------
+
+def parse_deploy_command(cmd) :
+    """Returns (action, path_inp, path_out) for command like 'cp path_inp path_out'"""
+    fields = cmd.split()
+    if len(fields) != 3 or fields[0] not in list_of_deploy_actions :
+        raise ValueError('unsupported deployment command "%s", expected: cp|mv path_inp path_out' % cmd)
+    return tuple(fields)
+
+def copy_file_data(fsrc, fdst) :
+    """Copies content of open file fsrc to open file fdst in kernel, returns number of copied bytes"""
+    nbytes = os.fstat(fsrc.fileno()).st_size
+    ifd, ofd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    try :
+        copy = os.copy_file_range if hasattr(os, 'copy_file_range') else\
+               (lambda i, o, n : os.sendfile(o, i, None, n))
+        while copied < nbytes :
+            n = copy(ifd, ofd, min(nbytes - copied, 1<<30))
+            if n == 0 : break # file was truncated
+            copied += n
+    except OSError : # e.g. EXDEV or ENOSYS on some file systems, continue with buffered copy
+        pass
+    if copied < nbytes :
+        fsrc.seek(copied)
+        fdst.seek(copied)
+        shutil.copyfileobj(fsrc, fdst, 1<<20)
+        copied = fdst.tell()
+    return copied
+
+def gid_of_group(group) :
+    """Returns group id for group name or None if group is unknown"""
+    if group is None : return None
+    try :
+        return grp.getgrnam(group).gr_gid
+    except KeyError :
+        logger.warning('group %s is unknown, group of file is not changed' % group, __name__)
+        return None
+
+def copy_permissions(path_from, fd_to) :
+    """Copies mode, group and access ACL of existing file path_from to open file descriptor fd_to"""
+    st = os.stat(path_from)
+    os.fchmod(fd_to, st.st_mode & 0o7777)
+    try :
+        os.fchown(fd_to, -1, st.st_gid)
+    except OSError as err :
+        logger.debug('group of %s is not preserved: %s' % (path_from, err), __name__)
+    if not hasattr(os, 'getxattr') : return
+    try :
+        os.setxattr(fd_to, XATTR_ACL_ACCESS, os.getxattr(path_from, XATTR_ACL_ACCESS))
+    except OSError : # no ACL on file or file system without ACL support
+        pass
+
+def set_permissions(fd, filemode=0o664, group=None) :
+    """Sets mode and group of new file"""
+    os.fchmod(fd, filemode)
+    gid = gid_of_group(group)
+    if gid is None : return
+    try :
+        os.fchown(fd, -1, gid)
+    except OSError as err :
+        logger.warning('group of file is not changed to %s: %s' % (group, err), __name__)
+
+def fsync_directory(d) :
+    """Flushes directory entry to disk after rename"""
+    try :
+        fd = os.open(d, os.O_RDONLY)
+    except OSError :
+        return
+    try :
+        os.fsync(fd)
+    except OSError : # not supported by some file systems
+        pass
+    finally :
+        os.close(fd)
+
+def temporary_path(path_out) :
+    """Returns name of hidden temporary file in the directory of path_out, unique for process and thread"""
+    dir_out = os.path.dirname(os.path.abspath(path_out))
+    return os.path.join(dir_out, '.%s.%d-%x.tmp' % (os.path.basename(path_out), os.getpid(), threading.get_ident()))
+
+def copy_to_temporary(path_inp, path_out, filemode=0o664, group='ps-users') :
+    """Copies file path_inp to fsync-ed temporary file in the directory of path_out with permissions of path_out,
+       returns (path_tmp, nbytes), temporary file is removed on failure.
+    """
+    tmp = temporary_path(path_out)
+    try :
+        with open(path_inp, 'rb') as fsrc, open(tmp, 'wb') as fdst :
+            nbytes = copy_file_data(fsrc, fdst)
+            fdst.flush()
+            if os.path.exists(path_out) : copy_permissions(path_out, fdst.fileno())
+            else                        : set_permissions(fdst.fileno(), filemode, group)
+            os.fsync(fdst.fileno())
+    except :
+        if os.path.exists(tmp) : os.remove(tmp)
+        raise
+    return tmp, nbytes
+
+def atomic_copy(path_inp, path_out, filemode=0o664, group='ps-users', move=False) :
+    """Copies file path_inp to path_out atomically, removes path_inp for move=True.
+       Returns number of copied bytes, raises OSError/IOError on failure, target is not changed in this case.
+    """
+    tmp, nbytes = copy_to_temporary(path_inp, path_out, filemode, group)
+    try :
+        os.replace(tmp, path_out)
+    except :
+        os.remove(tmp)
+        raise
+    fsync_directory(os.path.dirname(os.path.abspath(path_out)))
+    if move : os.remove(path_inp)
+    return nbytes
+
+def copy_for_command(cmd, filemode=0o664, group='ps-users') :
+    """Executes command like 'cp path_inp path_out' or 'mv path_inp path_out' in process, returns number of copied bytes"""
+    action, path_inp, path_out = parse_deploy_command(cmd)
+    return atomic_copy(path_inp, path_out, filemode, group, move=(action=='mv'))
+
+def copy_for_commands(list_of_cmds, filemode=0o664, group='ps-users', nthreads=8) :
+    """Executes commands concurrently in thread pool,
+       returns list of (cmd, nbytes, err) in order of commands, err is None for successful command.
+    """
+    def proc(cmd) :
+        try :
+            return cmd, copy_for_command(cmd, filemode, group), None
+        except (OSError, IOError, ValueError) as err :
+            return cmd, 0, err
+
+    if len(list_of_cmds) < 2 or nthreads < 2 : return [proc(cmd) for cmd in list_of_cmds]
+    with ThreadPoolExecutor(max_workers=min(nthreads, len(list_of_cmds))) as pool :
+        return list(pool.map(proc, list_of_cmds))
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import stat
+    import tempfile
+    from time import time
+
+    d = tempfile.mkdtemp()
+    dir_work, dir_calib = os.path.join(d, 'work'), os.path.join(d, 'calib', 'pedestals')
+    os.makedirs(dir_work)
+    os.makedirs(dir_calib)
+
+    nfiles, size = 32, 2<<20
+    list_of_cmds = []
+    for i in range(nfiles) :
+        p = os.path.join(dir_work, 'clb-xpptut15-r0054-peds-ave-%02d.txt' % i)
+        with open(p, 'wb') as f : f.write(os.urandom(size))
+        list_of_cmds.append('cp %s %s' % (p, os.path.join(dir_calib, '%02d-end.data' % i)))
+
+    t0 = time()
+    results = copy_for_commands(list_of_cmds, filemode=0o640, group=None)
+    dt = time() - t0
+    print('copied %d files of %.1f MB in %.3f sec, errors: %s' % (nfiles, size/1e6, dt, [err for c, n, err in results if err]))
+
+    t0 = time()
+    for cmd in list_of_cmds : os.popen('cat %s > %s' % tuple(cmd.split()[1:])).read()
+    print('cat in subprocesses: %.3f sec' % (time() - t0))
+
+    p0 = os.path.join(dir_calib, '00-end.data')
+    os.chmod(p0, 0o600)
+    nbytes = copy_for_command('mv %s %s' % (list_of_cmds[0].split()[1], p0), filemode=0o664, group=None)
+    print('mv: %d bytes, source exists: %s, mode of replaced file is preserved: %s'%\
+          (nbytes, os.path.exists(list_of_cmds[0].split()[1]), oct(stat.S_IMODE(os.stat(p0).st_mode))))
+    p1 = os.path.join(dir_calib, '01-end.data')
+    print('content is identical: %s' % (open(p1, 'rb').read() == open(list_of_cmds[1].split()[1], 'rb').read()))
+    print('failed command: %s' % str(copy_for_commands(['cp %s/missing.txt %s/x.data' % (dir_work, dir_calib)])))
+    print('temporary files left: %s' % [f for f in os.listdir(dir_calib) if f.endswith('tmp')])
+    sys.exit('End of test')
+
+#------------------------------
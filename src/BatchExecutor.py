@@ -0,0 +1,274 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module BatchExecutor
+#
+#------------------------------------------------------------------------
+
+"""BatchExecutor - executors of batch job commands with common submit/status/kill interface
+
+Backends:
+    - 'lsf'    - submits commands to LSF through the shared BatchStatusPoller,
+    - 'local'  - runs commands concurrently in local subprocesses, up to ncores at a time,
+    - 'inproc' - runs jobs one at a time in a background thread of this process; job is either a callable,
+                 e.g. PedestalEngine averaging, executed directly in the thread, or a command run in subprocess.
+All backends write the command output in the log file and return string job ids;
+status is one of None, 'PEND', 'RUN', 'DONE', 'EXIT' as for LSF jobs, None is final for lost job (see is_lost).
+
+Usage ::
+
+    from CalibManager.BatchExecutor import get_executor
+
+    ex = get_executor('local', ncores=4)   # or 'lsf', 'inproc'
+    job_id, out, err = ex.submit('det_ndarr_raw_proc -d ...', queue='psanaq', log_file='log.txt')
+    job_id, out, err = get_executor('inproc').submit(functools.partial(save_constants_from_psana, ...), log_file='log.txt')
+    status = ex.status(job_id)             # 'PEND', 'RUN', 'DONE', 'EXIT'
+    status, node = ex.status_and_nodename(job_id)
+    ex.kill(job_id)
+    ex.is_lost(job_id)                     # True for job which is not submitted or not found by scheduler, status None
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import signal
+import socket
+import subprocess
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from CalibManager.Logger import logger
+from CalibManager.BatchStatusPoller import batch_status_poller, JOB_ID_IS_UNKNOWN
+
+#------------------------------
+
+class LSFExecutor(object) :
+    """Submits commands to LSF, status is provided by the shared BatchStatusPoller"""
+
+    name = 'lsf'
+
+    def __init__(self, poller=None) :
+        self.poller = batch_status_poller() if poller is None else poller
+
+    def is_available(self) :
+        return self.poller.is_available()
+
+    def submit(self, command, queue='psnehq', log_file='batch-log.txt') :
+        return self.poller.submit(command, queue, log_file)
+
+    def status_and_nodename(self, job_id) :
+        return self.poller.status_and_nodename(job_id)
+
+    def status(self, job_id) :
+        return self.poller.status(job_id)
+
+    def kill(self, job_id) :
+        return self.poller.kill(job_id)
+
+    def is_lost(self, job_id) :
+        return self.poller.is_lost(job_id)
+
+    def check(self, job_id) :
+        return self.poller.check(job_id)
+
+#------------------------------
+
+class _LocalJob(object) :
+    __slots__ = ('job_id', 'command', 'log_file', 'proc', 'rc', 'killed', 'started')
+
+    def __init__(self, job_id, command, log_file) :
+        self.job_id   = job_id
+        self.command  = command
+        self.log_file = log_file
+        self.proc     = None
+        self.rc       = None
+        self.killed   = False
+        self.started  = False
+
+    def status(self) :
+        if self.rc is not None : return 'DONE' if self.rc == 0 else 'EXIT'
+        return 'RUN' if self.started else 'PEND'
+
+
+class LocalPoolExecutor(object) :
+    """Runs commands in local subprocesses, at most ncores at a time, the rest of jobs are pending"""
+
+    name = 'local'
+    job_id_prefix = 'local.'
+    workers = 'processes'
+
+    def __init__(self, ncores=None) :
+        """Constructor.
+        @param ncores - max number of concurrent subprocesses, None or 0 - number of cpu cores
+        """
+        self.ncores  = ncores if ncores else (os.cpu_count() or 1)
+        self.pool    = None
+        self.jobs    = {} # job_id : _LocalJob
+        self.counter = 0
+        self.lock    = threading.Lock()
+
+    def is_available(self) :
+        return True
+
+    def _new_job(self, command, log_file) :
+        with self.lock :
+            self.counter += 1
+            job = _LocalJob('%s%d' % (self.job_id_prefix, self.counter), command, log_file)
+            self.jobs[job.job_id] = job
+        return job
+
+    def _run_job(self, job) :
+        """Runs job subprocess in its own process group and waits for completion"""
+        with self.lock :
+            if job.killed : return
+            try :
+                with open(job.log_file, 'w') as log : # subprocess keeps its own copy of the log file descriptor
+                    job.proc = subprocess.Popen(job.command, shell=True, stdout=log, stderr=subprocess.STDOUT,\
+                                                stdin=subprocess.DEVNULL, start_new_session=True)
+            except (OSError, IOError) as err :
+                logger.warning('Job %s is not started: %s' % (job.job_id, err), __name__)
+                job.rc = -1
+                return
+            job.started = True
+        job.rc = job.proc.wait()
+        logger.info('Job %s is completed with exit code %d' % (job.job_id, job.rc), __name__)
+
+    def submit(self, command, queue=None, log_file='batch-log.txt') :
+        """Queues command for execution, returns (job_id_str, out, err) as LSF submission does, queue is ignored"""
+        if os.path.lexists(log_file) : os.remove(log_file)
+        job = self._new_job(command, log_file)
+        if self.pool is None : self.pool = ThreadPoolExecutor(max_workers=self.ncores)
+        self.pool.submit(self._run_job, job)
+        out = 'Job <%s> is submitted to %s pool of %d %s.' % (job.job_id, self.name, self.ncores, self.workers)
+        logger.info(out, __name__)
+        return job.job_id, out, ''
+
+    def status_and_nodename(self, job_id) :
+        job = self.jobs.get(job_id)
+        if job is None : return None, None
+        status = job.status()
+        return status, (socket.gethostname() if status != 'PEND' else None)
+
+    def status(self, job_id) :
+        return self.status_and_nodename(job_id)[0]
+
+    def is_lost(self, job_id) :
+        return job_id not in self.jobs
+
+    def kill(self, job_id) :
+        job = self.jobs.get(job_id)
+        if job is None : return 'Job <%s> is not found' % job_id
+        with self.lock :
+            job.killed = True
+            if not job.started :
+                if job.rc is None : job.rc = -signal.SIGTERM # pending job will not be started
+            elif job.proc is None :
+                return 'Job <%s> runs in process and can not be interrupted, it is marked as killed' % job_id
+            elif job.rc is None :
+                try : os.killpg(job.proc.pid, signal.SIGTERM)
+                except OSError : pass
+        return 'Job <%s> is being terminated' % job_id
+
+    def check(self, job_id) :
+        status, node = self.status_and_nodename(job_id)
+        job = self.jobs.get(job_id)
+        if job is None : return 'Job <%s> is not found' % job_id
+        return 'JOBID %s STAT %s HOST %s LOG %s\nCOMMAND %s' % (job_id, status, node, job.log_file, job.command)
+
+#------------------------------
+
+class InProcessExecutor(LocalPoolExecutor) :
+    """Runs jobs one at a time in a background thread of this process, submit does not block.
+       Job is a callable without arguments executed directly in the thread (exception - EXIT, otherwise DONE),
+       or command string executed in subprocess.
+    """
+
+    name = 'inproc'
+    job_id_prefix = 'inproc.'
+    workers = 'thread'
+
+    def __init__(self, ncores=None) :
+        LocalPoolExecutor.__init__(self, 1) # psana and PedestalEngine jobs are not run concurrently in one process
+
+    def _run_job(self, job) :
+        if not callable(job.command) : return LocalPoolExecutor._run_job(self, job)
+        with self.lock :
+            if job.killed : return
+            job.started = True
+        with open(job.log_file, 'w') as log :
+            log.write('in-process job %s: %s\n' % (job.job_id, getattr(job.command, '__name__', repr(job.command))))
+            log.flush()
+            try :
+                result = job.command()
+                log.write('result: %s\n' % str(result))
+                rc = 0
+            except Exception :
+                log.write(traceback.format_exc())
+                rc = 1
+        job.rc = -signal.SIGTERM if job.killed else rc
+        logger.info('Job %s is completed with exit code %d' % (job.job_id, job.rc), __name__)
+
+#------------------------------
+
+dict_of_executors = {'lsf'    : LSFExecutor,
+                     'local'  : LocalPoolExecutor,
+                     'inproc' : InProcessExecutor}
+
+list_of_executors = ['lsf', 'local', 'inproc']
+
+_executors = {} # name : executor object
+
+def get_executor(name='lsf', ncores=None) :
+    """Returns shared executor object for backend name"""
+    if name not in dict_of_executors :
+        raise ValueError('Unknown executor "%s", use one of %s' % (name, str(list_of_executors)))
+    ex = _executors.get(name)
+    if ex is None :
+        ex = _executors[name] = dict_of_executors[name]() if name == 'lsf' else dict_of_executors[name](ncores)
+    elif name == 'local' and ncores and ncores != ex.ncores and ex.pool is None :
+        ex.ncores = ncores
+    return ex
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    from time import time, sleep
+    d = tempfile.mkdtemp()
+
+    ex = get_executor('local', ncores=2)
+    t0 = time()
+    jobs = [ex.submit('echo job %d; sleep 0.5; exit %d' % (i, i%2), None, os.path.join(d, 'log-%d.txt'%i))[0] for i in range(4)]
+    jkill = ex.submit('sleep 100', None, os.path.join(d, 'log-kill.txt'))[0]
+    print('just submitted: %s' % ' '.join(str(ex.status(j)) for j in jobs + [jkill]))
+    sleep(0.2); print('kill %s: %s' % (jkill, ex.kill(jkill)))
+    while [j for j in jobs if ex.status(j) not in ('DONE', 'EXIT')] : sleep(0.05)
+    print('completed in %.2f sec: %s' % (time()-t0, ' '.join(ex.status(j) for j in jobs + [jkill])))
+    print('log of %s: %s' % (jobs[1], open(os.path.join(d, 'log-1.txt')).read().strip()))
+    assert [ex.status(j) for j in jobs] == ['DONE', 'EXIT', 'DONE', 'EXIT'] and ex.status(jkill) == 'EXIT'
+
+    exi = get_executor('inproc')
+    t0 = time()
+    ji = [exi.submit('sleep 0.3', None, os.path.join(d, 'log-i.txt'))[0],\
+          exi.submit(lambda : sum(range(1000)), None, os.path.join(d, 'log-i1.txt'))[0],\
+          exi.submit(lambda : 1/0, None, os.path.join(d, 'log-i2.txt'))[0]]
+    print('inproc submitted in %.3f sec: %s' % (time()-t0, ' '.join(str(exi.status(j)) for j in ji)))
+    while [j for j in ji if exi.status(j) not in ('DONE', 'EXIT')] : sleep(0.05)
+    print('inproc completed in %.2f sec: %s' % (time()-t0, ' '.join(exi.status(j) for j in ji)))
+    print('log of %s: %s' % (ji[2], open(os.path.join(d, 'log-i2.txt')).read().strip().splitlines()[-1]))
+    assert [exi.status(j) for j in ji] == ['DONE', 'DONE', 'EXIT']
+    sys.exit('End of test')
+
+#------------------------------
@@ -28,6 +28,8 @@ import os
 from .ConfigParametersForApp   import cp
 from CalibManager.Logger                   import logger
 from . import GlobalUtils            as     gu
+from .BatchStatusPoller         import batch_status_poller
+from .BatchExecutor             import get_executor
 
 from PyQt5 import QtCore # need it in order to use QtCore.QObject for connect
 
@@ -50,15 +52,19 @@ class BatchJob(QtCore.QObject) : # need in QtCore.QObject in order to connect to
         self.queue             = cp.bat_queue # .value()
         self.str_run_number    = cp.str_run_number.value()
         self.autoRunStage = 0
+
+        batch_status_poller().set_commands(cp.bat_cmd_submit.value(), cp.bat_cmd_status.value(), cp.bat_cmd_kill.value(),\
+                                           cp.bat_status_ttl_sec.value())
+        self.executor = get_executor(cp.bat_executor.value(), cp.bat_local_ncores.value()) # shared by all batch jobs
         
 #-----------------------------
 
     def job_can_be_submitted(self, job_id, t_sub, comment='') :
 
-        if not gu.bsub_is_available() :
-            #return False
-            sys.exit('EXIT')
-
+        if not self.executor.is_available() :
+            logger.warning('Job for %s can not be submitted, executor "%s" is not available, '\
+                           'change the batch executor in configuration parameters' % (comment, self.executor.name), __name__)
+            return False
 
         if self.job_was_recently_submitted(t_sub, comment) and \
            (self.get_batch_job_status(job_id, comment) != 'DONE') :
@@ -93,10 +99,7 @@ class BatchJob(QtCore.QObject) : # need in QtCore.QObject in order to connect to
             logger.info('Batch job for ' + comment + ' was not submitted in this session.', __name__) 
             return
 
-        lines = gu.batch_job_check(job_id, self.queue.value())
-        msg = 'Check batch status for ' + comment + ':\n'
-        for line in lines :
-            msg += line
+        msg = 'Check batch status for ' + comment + ':\n' + self.executor.check(job_id)
         logger.info(msg, __name__) 
 
 #-----------------------------
@@ -107,10 +110,7 @@ class BatchJob(QtCore.QObject) : # need in QtCore.QObject in order to connect to
             #logger.info('Batch job for ' + comment + ' was not submitted in this session.', __name__) 
             return
 
-        lines = gu.batch_job_kill(job_id)
-        msg = 'Kill batch job ' + job_id + ' ' + comment + ':\n'
-        for line in lines :
-            msg += line
+        msg = 'Kill batch job ' + job_id + ' ' + comment + ':\n' + self.executor.kill(job_id)
         logger.info(msg, __name__) 
 
 #-----------------------------
@@ -120,12 +120,18 @@ class BatchJob(QtCore.QObject) : # need in QtCore.QObject in order to connect to
         if job_id is None :
             self.batch_job_status = None
         else :
-            self.batch_job_status = gu.batch_job_status(job_id, self.queue.value())
+            self.batch_job_status = self.executor.status(job_id)
 
         if comment != '' :
             logger.info('Status for ' + comment + ': ' + str(self.batch_job_status), __name__) 
         return self.batch_job_status
 
+#-----------------------------
+
+    def submit_batch_job(self, command, queue, log_file) :
+        """Submits job through the selected executor, returns (job_id_str, out, err)"""
+        return self.executor.submit(command, queue, log_file)
+
 #-----------------------------
 
     def get_batch_job_status_and_string(self, job_id, time_sec, comment='') :
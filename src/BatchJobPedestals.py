@@ -9,11 +9,15 @@ If you use all or part of it, please give an appropriate acknowledgment.
 from __future__ import absolute_import
 
 import sys
+from functools import partial
 
 from .BatchJob import *
 from .FileNameManager          import fnm
 from .ConfigFileGenerator      import cfg
 from .ConfigParametersForApp   import cp
+from .ShardedPedestals         import ShardedPedestals
+from .DarkProcState            import DarkProcState
+from .PedestalEngine           import save_constants_from_psana
 
 class BatchJobPedestals(BatchJob):
     """Deals with batch jobs for dark runs (pedestals).
@@ -33,6 +37,9 @@ class BatchJobPedestals(BatchJob):
 
         self.procDarkStatus  = 0 # 0=inactive, 1=scan, 2=averaging, 3=both
 
+        self.sharded = None # ShardedPedestals for cp.bat_dark_nshards > 1
+        self.state   = None # DarkProcState of the last submission
+
         #self.opt = ' -o psana.l3t-accept-only=0'
         self.opt = ''
 
@@ -64,7 +71,7 @@ class BatchJobPedestals(BatchJob):
         #print 'queue      :', queue
         #print 'bat_log_file:', bat_log_file
 
-        self.job_id_scan_str, out, err = gu.batch_job_submit(command, queue, bat_log_file)
+        self.job_id_scan_str, out, err = self.submit_batch_job(command, queue, bat_log_file)
         self.procDarkStatus ^= 1 # set bit to 1
 
         if err != '':
@@ -102,9 +109,7 @@ class BatchJobPedestals(BatchJob):
         command = self.str_command_for_peds_scan()
         logscan = fnm.path_peds_scan_batch_log() # log file name for scan
 
-        err = gu.subproc_in_log(command.split(), logscan) # , shell=True)
-
-        err = str(err) # convert byte to str for py3
+        err = gu.subproc_in_log(command.split(), logscan, on_tick=QtCore.QCoreApplication.processEvents)
         if err != '':
             if 'ERR' in err:
                 logger.error('\nERROR message from scan:\n%s' % (err), __name__)
@@ -178,6 +183,7 @@ class BatchJobPedestals(BatchJob):
         intnlo = cp.mask_intnlo.value()
         intnhi = cp.mask_intnhi.value()
         evcode = cp.bat_dark_sele.value()
+        nrecs1 = cp.bat_dark_nrecs1.value()
 
         if srcs == '':
             str_sel_dets = ' '.join(cp.list_of_dets_selected())
@@ -201,7 +207,8 @@ class BatchJobPedestals(BatchJob):
                 + ' -L %.3f' % rmsnlo\
                 + ' -H %.3f' % rmsnhi\
                 + ' -D %.3f' % intnlo\
-                + ' -U %.3f' % intnhi
+                + ' -U %.3f' % intnhi\
+                + ' --nrecs1 %d' % nrecs1
 
         if evcode != 'None': command += ' -c %s'   % evcode
 
@@ -238,7 +245,7 @@ class BatchJobPedestals(BatchJob):
 
         logave  = fnm.path_peds_aver_batch_log() # log file name for averaging
 
-        err = gu.subproc_in_log(command.split(), logave) # , shell=True)
+        err = gu.subproc_in_log(command.split(), logave, on_tick=QtCore.QCoreApplication.processEvents)
         if err != '':
             logger.warning('\nWarning/error message from subprocess:\n%s' % (err), __name__)
             return False
@@ -271,6 +278,8 @@ class BatchJobPedestals(BatchJob):
 
     def is_good_lsf(self):
         """Checks and returns LSF status"""
+        if self.executor.name != 'lsf': return True # local executors do not depend on LSF
+
         queue = self.queue.value()
         farm = cp.dict_of_queue_farm[queue]
         msg, status = gu.msg_and_status_of_lsf(farm)
@@ -302,9 +311,16 @@ class BatchJobPedestals(BatchJob):
         if not self.job_can_be_submitted(self.job_id_peds_str, self.time_peds_job_submitted, 'peds'): return
         self.time_peds_job_submitted = gu.get_time_sec()
 
-        status = self.command_for_peds_scan()
-        if not status:
-            return False
+        self.state = self.dark_proc_state()
+
+        if not self.resume_peds_scan() and not self.scan_is_cached():
+            status = self.command_for_peds_scan()
+            if not status:
+                return False
+            cp.blsp.save_scan_in_cache()
+            self.save_peds_scan_in_state()
+
+        if self.resume_peds_aver(): return True
 
         if not self.is_good_lsf():
             self.stop_auto_processing(is_stop_on_button_click=False)
@@ -316,11 +332,16 @@ class BatchJobPedestals(BatchJob):
         command = self.str_command_for_peds_aver()
         if command is None: return False
 
+        self.sharded = None
+        if cp.bat_dark_nshards.value() > 1: return self.submit_batch_for_peds_aver_sharded()
+
         queue        = self.queue.value()
         bat_log_file = fnm.path_peds_aver_batch_log()
+        job          = self.in_process_job_for_peds_aver()
 
-        self.job_id_peds_str, out, err = gu.batch_job_submit(command, queue, bat_log_file)
+        self.job_id_peds_str, out, err = self.submit_batch_job(command if job is None else job, queue, bat_log_file)
         self.procDarkStatus ^= 2 # set bit to 1
+        self.state.set_job('aver', self.job_id_peds_str, self.executor.name)
 
         if err != 'Warning: job being submitted without an AFS token.':
             #logger.info('This job is running on LCLS NFS, it does not need in AFS, ignore warning and continue.', __name__)
@@ -335,6 +356,109 @@ class BatchJobPedestals(BatchJob):
         return True
 
 
+    def in_process_job_for_peds_aver(self):
+        """Returns callable averaging by PedestalEngine for executor 'inproc' and engine 'numpy', None - det_ndarr_raw_proc command is used"""
+        if self.executor.name != 'inproc' or cp.bat_peds_engine.value() != 'numpy': return None
+        logger.info('Averaging for run %s by PedestalEngine in process' % self.str_run_number, __name__)
+        return partial(save_constants_from_psana, fnm.path_to_data_files(), [s for s in self.str_of_sources().split(',') if s],\
+                       fnm.path_peds_template(), cp.exp_name.value(), cp.str_run_number.value(),\
+                       events=cp.bat_dark_end.value(), evskip=cp.bat_dark_start.value() - 1,\
+                       pars=cp.dict_of_peds_engine_pars(), evcodes=cp.bat_dark_sele.value())
+
+
+    def submit_batch_for_peds_aver_sharded(self):
+        """Submits cp.bat_dark_nshards jobs for event-range shards, partials are merged in on_auto_processing_status"""
+        self.sharded = ShardedPedestals(fnm.path_to_data_files(), self.str_of_sources(),\
+                                        cp.bat_dark_start.value() - 1, cp.bat_dark_end.value(), cp.bat_dark_nshards.value(),\
+                                        fnm.path_peds_template(), cp.exp_name.value(), self.str_run_number, cp.dict_of_peds_engine_pars(),\
+                                        nevts_ckpt=cp.bat_dark_ckpt_events.value(), evcodes=cp.bat_dark_sele.value())
+        if self.state.resumed:
+            ndone = self.sharded.restore(self.state.shards())
+            logger.info('Resume run %s: %d of %d shards are done earlier' % (self.str_run_number, ndone, len(self.sharded.shards)), __name__)
+        self.sharded.submit(self.executor, self.queue.value(), fnm.path_peds_aver_batch_log().rsplit('.',1)[0])
+        self.job_id_peds_str = None
+        self.procDarkStatus ^= 2 # set bit to 1
+        self.state.set_job('aver', None, self.executor.name)
+        self.state.set_shards(self.sharded.shard_records())
+        return True
+
+
+    def merge_sharded_peds_aver(self):
+        """Merges partial accumulators of shards, saves shard summary in the averaging log file"""
+        try:
+            self.sharded.merge_and_save()
+        except (IOError, OSError, ValueError) as err:
+            logger.warning('Merging of shards for run %s failed: %s' % (self.str_run_number, err), __name__)
+            return False
+        gu.save_textfile(self.sharded.summary() + '\n', fnm.path_peds_aver_batch_log())
+        self.state.set_stage('averaged')
+        return True
+
+
+    def dark_proc_state(self):
+        """Returns DarkProcState for current run and parameters, state of earlier processing is loaded if cp.bat_dark_resume"""
+        key = dict(cp.dict_of_dark_proc_key(), dsname=fnm.path_to_data_files())
+        return DarkProcState(fnm.path_peds_state(), key, resume=cp.bat_dark_resume.value())
+
+
+    def resume_peds_scan(self):
+        """Returns True if scan results are available in the state file, re-creates scan log file and scan cache entry from them"""
+        event_keys = self.state.scan_event_keys()
+        if event_keys is None: return False
+        gu.save_textfile('\n'.join(event_keys) + '\n', fnm.path_peds_scan_batch_log()) # log may be from other run
+        cp.blsp.save_scan_in_cache()
+        logger.info('Resume run %s: scan results from state file %s' % (self.str_run_number, self.state.fname), __name__)
+        return True
+
+
+    def scan_is_cached(self):
+        """Returns True if types and sources for run are available in scan cache (scan done earlier or RegDB),
+           scan log file is not written in this case and is not required by get_list_of_files_peds_essential.
+        """
+        if not cp.blsp.scan_is_cached(): return False
+        logger.info('Scan for run %s is skipped, sources from scan cache %s: %s'%\
+                    (self.str_run_number, fnm.path_scan_cache(), ' '.join(cp.blsp.get_list_of_sources())), __name__)
+        return True
+
+
+    def save_peds_scan_in_state(self, pattern='EventKey(type=psana.'):
+        logscan = fnm.path_peds_scan_batch_log()
+        if not os.path.exists(logscan): return
+        with open(logscan, 'r') as f:
+            event_keys = set(line.strip() for line in f if pattern in line)
+        self.state.set_scan_event_keys(event_keys)
+
+
+    def resume_peds_aver(self):
+        """Re-attaches to the averaging job of earlier session if it is still pending or running,
+           or skips averaging completed earlier (stage 'averaged' or job DONE) if files of pedestals exist,
+           returns True in these cases.
+        """
+        job = self.state.job('aver')
+        status = None
+        if job is not None and job['id'] is not None and job['executor'] == self.executor.name:
+            status = self.executor.status(job['id'])
+        if (self.state.is_done('averaged') or status == 'DONE') and self.peds_files_exist():
+            self.job_id_peds_str = None
+            self.sharded = None
+            self.procDarkStatus |= 2 # files are found at the next status check
+            if not self.state.is_done('averaged'): self.state.set_stage('averaged')
+            logger.info('Resume run %s: averaging is completed earlier, state file %s' % (self.str_run_number, self.state.fname), __name__)
+            return True
+        if self.state.stage() != 'submitted' or status not in ('PEND', 'RUN'): return False
+        self.job_id_peds_str = job['id']
+        self.time_peds_job_submitted = job['time']
+        self.sharded = None
+        self.procDarkStatus |= 2
+        logger.info('Resume run %s: averaging job %s submitted earlier is %s' % (self.str_run_number, job['id'], status), __name__)
+        return True
+
+
+    def peds_files_exist(self):
+        lst = gu.get_list_of_files_for_list_of_insets(fnm.path_peds_ave(), [s for s in self.str_of_sources().split(',') if s])
+        return lst != [] and all(os.path.exists(fname) for fname in lst)
+
+
     def submit_batch_for_peds_aver_old(self):
         self.exportLocalPars() # export run_number to cp.str_run_number
 
@@ -359,7 +483,7 @@ class BatchJobPedestals(BatchJob):
         queue        = self.queue.value()
         bat_log_file = fnm.path_peds_aver_batch_log()
 
-        self.job_id_peds_str, out, err = gu.batch_job_submit(command, queue, bat_log_file)
+        self.job_id_peds_str, out, err = self.submit_batch_job(command, queue, bat_log_file)
         self.procDarkStatus ^= 2 # set bit to 1
 
         if err != 'Warning: job being submitted without an AFS token.':
@@ -380,6 +504,9 @@ class BatchJobPedestals(BatchJob):
 
     def kill_batch_job_for_peds_aver(self):
         self.kill_batch_job(self.job_id_peds_str, 'for peds aver')
+        if self.sharded is not None:
+            for shard in self.sharded.shards:
+                if not shard.is_done(): self.kill_batch_job(shard.job_id, 'for peds aver shard %d' % shard.index)
 
     def kill_all_batch_jobs(self):
         logger.debug('kill_all_batch_jobs', __name__)
@@ -413,9 +540,11 @@ class BatchJobPedestals(BatchJob):
 
 
     def get_list_of_files_peds_essential(self):
+        """Returns list of scan log and averaging files, scan log is not required if scan is skipped for cached sources"""
         self.exportLocalPars() # export run_number to cp.str_run_number
-        return   self.get_list_of_files_peds_scan() \
-               + self.get_list_of_files_peds_aver()
+        lst_scan = [] if not cp.blsp.scan_log_exists() and cp.blsp.scan_is_cached() else\
+                   self.get_list_of_files_peds_scan()
+        return lst_scan + self.get_list_of_files_peds_aver()
 
 
     def status_for_peds_files_essential(self):
@@ -436,6 +565,11 @@ class BatchJobPedestals(BatchJob):
         return self.get_batch_job_status_and_string(self.job_id_scan_str, self.time_scan_job_submitted)
 
     def status_batch_job_for_peds_aver(self):
+        if self.sharded is not None:
+            status = self.sharded.poll(self.executor) # re-submits failed shards
+            if self.state is not None: self.state.set_shards(self.sharded.shard_records())
+            ndone = len([shard for shard in self.sharded.shards if shard.is_done()])
+            return status, 'Shards done: %d of %d status: %s' % (ndone, len(self.sharded.shards), status)
         return self.get_batch_job_status_and_string(self.job_id_peds_str, self.time_peds_job_submitted)
 
     def job_id_peds_aver_str(self):
@@ -506,11 +640,16 @@ class BatchJobPedestals(BatchJob):
                 self.stop_auto_processing(is_stop_on_button_click=False)
                 logger.warning('PROCESSING IS STOPPED for run %s due to status: %s - CHECK LOG FLIE %s' % (self.str_run_number,self.status_bj_aver, logave), __name__)
 
+            elif self.status_bj_aver == 'DONE' and self.sharded is not None and not self.sharded.merged:
+                if not self.merge_sharded_peds_aver():
+                    self.stop_auto_processing(is_stop_on_button_click=False)
+
             self.status_aver, fstatus_str_aver = self.status_for_peds_aver_files(comment='')
             #print 'self.status_aver, fstatus_str_aver = ', self.status_aver, fstatus_str_aver
 
             if self.status_aver:
                 logger.info('on_auto_processing_status: Averaging is completed, stop processing for run %s.' % self.str_run_number, __name__)
+                if self.state is not None and not self.state.is_done('averaged'): self.state.set_stage('averaged')
                 self.stop_auto_processing(is_stop_on_button_click=False)
 
         else:
@@ -16,6 +16,8 @@ from .ConfigParametersForApp import cp
 from .FileNameManager        import fnm
 from . import GlobalUtils    as     gu
 from . import RegDBUtils     as     ru
+from .ScanResultCache        import scan_result_cache, has_sources_of_detectors, is_type_pattern
+from .EventKeyParser         import types_and_sources_in_file
 
 
 class BatchLogScanParser():
@@ -32,79 +34,56 @@ class BatchLogScanParser():
         self.list_of_types          = []
         self.det_names_parsed       = None
         self.path                   = None
+        self.parsed_key             = None # (path, size, mtime) of the parsed file
 
 
-    def parse_batch_log_peds_scan(self, pattern='EventKey(type=psana.'):
+    def parse_batch_log_peds_scan(self, pattern='EventKey(type=psana.', force=False):
         """Psrses log file for dark run scan and makes lists:
            self.list_of_types and self.list_of_sources for all psana data types in file.
+           File is re-parsed only if its path, size, or modification time is changed.
         """
-
-        if self.path == fnm.path_peds_scan_batch_log(): return
-
-        #self.list_of_detinfo_sources = []
-        self.list_of_sources         = []
-        self.list_of_types           = []
-
-        if not self.make_set_of_lines_from_file_for_pattern(pattern): return
-        self.make_list_of_types_and_sources(pattern)
-
-
-    def make_set_of_lines_from_file_for_pattern(self, pattern): # pattern='EventKey(type=psana.'
-        """Makse self.list_of_found_lines - a set of lines from file specified containing pattern
-        """
-
         self.path = fnm.path_peds_scan_batch_log()
 
-        if not os.path.lexists(self.path):
+        try:
+            st = os.stat(self.path)
+        except OSError:
             logger.info('\nThe requested file: ' + self.path + '\nIS NOT AVAILABLE!')
-            return False
+            self.list_of_sources, self.list_of_types, self.parsed_key = [], [], None
+            return
 
-        self.list_of_found_lines  = []
+        key = (self.path, st.st_size, st.st_mtime_ns)
+        if key == self.parsed_key and not force: return
 
-        fin = open(self.path, 'r')
-        for line in fin:
-            if pattern in line:
-                line_st = line.rstrip('\n').strip(' ')
-                if line_st in self.list_of_found_lines: continue # if the line is already in the list
-                self.list_of_found_lines.append(line_st)
-                #print 'found line:', line_st
+        self.list_of_types, self.list_of_sources = types_and_sources_in_file(self.path, pattern)
+        self.parsed_key = key
 
-        fin.close()
 
-        return True
+    def scan_cache(self):
+        return scan_result_cache(fnm.path_scan_cache())
 
 
-    def make_list_of_types_and_sources(self, pattern): # pattern='EventKey(type=psana.'
+    def cached_type_sources(self):
+        """Returns list of (type, src) for current run from scan cache pre-filled from RegDB, or None"""
+        ins, exp, run = cp.instr_name.value(), cp.exp_name.value(), int(cp.str_run_number.value())
+        return self.scan_cache().get_or_prefill(exp, run, fnm.path_to_data_files(),\
+                                                list_of_sources=lambda : ru.list_of_sources_in_run(ins, exp, run),\
+                                                dict_of_det_data_types=self.dict_of_det_data_types)
 
-        for line in self.list_of_found_lines:
 
-            #print line                                #EventKey(type=psana.CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2')
-            pos1 = line.find(pattern) + len(pattern)
-            pos2 = line.rfind(')')                    #                    CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2'
-            line1 = line[pos1:pos2]                   #                    CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2'
-            fields = line1.split(',')
-            #print fields
+    def scan_is_cached(self):
+        """Returns True if scan cache has sources of all selected detectors or results of the scan"""
+        lst = self.cached_type_sources()
+        if lst is None: return False
+        origin = self.scan_cache().origin(cp.exp_name.value(), int(cp.str_run_number.value()), fnm.path_to_data_files())
+        return origin == 'scan' or has_sources_of_detectors(lst, self.list_of_dets_selected())
 
-            type = fields[0]                          # CsPad2x2.ElementV1
-            if type.find('ConfigV') != -1: continue  # remove ConfigV from lists
-            #print 'type: ', type
-            tparts = type.split('.')
-            type_old = '%s::%s' % (tparts[0],tparts[1]) if len(tparts) == 2 else type # CsPad2x2.ElementV1 -> CsPad2x2::ElementV1
 
-            if len(fields)<2: continue
-            patt = 'src='
-            pos1 = fields[1].find(patt) + len(patt)
-            detinfo_src = fields[1][pos1:].strip('"\'') # DetInfo(CxiDg2.0:Cspad2x2.0)
-            #print 'detinfo_src: ', detinfo_src
-
-            pos1 = detinfo_src.find('(') + 1
-            pos2 = detinfo_src.rfind(')')
-            src  = detinfo_src[pos1:pos2] # if pos2 != -1 elsw detinfo_src[pos1:]  # CxiDg2.0:Cspad2x2.0
-            #print 'type:%s  src:%s' % (type, src)
-
-            #self.list_of_detinfo_sources.append(detinfo_src)
-            self.list_of_types.append(type_old)
-            self.list_of_sources.append(src)
+    def save_scan_in_cache(self):
+        """Parses scan log file of current run and saves types and sources in the scan cache"""
+        self.parse_batch_log_peds_scan(force=True)
+        if not self.scan_log_exists(): return
+        self.scan_cache().put(cp.exp_name.value(), int(cp.str_run_number.value()), fnm.path_to_data_files(),\
+                              list(zip(self.list_of_types, self.list_of_sources)), origin='scan')
 
 
     def print_list_of_types_and_sources(self):
@@ -114,17 +93,18 @@ class BatchLogScanParser():
 
     def txt_list_of_types_and_sources(self):
 
-        self.parse_batch_log_peds_scan()
-        msg = 'log file: %s' % self.path
+        type_srcs = self.get_list_of_type_sources()
+        origin = self.scan_cache().origin(cp.exp_name.value(), int(cp.str_run_number.value()), fnm.path_to_data_files())
+        msg = 'scan cache: %s (%s)' % (fnm.path_scan_cache(), origin) if origin is not None else 'log file: %s' % self.path
         state = 'Sources found in scan:'
-        if self.list_of_sources == []:
+        if type_srcs == []:
             msg += '\nLog file %s' % self.dict_exists[self.scan_log_exists()] # is available or not
             msg += '\nLIST OF SOURCES IS EMPTY !!!'
 
             return msg
 
-        for type, src in zip(self.list_of_types, self.list_of_sources):
-            line  = '\n    %30s: %s' % (type, src)
+        for type, src in type_srcs:
+            line  = '\n    %30s: %s%s' % (type, src, ' (type pattern from RegDB)' if is_type_pattern(type) else '')
             msg   += line
             state += line
         return msg
@@ -139,37 +119,25 @@ class BatchLogScanParser():
 
 
     def get_list_of_sources(self):
-        if self.scan_log_exists():
-            self.parse_batch_log_peds_scan()
-            return self.list_of_sources
-        # Use RegDB
-        return ru.list_of_sources_in_run(cp.instr_name.value(), cp.exp_name.value(), int(cp.str_run_number.value()))
+        return [src for type, src in self.get_list_of_type_sources()]
 
 
     def get_list_of_types(self):
-        self.parse_batch_log_peds_scan()
-        return self.list_of_types
+        return [type for type, src in self.get_list_of_type_sources()]
 
 
     def get_list_of_type_sources(self):
+        """Returns list of (type, src) from scan cache (pre-filled from RegDB) or from scan log file"""
+        lst = self.cached_type_sources()
+        if lst is not None: return lst
         self.parse_batch_log_peds_scan()
         return list(zip(self.list_of_types, self.list_of_sources))
 
 
     def list_of_types_and_sources_for_detector(self, det_name):
-
-        if not self.scan_log_exists(): # Use RegDB
-            ins, exp, run_number = cp.instr_name.value(), cp.exp_name.value(), int(cp.str_run_number.value())
-            lst_srcs = ru.list_of_sources_in_run_for_selected_detector(ins, exp, run_number, det_name)
-            dtype = cp.dict_of_det_data_types[det_name]
-            ctype = cp.dict_of_det_calib_types[det_name]
-            lst_dtypes = [dtype for src in lst_srcs]
-            lst_ctypes = [ctype for src in lst_srcs]
-            #print 'lst_ctypes::: ', lst_ctypes
-            #print 'lst_dtypes::: ', lst_dtypes
-            #print 'lst_srcs  ::: ', lst_srcs
-            return lst_dtypes, lst_srcs, lst_ctypes
-
+        """Returns lists of data types, sources, and calib types for detector from get_list_of_type_sources,
+           RegDB is used through the scan cache if scan was not done.
+        """
         pattern_det = det_name.lower() + '.'
         pattern_type = self.dict_of_det_data_types[det_name]
         #print 'XXX: pattern_type, pattern_det', pattern_type, pattern_det
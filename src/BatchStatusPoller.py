@@ -0,0 +1,325 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module BatchStatusPoller
+#
+#------------------------------------------------------------------------
+
+"""BatchStatusPoller - central poller of batch job status for all tracked jobs
+
+Status of all outstanding jobs is requested by a single status command (bjobs <id1> <id2> ...),
+the output table is parsed once and cached for ttl_sec, so that many BatchJob objects
+asking for status at the same ThreadWorker tick share one subprocess.
+Jobs in the final state (DONE, EXIT) are not queried any more. Job reported as not found
+(e.g. purged by LSF after its clean period) max_misses times in a row is considered lost:
+its status is None as for unknown job and it is not queried any more.
+
+Submit, status, and kill commands are pluggable strings, for example a fake local scheduler
+can be used in place of LSF: cmd_submit='python fake_lsf.py bsub', cmd_status='python fake_lsf.py bjobs', etc.
+The status command is expected to print LSF-like table with columns
+JOBID USER STAT QUEUE FROM_HOST EXEC_HOST ..., the submit command to print 'Job <id> is submitted ...'.
+
+Usage ::
+
+    from CalibManager.BatchStatusPoller import batch_status_poller
+
+    bsp = batch_status_poller()
+    bsp.set_commands(cmd_submit='bsub', cmd_status='bjobs', cmd_kill='bkill', ttl_sec=2)
+    job_id, out, err = bsp.submit('ls -l', queue='psanaq', log_file='log.txt')
+    bsp.register(job_id, callback=lambda job_id, status : print(job_id, status))
+    status = bsp.status(job_id)   # None, 'PEND', 'RUN', 'DONE', 'EXIT', etc.
+    status, node = bsp.status_and_nodename(job_id)
+    bsp.kill(job_id)
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import re
+import shlex
+import subprocess
+from shutil import which
+from time import time
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+JOB_ID_IS_UNKNOWN = 'JOB_ID_IS_UNKNOWN'
+
+submit_response_pattern = re.compile(r'Job <(\S+)>')
+not_found_pattern = re.compile(r'Job <(\S+)> is not found')
+
+def _split_command(cmd) :
+    return shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+
+def _run(command_seq) :
+    """Executes command, returns (out, err) strings"""
+    try :
+        p = subprocess.Popen(command_seq, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError as err :
+        return '', 'Can not execute %s: %s' % (' '.join(command_seq), err)
+    out, err = p.communicate()
+    return out, err
+
+def parse_status_table(out) :
+    """Parses output of bjobs-like command, returns dict {job_id : (status, nodename)}"""
+    d = {}
+    for line in out.splitlines() :
+        fields = line.split()
+        if len(fields) < 3 or not fields[0].isdigit() : continue # header or continuation line
+        d[fields[0]] = (fields[2], fields[5] if len(fields) > 5 else None)
+    return d
+
+#------------------------------
+
+class BatchStatusPoller(object) :
+    """Polls status of all outstanding batch jobs by a single command"""
+
+    final_states = ('DONE', 'EXIT')
+
+    def __init__(self, cmd_submit='bsub', cmd_status='bjobs', cmd_kill='bkill', ttl_sec=2, max_misses=3) :
+        """Constructor.
+        @param cmd_submit - submit command, called as: cmd_submit -q <queue> -o <log_file> <command>
+        @param cmd_status - status command, called as: cmd_status <id1> <id2> ...
+        @param cmd_kill - kill command, called as: cmd_kill <id>
+        @param ttl_sec - time to live of cached status
+        @param max_misses - job is lost after this number of consecutive polls reporting it as not found
+        """
+        self.jobs      = {} # job_id : [status, nodename, t_update]
+        self.misses    = {} # job_id : number of consecutive polls reporting job as not found
+        self.lost      = set()
+        self.max_misses = max_misses
+        self.callbacks = {} # job_id : list of callback(job_id, status)
+        self.t_poll    = 0
+        self.npolls    = 0
+        self.set_commands(cmd_submit, cmd_status, cmd_kill, ttl_sec)
+
+    def set_commands(self, cmd_submit=None, cmd_status=None, cmd_kill=None, ttl_sec=None) :
+        if cmd_submit is not None : self.cmd_submit = _split_command(cmd_submit)
+        if cmd_status is not None : self.cmd_status = _split_command(cmd_status)
+        if cmd_kill   is not None : self.cmd_kill   = _split_command(cmd_kill)
+        if ttl_sec    is not None : self.ttl_sec    = ttl_sec
+
+    def is_available(self) :
+        """Returns True if submit command is available on this node"""
+        if which(self.cmd_submit[0]) is not None : return True
+        msg = '\n%s IS NOT available in current configuration of your node... (try command: which %s)\n'%\
+              (self.cmd_submit[0], self.cmd_submit[0])
+        logger.warning(msg, __name__)
+        return False
+
+#------------------------------
+
+    def submit(self, command, queue='psnehq', log_file='batch-log.txt') :
+        """Submits command, returns (job_id_str, out, err), submitted job is registered for polling"""
+        if os.path.lexists(log_file) : os.remove(log_file)
+
+        out, err = _run(self.cmd_submit + ['-q', queue, '-o', log_file, command])
+        m = submit_response_pattern.search(out)
+        if m is None :
+            msg = 'EXIT: Unexpected response at batch submission:\nout: %s \nerr: %s'%(out, err)
+            logger.warning(msg, __name__)
+            job_id_str = JOB_ID_IS_UNKNOWN
+        else :
+            job_id_str = m.group(1)
+            self.register(job_id_str)
+
+        if err != '' :
+            if 'job being submitted without an AFS token' in err :
+                msg = err + '      This warning does not matter for jobs on LCLS NFS, continue'
+            else :
+                msg = '\n' + 80*'!' + '\n' + err + 80*'!' + '\n'
+            logger.warning(msg, __name__)
+
+        logger.info(out, __name__)
+        return job_id_str, out, err
+
+    def kill(self, job_id) :
+        """Kills job, returns command output"""
+        out, err = _run(self.cmd_kill + [job_id])
+        self.t_poll = 0 # status of killed job should be refreshed at next request
+        return err + '\n' + out if err != '' else out
+
+    def check(self, job_id) :
+        """Returns raw output of the status command for job"""
+        out, err = _run(self.cmd_status + [job_id])
+        return err + '\n' + out if err != '' else out
+
+#------------------------------
+
+    def register(self, job_id, callback=None) :
+        """Adds job to the list of polled jobs, callback(job_id, status) is called on status change"""
+        if job_id is None or job_id == JOB_ID_IS_UNKNOWN : return
+        self.jobs.setdefault(job_id, [None, None, 0])
+        if callback is not None : self.callbacks.setdefault(job_id, []).append(callback)
+
+    def unregister(self, job_id) :
+        self.jobs.pop(job_id, None)
+        self.callbacks.pop(job_id, None)
+        self.misses.pop(job_id, None)
+        self.lost.discard(job_id)
+
+    def is_lost(self, job_id) :
+        """Returns True for job which is not submitted or is not found by the status command any more"""
+        return job_id is None or job_id == JOB_ID_IS_UNKNOWN or job_id in self.lost
+
+    def outstanding(self) :
+        """Returns sorted list of job ids which are not in the final state and not lost"""
+        return sorted(job_id for job_id, (status, node, t) in self.jobs.items()\
+                      if status not in self.final_states and job_id not in self.lost)
+
+    def poll(self, force=False) :
+        """Requests status of all outstanding jobs by a single command if cache is expired"""
+        if not force and time() - self.t_poll < self.ttl_sec : return
+        job_ids = self.outstanding()
+        self.t_poll = time()
+        if not job_ids : return
+
+        out, err = _run(self.cmd_status + job_ids)
+        self.npolls += 1
+        table = parse_status_table(out)
+        not_found = set(not_found_pattern.findall(out + err))
+        if err != '' and not table and not not_found : logger.warning('%s:\n%s' % (' '.join(self.cmd_status), err), __name__)
+
+        for job_id in job_ids :
+            if job_id not in table :
+                if job_id in not_found : self._miss(job_id)
+                continue # no answer for job, keep last known status
+            self.misses.pop(job_id, None)
+            status, node = table[job_id]
+            rec = self.jobs[job_id]
+            changed = status != rec[0]
+            rec[:] = [status, node, self.t_poll]
+            if changed :
+                for callback in self.callbacks.get(job_id, []) : callback(job_id, status)
+
+    def _miss(self, job_id) :
+        """Counts report of job as not found, after max_misses reports job is lost with status None"""
+        self.misses[job_id] = self.misses.get(job_id, 0) + 1
+        if self.misses[job_id] < self.max_misses : return
+        rec = self.jobs[job_id]
+        logger.warning('job %s with last known status %s is not found by %s %d times, it is not polled any more'%\
+                       (job_id, rec[0], self.cmd_status[0], self.misses[job_id]), __name__)
+        self.lost.add(job_id)
+        changed = rec[0] is not None
+        rec[:] = [None, None, self.t_poll]
+        if changed :
+            for callback in self.callbacks.get(job_id, []) : callback(job_id, None)
+
+    def status_and_nodename(self, job_id) :
+        """Returns (status, nodename) of job, status might be None, 'RUN', 'PEND', 'EXIT', 'DONE', etc.,
+           None - for unknown or lost job.
+        """
+        if job_id is None or job_id == JOB_ID_IS_UNKNOWN : return None, None
+        if job_id not in self.jobs :
+            self.register(job_id)
+            self.t_poll = 0
+        self.poll()
+        status, node, t = self.jobs[job_id]
+        return status, node
+
+    def status(self, job_id) :
+        return self.status_and_nodename(job_id)[0]
+
+#------------------------------
+
+_poller = None
+
+def batch_status_poller() :
+    """Returns the shared BatchStatusPoller object"""
+    global _poller
+    if _poller is None : _poller = BatchStatusPoller()
+    return _poller
+
+#------------------------------
+
+# Fake scheduler with LSF-like interface for tests: python fake_lsf.py bsub|bjobs|bkill <args>
+FAKE_LSF_SCRIPT = r'''
+import os, sys, signal, subprocess
+state = os.environ.get('FAKE_LSF_DIR', '/tmp/fake_lsf')
+if not os.path.isdir(state) : os.makedirs(state)
+cmd, args = sys.argv[1], sys.argv[2:]
+if cmd == 'bsub' :
+    queue, log, command = args[1], args[3], args[4]
+    job_id = str(len([f for f in os.listdir(state) if f.endswith('.pid')]) + 1001)
+    rc = os.path.join(state, job_id + '.rc')
+    p = subprocess.Popen(['sh', '-c', '(%s) > %s 2>&1; echo $? > %s' % (command, log, rc)],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    open(os.path.join(state, job_id + '.pid'), 'w').write(str(p.pid))
+    print('Job <%s> is submitted to queue <%s>.' % (job_id, queue))
+elif cmd == 'bjobs' :
+    print('JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME')
+    for job_id in args :
+        fpid, frc = os.path.join(state, job_id + '.pid'), os.path.join(state, job_id + '.rc')
+        if not os.path.exists(fpid) :
+            sys.stderr.write('Job <%s> is not found\n' % job_id); continue
+        if os.path.exists(frc) and open(frc).read().strip() :
+            stat = 'DONE' if open(frc).read().strip() == '0' else 'EXIT'
+        else :
+            stat = 'RUN'
+        print('%s fake %s local localhost localhost job Jan 1 00:00' % (job_id, stat))
+elif cmd == 'bkill' :
+    job_id = args[0]
+    try :
+        os.killpg(int(open(os.path.join(state, job_id + '.pid')).read()), signal.SIGTERM)
+        open(os.path.join(state, job_id + '.rc'), 'w').write('143')
+        print('Job <%s> is being terminated' % job_id)
+    except (OSError, IOError) as err :
+        sys.stderr.write('Job <%s>: %s\n' % (job_id, err))
+'''
+
+def write_fake_lsf_script(path) :
+    """Writes fake scheduler script, returns dict of commands for BatchStatusPoller.set_commands"""
+    with open(path, 'w') as f : f.write(FAKE_LSF_SCRIPT)
+    import sys
+    py = '%s %s' % (sys.executable, path)
+    return dict(cmd_submit=py+' bsub', cmd_status=py+' bjobs', cmd_kill=py+' bkill')
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    from time import sleep
+    d = tempfile.mkdtemp()
+    os.environ['FAKE_LSF_DIR'] = os.path.join(d, 'state')
+    bsp = BatchStatusPoller(ttl_sec=0.5, **write_fake_lsf_script(os.path.join(d, 'fake_lsf.py')))
+
+    changes = []
+    jobs = [bsp.submit('sleep %.1f; exit %d' % (0.3*i, i%2), 'local', os.path.join(d, 'log-%d.txt'%i))[0] for i in range(1,6)]
+    for job_id in jobs : bsp.register(job_id, callback=lambda job_id, status : changes.append((job_id, status)))
+    job_kill = bsp.submit('sleep 100', 'local', os.path.join(d, 'log-kill.txt'))[0]
+
+    for tick in range(20) :
+        statuses = [bsp.status(job_id) for job_id in jobs] # many requests per tick - one status command
+        print('tick %2d  polls %2d  %s' % (tick, bsp.npolls, ' '.join(str(s) for s in statuses)))
+        if not [s for s in statuses if s not in bsp.final_states] : break
+        sleep(0.3)
+
+    print('status of job to kill: %s' % bsp.status(job_kill))
+    print('kill: %s' % bsp.kill(job_kill).strip())
+    print('status after kill: %s' % bsp.status(job_kill))
+    print('status changes: %s' % str(changes))
+    assert [bsp.status(job_id) for job_id in jobs] == ['EXIT', 'DONE', 'EXIT', 'DONE', 'EXIT']
+
+    job_lost = bsp.submit('sleep 100', 'local', os.path.join(d, 'log-lost.txt'))[0]
+    print('status of job to be purged: %s' % bsp.status(job_lost))
+    os.remove(os.path.join(os.environ['FAKE_LSF_DIR'], job_lost + '.pid')) # purged by scheduler
+    for tick in range(5) :
+        bsp.poll(force=True)
+        print('tick %d  status %s  outstanding %s' % (tick, bsp.status(job_lost), bsp.outstanding()))
+    assert bsp.status(job_lost) is None and job_lost in bsp.lost and not bsp.outstanding()
+    sys.exit('End of test')
+
+#------------------------------
@@ -0,0 +1,207 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module CalibFileDedup
+#
+#------------------------------------------------------------------------
+
+"""CalibFileDedup - content-hash deduplication of calibration files
+
+Content of files is compared by streaming blake2b digest, digests are memoized by (path, size, mtime),
+and only files of equal size are hashed.
+
+For deployment of file to <calib-type-dir>/<begin>-<end>.data dedup_plan returns one of actions:
+  - 'deploy' - file has to be written,
+  - 'skip'   - existing file with identical content is already in use for all runs of the new range
+               (e.g. the same file is re-deployed, or zero pedestals are deployed again),
+  - 'extend' - file with identical content is in use for runs just before the new range and ends at begin-1,
+               it is renamed to cover the new range; rename is done only if the run validity map
+               after rename is identical in content to the map after deployment of new file.
+Run validity maps are evaluated by CalibFileFinder.resolve_actual_run_ranges.
+
+duplicate_clusters walks the calib tree and returns clusters of files with identical content.
+
+Usage ::
+
+    from CalibManager.CalibFileDedup import file_digest, dedup_plan, duplicate_clusters, txt_duplicate_clusters
+
+    action, name = dedup_plan('./work/clb-xpptut15-r0054-peds-ave-XppGon.0:Cspad.0.txt',
+                              '/reg/d/psdm/XPP/xpptut15/calib/CsPad::CalibV1/XppGon.0:Cspad.0/pedestals/54-end.data')
+    # ('skip', '50-end.data') or ('extend', '50-53.data') or ('deploy', None)
+    print(txt_duplicate_clusters(duplicate_clusters('/reg/d/psdm/XPP/xpptut15/calib')))
+
+    # command line:
+    calibfile dedupe -e xpptut15
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import hashlib
+import threading
+
+from CalibManager.CalibFileFinder import calib_fname_pattern, parse_calib_fname, CalibFileColumns, resolve_actual_run_ranges
+
+#------------------------------
+
+_digests = {} # {path: (size, mtime_ns, digest)}
+_lock_digests = threading.Lock()
+
+def file_digest(path, block_size=1<<20) :
+    """Returns hex digest of file content, streamed in blocks, memoized for unchanged file"""
+    st = os.stat(path)
+    with _lock_digests :
+        rec = _digests.get(path)
+    if rec is not None and rec[:2] == (st.st_size, st.st_mtime_ns) : return rec[2]
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f :
+        for block in iter(lambda : f.read(block_size), b'') : h.update(block)
+    digest = h.hexdigest()
+    with _lock_digests :
+        _digests[path] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+def is_identical(path1, path2) :
+    """Returns True if files have identical content, files of different size are not hashed"""
+    if os.path.getsize(path1) != os.path.getsize(path2) : return False
+    return file_digest(path1) == file_digest(path2)
+
+#------------------------------
+
+def _segments_in_content(list_of_cfiles, names_of_new_content, run_min, run_max) :
+    """Returns list of (begin, end, name) of validity segments in [run_min, run_max],
+       names of files with the new content are replaced by None, adjacent segments of the same content are merged.
+    """
+    segs = []
+    for b, e, name in resolve_actual_run_ranges(list_of_cfiles)['segments'] :
+        if e < run_min or b > run_max : continue
+        b, e = max(b, run_min), min(e, run_max)
+        name = None if name in names_of_new_content else name
+        if segs and segs[-1][2] == name and segs[-1][1] == b-1 : segs[-1] = (segs[-1][0], e, name)
+        else : segs.append((b, e, name))
+    return segs
+
+def dedup_plan(path_inp, path_out, exclude=()) :
+    """Returns (action, name) for deployment of file path_inp as path_out,
+       action is 'deploy', 'skip' or 'extend', name is basename of existing identical file or None for 'deploy'.
+       @param exclude - basenames of files in the directory of path_out which should not be renamed
+    """
+    dir_out, fname_out = os.path.split(path_out)
+    rng = parse_calib_fname(fname_out)
+    if rng is None or not os.path.isdir(dir_out) : return 'deploy', None
+    begin, end = rng
+    cfcols = CalibFileColumns.from_directory(dir_out)
+    if len(cfcols) == 0 : return 'deploy', None
+    cfiles = cfcols.calib_files()
+    size_inp = os.path.getsize(path_inp)
+    identical = lambda name : os.path.getsize(os.path.join(dir_out, name)) == size_inp\
+                              and is_identical(path_inp, os.path.join(dir_out, name))
+
+    segments = resolve_actual_run_ranges(cfiles)['segments']
+
+    # skip: single identical file is in use for all runs of the new range
+    segs = [(b, e, name) for b, e, name in segments if e >= begin and b <= end]
+    if len(segs) == 1 and segs[0][0] <= begin and segs[0][1] >= end and identical(segs[0][2]) :
+        return 'skip', segs[0][2]
+
+    # extend: identical file is in use for run begin-1 and ends there
+    prev = [(b, e, name) for b, e, name in segments if b <= begin-1 <= e]
+    if not prev : return 'deploy', None
+    name_prev = prev[0][2]
+    begin_prev, end_prev = parse_calib_fname(name_prev)
+    if end_prev != begin-1 or name_prev in exclude or not identical(name_prev) : return 'deploy', None
+    name_ext = extended_name(name_prev, fname_out)
+    if name_ext in cfcols.names or name_ext in exclude : return 'deploy', None
+
+    names_deploy = [n for n in cfcols.names if n != fname_out] + [fname_out]
+    names_extend = [n for n in cfcols.names if n != name_prev] + [name_ext]
+    run_min, run_max = begin_prev, end
+    if _segments_in_content(CalibFileColumns.from_names(names_deploy).calib_files(), (name_prev, fname_out), run_min, run_max) !=\
+       _segments_in_content(CalibFileColumns.from_names(names_extend).calib_files(), (name_ext,), run_min, run_max) :
+        return 'deploy', None
+    return 'extend', name_prev
+
+def extended_name(name_prev, fname_out) :
+    """Returns name of file name_prev extended to the end of fname_out, e.g. ('50-53.data', '54-end.data') -> '50-end.data'"""
+    return '%s-%s.data' % (calib_fname_pattern.match(name_prev).group(1), calib_fname_pattern.match(fname_out).group(2))
+
+#------------------------------
+
+def duplicate_clusters(calib_dir) :
+    """Walks calib tree and returns list of clusters of calibration files with identical content,
+       each cluster is dict {'digest', 'size', 'paths'}, sorted by wasted bytes.
+    """
+    dict_of_sizes = {}
+    for dirpath, dirnames, filenames in os.walk(calib_dir) :
+        for fname in filenames :
+            if calib_fname_pattern.match(fname) is None : continue
+            path = os.path.join(dirpath, fname)
+            try :
+                dict_of_sizes.setdefault(os.path.getsize(path), []).append(path)
+            except OSError :
+                continue
+    clusters = []
+    for size, paths in dict_of_sizes.items() :
+        if len(paths) < 2 : continue
+        dict_of_digests = {}
+        for path in paths : dict_of_digests.setdefault(file_digest(path), []).append(path)
+        for digest, same in dict_of_digests.items() :
+            if len(same) > 1 : clusters.append({'digest' : digest, 'size' : size, 'paths' : sorted(same)})
+    clusters.sort(key=lambda c : -c['size'] * (len(c['paths']) - 1))
+    return clusters
+
+def txt_duplicate_clusters(clusters) :
+    """Returns text report of duplicate clusters"""
+    wasted = sum(c['size'] * (len(c['paths']) - 1) for c in clusters)
+    lines = ['%d cluster(s) of identical calibration files, %d duplicate bytes' % (len(clusters), wasted)]
+    for c in clusters :
+        ndirs = len(set(os.path.dirname(p) for p in c['paths']))
+        lines.append('digest %s  size %d  files %d  directories %d' % (c['digest'], c['size'], len(c['paths']), ndirs))
+        lines += ['    %s' % p for p in c['paths']]
+    return '\n'.join(lines)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    from time import time
+
+    d = tempfile.mkdtemp()
+    dir_ctype = os.path.join(d, 'calib', 'CsPad::CalibV1', 'XppGon.0:Cspad.0', 'pedestals')
+    dir_rms   = os.path.join(d, 'calib', 'CsPad::CalibV1', 'XppGon.0:Cspad.0', 'pixel_rms')
+    os.makedirs(dir_ctype)
+    os.makedirs(dir_rms)
+    def save(path, txt) :
+        with open(path, 'w') as f : f.write(txt)
+    save(os.path.join(dir_ctype, '10-49.data'), 'peds A\n')
+    save(os.path.join(dir_ctype, '50-53.data'), 'peds B\n')
+    save(os.path.join(dir_ctype, '60-end.data'), 'peds C\n')
+    save(os.path.join(dir_rms, '10-end.data'), 'peds B\n')
+    inp_b, inp_c = os.path.join(d, 'peds-b.txt'), os.path.join(d, 'peds-c.txt')
+    save(inp_b, 'peds B\n')
+    save(inp_c, 'peds C\n')
+
+    for inp, fname in ((inp_b, '54-59.data'), (inp_b, '54-end.data'), (inp_c, '70-end.data'), (inp_c, '60-end.data'), (inp_c, '54-end.data'), (inp_b, '55-59.data')) :
+        print('%-12s %-12s -> %s' % (os.path.basename(inp), fname, str(dedup_plan(inp, os.path.join(dir_ctype, fname)))))
+    print('extended name: %s' % extended_name('50-53.data', '54-end.data'))
+
+    print(txt_duplicate_clusters(duplicate_clusters(os.path.join(d, 'calib'))))
+
+    big = os.path.join(d, 'big.txt')
+    with open(big, 'wb') as f : f.write(os.urandom(100<<20))
+    t0 = time(); file_digest(big); t1 = time(); file_digest(big); t2 = time()
+    print('digest of 100 MB: %.3f sec, memoized: %.6f sec' % (t1-t0, t2-t1))
+    sys.exit('End of test')
+
+#------------------------------
@@ -21,14 +21,26 @@ __version__ = "$Revision$"
 #--------------------------------
 
 import os
+import re
+import heapq
+from bisect import bisect_right
+
+import numpy as np
 
 from CalibManager.Logger                   import logger
 
 #------------------------------
 
+# pattern for calibration file name <begin>-<end>.data, i.e. 123-end.data or 123-456.data
+calib_fname_pattern = re.compile(r'^(\d+)-(\d+|end)\.data$')
+
+#------------------------------
+
 class CalibFile(object) :
     """Calib file name, run range, etc
     """
+    __slots__ = ('is_calibfile', 'path', 'basename', 'begin', 'end')
+
     max_run_number = 9999
 
     def __init__(self, path) :
@@ -53,6 +65,21 @@ class CalibFile(object) :
         self.end = self.max_run_number
         if str_end != 'end' : self.end = int(str_end)
 
+    @classmethod
+    def from_range(cls, basename, begin, end, path=None) :
+        """Returns CalibFile object for already parsed file name, without parsing"""
+        cfile = cls.__new__(cls)
+        cfile.is_calibfile = True
+        cfile.path = basename if path is None else path
+        cfile.basename = basename
+        cfile.begin = begin
+        cfile.end = end
+        return cfile
+
+    def sort_key(self) :
+        """Key for sorted(), consistent with __cmp__: begin ascending, end descending"""
+        return (self.begin, -self.end)
+
 #----------------------------------
 
     def is_calib_file(self) : return self.is_calibfile
@@ -143,34 +170,116 @@ class CalibFileFinder(object) :
     def find_calib_file(self, runnum=0) :
         """returns string path to found calibration file of empty string
         """
-        cfile = find_calib_file_in_list_for_run(self.list_of_sorted_calib_files(), runnum)
+        cfile = self.run_index().find_calib_file(runnum)
         #cfile.print_member_data()
         if cfile is None : return ''
         else : return os.path.join(self.path, cfile.get_basename())
 
+#----------------------------------
+
+    def find_calib_files(self, runs) :
+        """returns the list of string paths to calibration files (or empty strings) for the list of runs
+        """
+        return [('' if cfile is None else os.path.join(self.path, cfile.get_basename()))\
+                for cfile in self.run_index().find_calib_files(runs)]
+
+#----------------------------------
+
+    def run_index(self) :
+        """returns CalibRunIndex for the calib-type directory from the calib tree manifest,
+           index is re-built only if the directory mtime has changed since the previous call
+        """
+        if not os.path.exists(self.path) : return CalibRunIndex([], path=self.path)
+        from CalibManager.CalibTreeManifest import manifest_for_path
+        m = manifest_for_path(self.path)
+        if m is not None :
+            m.refresh(self.path) # stat of the calib-type directory, re-list it only if changed
+            return m.run_index(self.path)
+        mtime = os.stat(self.path).st_mtime
+        if getattr(self, '_index', None) is None or mtime != self._index_mtime :
+            self._index = CalibRunIndex(self.list_of_sorted_calib_files(), path=self.path)
+            self._index_mtime = mtime
+        return self._index
+
 #----------------------------------
 
     def list_of_sorted_calib_files(self) :
 
-        list_of_fnames = os.listdir(self.path)
-        if list_of_fnames == [] :
-            logger.warning('Directory %s IS EMPTY!' % self.path, __name__)
+        cfcols = CalibFileColumns.from_directory(self.path)
+        if len(cfcols) == 0 :
+            logger.warning('Directory %s does not have calibration files!' % self.path, __name__)
             return []
-        return list_of_sorted_calib_files_from_list_of_files(list_of_fnames)
+        return cfcols.calib_files()
+
+#----------------------------------
+
+def parse_calib_fname(fname) :
+    """Returns (begin, end) for calibration file name like 123-end.data or 123-456.data, None for other names
+    """
+    m = calib_fname_pattern.match(fname)
+    if m is None : return None
+    str_begin, str_end = m.groups()
+    return int(str_begin), (CalibFile.max_run_number if str_end == 'end' else int(str_end))
+
+#----------------------------------
+
+class CalibFileColumns(object) :
+    """Columnar representation of calibration files in directory:
+       numpy arrays of begin, end, and index of name in the list of names,
+       sorted by begin ascending and end descending, as sorted CalibFile objects.
+    """
+    __slots__ = ('names', 'begin', 'end', 'name_index')
+
+    def __init__(self, names, begin, end, name_index) :
+        self.names      = names      # list of all parsed calibration file names
+        self.begin      = begin      # sorted np.array of begin runs
+        self.end        = end        # np.array of end runs in the same order
+        self.name_index = name_index # np.array of indexes in self.names in the same order
+
+    @staticmethod
+    def from_names(list_of_files) :
+        """Parses the list of file names in one pass and sorts them by key"""
+        names, begins, ends = [], [], []
+        for fname in list_of_files :
+            fname = str(fname)
+            m = calib_fname_pattern.match(fname)
+            if m is None : continue
+            str_begin, str_end = m.groups()
+            names .append(fname)
+            begins.append(int(str_begin))
+            ends  .append(CalibFile.max_run_number if str_end == 'end' else int(str_end))
+        return CalibFileColumns.from_ranges(names, begins, ends)
+
+    @staticmethod
+    def from_ranges(names, begins, ends) :
+        """Sorts already parsed names with run ranges"""
+        begin = np.array(begins, dtype=np.int64)
+        end   = np.array(ends,   dtype=np.int64)
+        order = np.lexsort((-end, begin)) # stable, the last key is primary
+        return CalibFileColumns(names, begin[order], end[order], order)
+
+    @staticmethod
+    def from_directory(path) :
+        """Returns CalibFileColumns for file names from os.scandir"""
+        with os.scandir(path) as it :
+            return CalibFileColumns.from_names(entry.name for entry in it)
+
+    def __len__(self) : return len(self.names)
+
+    def sorted_names(self) :
+        return [self.names[i] for i in self.name_index.tolist()]
+
+    def calib_files(self) :
+        """Returns the list of sorted CalibFile objects"""
+        return [CalibFile.from_range(name, b, e) for name, b, e in\
+                zip(self.sorted_names(), self.begin.tolist(), self.end.tolist())]
 
 #----------------------------------
 
 def list_of_sorted_calib_files_from_list_of_files(list_of_files) :
     """Returns the list of CalibFile objects for specified list of files or [] 
     """    
-    list_of_calib_files = []
-    for file in list_of_files :
-        cfile = CalibFile(str(file))
-        if cfile.is_calib_file() :
-            list_of_calib_files.append(cfile)
-            #cfile.print_member_data()
-
-    return sorted(list_of_calib_files) # sorted() uses reimplemented method CalibFile.__cmp__()
+    return CalibFileColumns.from_names(list_of_files).calib_files()
 
 #----------------------------------
 
@@ -184,26 +293,183 @@ def find_calib_file_in_list_for_run(list_sorted_cfiles, runnum=0) :
 
 #----------------------------------
 
-def dict_calib_file_actual_run_range(list_of_cfiles) :
+def _resolve_validity_segments(begins, ends, with_counts=False) :
+    """Sweep over sorted run ranges [begins[i], ends[i]] of calibration files.
+       Returns lists seg_begin, seg_end, seg_index of non-overlapping run segments,
+       where seg_index is the index of file which is found for runs in the segment,
+       i.e. the last file in the sorted list which contains the run.
+       If with_counts=True, the list seg_count of the number of files covering the segment
+       is also returned and adjacent segments are merged only if their counts are equal.
+    """
+    nfiles = len(begins)
+    sorted_ends = sorted(ends)
+    bounds = sorted(set(begins) | set(e+1 for e in ends))
+    seg_begin, seg_end, seg_index, seg_count = [], [], [], []
+    active = [] # heap of -index for files with begin <= run
+    j = 0       # number of files with begin <= run
+    jend = 0    # number of files with end < run
+    for k, b in enumerate(bounds) :
+        while j < nfiles and begins[j] <= b :
+            heapq.heappush(active, -j)
+            j += 1
+        while jend < nfiles and sorted_ends[jend] < b : jend += 1
+        while active and ends[-active[0]] < b : heapq.heappop(active)
+        if not active : continue
+        i = -active[0]
+        n = j - jend
+        e = bounds[k+1]-1 if k+1 < len(bounds) else ends[i]
+        if seg_index and seg_index[-1] == i and seg_end[-1] == b-1 and (not with_counts or seg_count[-1] == n) :
+            seg_end[-1] = e
+        else :
+            seg_begin.append(b)
+            seg_end  .append(e)
+            seg_index.append(i)
+            seg_count.append(n)
+    if with_counts : return seg_begin, seg_end, seg_index, seg_count
+    return seg_begin, seg_end, seg_index
 
+#----------------------------------
+
+class CalibRunIndex(object) :
+    """Run-range index of calibration files for a single calib-type directory.
+
+    The list of sorted files is resolved once to the table of non-overlapping run segments
+    with the same newest-begin-wins rule as in find_calib_file_in_list_for_run,
+    then each run lookup is a bisect and a list of runs is resolved in one vectorized pass.
+    """
+
+    def __init__(self, list_of_cfiles, path=None) :
+        """Constructor.
+        @param list_of_cfiles - list of CalibFile objects sorted as in list_of_sorted_calib_files_from_list_of_files
+        @param path - (optional) path to the calib-type directory
+        """
+        self.path   = path
+        self.cfiles = list(list_of_cfiles)
+        self.begins = np.array([cfile.get_begin() for cfile in self.cfiles], dtype=np.int64)
+        self.ends   = np.array([cfile.get_end()   for cfile in self.cfiles], dtype=np.int64)
+        self.seg_begin, self.seg_end, self.seg_index =\
+            _resolve_validity_segments(self.begins.tolist(), self.ends.tolist())
+        self.arr_seg_begin = np.array(self.seg_begin, dtype=np.int64)
+        self.arr_seg_end   = np.array(self.seg_end,   dtype=np.int64)
+        self.arr_seg_index = np.array(self.seg_index, dtype=np.int64)
+
+    @staticmethod
+    def from_directory(path) :
+        """Returns CalibRunIndex for the list of files in the calib-type directory"""
+        return CalibRunIndex(CalibFileColumns.from_directory(path).calib_files(), path=path)
+
+    def __len__(self) : return len(self.cfiles)
+
+    def find_index(self, runnum) :
+        """Returns index of the calibration file in the sorted list for run or -1"""
+        i = bisect_right(self.seg_begin, runnum) - 1
+        if i < 0 or runnum > self.seg_end[i] : return -1
+        return self.seg_index[i]
+
+    def find_calib_file(self, runnum=0) :
+        """Returns CalibFile object or None"""
+        i = self.find_index(runnum)
+        return None if i < 0 else self.cfiles[i]
+
+    def find_indexes(self, runs) :
+        """Returns numpy array of calibration file indexes (-1 if not found) for array-like of runs"""
+        runs = np.asarray(runs, dtype=np.int64)
+        if not self.seg_begin : return np.full(runs.shape, -1, dtype=np.int64)
+        pos = np.searchsorted(self.arr_seg_begin, runs, side='right') - 1
+        posc = np.maximum(pos, 0)
+        found = (pos >= 0) & (runs <= self.arr_seg_end[posc])
+        return np.where(found, self.arr_seg_index[posc], -1)
+
+    def find_calib_files(self, runs) :
+        """Returns the list of CalibFile objects or None for array-like of runs"""
+        return [(None if i < 0 else self.cfiles[i]) for i in self.find_indexes(runs).tolist()]
+
+    def print_segments(self) :
+        for b, e, i in zip(self.seg_begin, self.seg_end, self.seg_index) :
+            print('run range %04d - %04d  file %s' % (b, e, self.cfiles[i].get_basename()))
+
+#----------------------------------
+
+def resolve_actual_run_ranges(list_of_cfiles, max_run=None) :
+    """Resolves in one sweep over the sorted list of CalibFile objects the actual validity of files.
+       Returns dictionary with keys:
+       'segments' - list of (begin, end, basename) for non-overlapping run segments in run order,
+       'files'    - dictionary {basename:[(begin, end),...]} of run ranges where file is used, [] - file is not used,
+       'unused'   - list of basenames of files which are not used for any run,
+       'overlaps' - list of (begin, end, basename, nfiles) for run ranges covered by more than one file,
+                    where basename is the file in use and nfiles - the number of files covering the range,
+       'gaps'     - list of (begin, end) run ranges in [0, max_run] without calibration file.
+    """
+    if max_run is None : max_run = CalibFileFinder.max_run_number
+    begins = [cfile.get_begin() for cfile in list_of_cfiles]
+    ends   = [cfile.get_end()   for cfile in list_of_cfiles]
+    names  = [cfile.get_basename() for cfile in list_of_cfiles]
+    seg_begin, seg_end, seg_index, seg_count = _resolve_validity_segments(begins, ends, with_counts=True)
+
+    dict_files = dict((name, []) for name in names)
+    segments, overlaps, gaps = [], [], []
+    run_next = 0
+    for b, e, i, n in zip(seg_begin, seg_end, seg_index, seg_count) :
+        name = names[i]
+        if b > run_next : gaps.append((run_next, min(b-1, max_run)))
+        run_next = e + 1
+        if n > 1 : overlaps.append((b, e, name, n))
+        if segments and segments[-1][2] == name and segments[-1][1] == b-1 :
+            segments[-1] = (segments[-1][0], e, name)
+            dict_files[name][-1] = (dict_files[name][-1][0], e)
+        else :
+            segments.append((b, e, name))
+            dict_files[name].append((b, e))
+    if run_next <= max_run : gaps.append((run_next, max_run))
+
+    return {'segments' : segments,
+            'files'    : dict_files,
+            'unused'   : [name for name in names if not dict_files[name]],
+            'overlaps' : overlaps,
+            'gaps'     : [(b, e) for b, e in gaps if b <= e]}
+
+#----------------------------------
+
+def dict_calib_file_actual_run_range(list_of_cfiles) :
+    """Returns dictionary {basename:[begin, end]} with begin of the file and end of its
+       actual use found at the candidate ends (begins of files - 1, max run number, and end of the last file),
+       [-1, -1] for files which are not used. All candidate ends are resolved through CalibRunIndex.
+    """
     list_of_ends   = [cfile.get_begin()-1 for cfile in list_of_cfiles]
-    #list_of_ends.append(0)                              # add minimal end=0
     list_of_ends.append(CalibFileFinder.max_run_number) # add maximal end=9999
     if len(list_of_cfiles)>0 :
         list_of_ends.append(list_of_cfiles[-1].get_end())   # end of the last file
-    
-    # Fill dictionary with begin-end from file name
-    #dict_fname_range = { cfile.get_basename():[cfile.get_begin(), cfile.get_end()] for cfile in list_of_cfiles }
+
     dict_fname_range = { cfile.get_basename():[-1, -1] for cfile in list_of_cfiles }
 
-    # Substitute ends from file finder
-    for end in list_of_ends :
-        cfile = find_calib_file_in_list_for_run(list_of_cfiles, runnum=end)
-        if cfile is None : continue
+    index = CalibRunIndex(list_of_cfiles)
+    for end, i in zip(list_of_ends, index.find_indexes(list_of_ends).tolist()) :
+        if i < 0 : continue
+        cfile = list_of_cfiles[i]
         dict_fname_range[cfile.get_basename()] = [cfile.get_begin(), end]
-    
+
     return dict_fname_range
 
+#----------------------------------
+
+def benchmark_actual_run_range(list_of_nfiles=(100, 1000, 10000, 20000), seed=12345) :
+    """Times dict_calib_file_actual_run_range and resolve_actual_run_ranges on synthetic calib directories"""
+    from time import time
+    import random
+    rnd = random.Random(seed)
+    maxrun = CalibFileFinder.max_run_number
+    for nfiles in list_of_nfiles :
+        fnames = set()
+        while len(fnames) < nfiles :
+            b = rnd.randint(0, maxrun)
+            fnames.add('%d-end.data' % b if rnd.random() < 0.5 else '%d-%d.data' % (b, min(b+rnd.randint(0, 200), maxrun)))
+        t0 = time(); cfiles = list_of_sorted_calib_files_from_list_of_files(fnames); dt_sort = time()-t0
+        t0 = time(); d = dict_calib_file_actual_run_range(cfiles); dt_dict = time()-t0
+        t0 = time(); r = resolve_actual_run_ranges(cfiles); dt_sweep = time()-t0
+        msg = 'nfiles: %6d  parse+sort: %7.3f sec  dict: %7.3f sec  sweep: %7.3f sec  segments: %d unused: %d overlaps: %d gaps: %d'%\
+              (nfiles, dt_sort, dt_dict, dt_sweep, len(r['segments']), len(r['unused']), len(r['overlaps']), len(r['gaps']))
+        print(msg)
+
 #----------------------------------
 #  Test of class CalibFile
 #----------------------------------
@@ -223,7 +489,7 @@ if __name__ == "__main__" :
         calib_file.print_member_data()
 
     print('\nSorted list of calibration files')
-    for cfile in sorted(list_of_calib_files) :
+    for cfile in sorted(list_of_calib_files, key=CalibFile.sort_key) :
         cfile.print_member_data()
 
     print('\n\nTest class CalibFileFinder')
@@ -233,6 +499,24 @@ if __name__ == "__main__" :
     runnum = 232
     print('For run %d: %s' % (runnum, cff.find_calib_file(runnum)))
 
+    print('\n\nTest class CalibRunIndex')
+    list_of_cfiles = list_of_sorted_calib_files_from_list_of_files(list_of_files)
+    cri = CalibRunIndex(list_of_cfiles)
+    cri.print_segments()
+    runs = list(range(0, CalibFileFinder.max_run_number+2))
+    for runnum, cfile in zip(runs, cri.find_calib_files(runs)) :
+        assert cfile is find_calib_file_in_list_for_run(list_of_cfiles, runnum), 'mismatch for run %d' % runnum
+    print('CalibRunIndex lookup is consistent with find_calib_file_in_list_for_run for runs 0-%d' % runs[-1])
+
+    print('\n\nTest resolve_actual_run_ranges:')
+    r = resolve_actual_run_ranges(list_of_cfiles)
+    for k in ('segments', 'unused', 'overlaps', 'gaps') :
+        print('%9s: %s' % (k, str(r[k])))
+
+    if 'bench' in sys.argv :
+        print('\n\nBenchmark for run ranges:')
+        benchmark_actual_run_range()
+
     print('\n\nTest methods for run ranges:')
     list_of_cfiles = list_of_sorted_calib_files_from_list_of_files(list_of_files)
     dict_fname_range = dict_calib_file_actual_run_range(list_of_cfiles)
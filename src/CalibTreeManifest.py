@@ -0,0 +1,341 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#   CalibTreeManifest...
+#------------------------------------------------------------------------
+
+"""Persistent manifest of the calib directory tree with mtime-based incremental refresh
+
+Manifest keeps for each directory of the tree <exp>/calib/<Type>::CalibV1/<src>/<ctype>/
+its mtime, the list of sub-directories, and the files with size, mtime, and run range
+parsed from the calibration file name. The offset (size) of the HISTORY file is kept for each directory.
+At refresh only directories with changed mtime are re-listed, all other directories cost one os.stat.
+
+Usage ::
+
+    import CalibManager.CalibTreeManifest as ctm
+
+    m = ctm.get_manifest('/reg/d/psdm/CXI/cxitut13/calib') # loaded from file and refreshed
+    names  = m.listdir(path)           # sorted list of names in directory or None
+    status = m.isdir(path)
+    cfiles = m.list_of_sorted_calib_files(path)
+    index  = m.run_index(path)         # CalibRunIndex for calib-type directory
+    offset = m.history_offset(path)    # size of the HISTORY file in directory or None
+    m.refresh(path)                    # refresh sub-tree
+    m.save()
+
+    names = ctm.listdir(path)          # from manifest if path is in refreshed tree, othervise os.listdir
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import json
+import tempfile
+from time import time
+
+from CalibManager.Logger                   import logger
+from CalibManager.CalibFileFinder          import CalibFileColumns, CalibRunIndex, parse_calib_fname
+
+#------------------------------
+
+MANIFEST_VERSION = 1
+HISTORY_FNAME = 'HISTORY'
+
+#------------------------------
+
+def path_to_manifest_default(calib_dir) :
+    """Returns path to the manifest file in the user cache directory, for example
+       ~/.cache/CalibManager/manifest/reg_d_psdm_CXI_cxitut13_calib.json
+    """
+    name = os.path.abspath(calib_dir).strip(os.sep).replace(os.sep, '_').replace(':', '_')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'CalibManager', 'manifest', '%s.json' % name)
+
+#------------------------------
+
+def _file_record(name, st) :
+    """Returns [size, mtime, begin, end] for file, begin=end=-1 for non-calibration files"""
+    begin, end = parse_calib_fname(name) or (-1, -1)
+    return [st.st_size, st.st_mtime, begin, end]
+
+#------------------------------
+
+class CalibTreeManifest(object) :
+    """Manifest of the calib directory tree
+    """
+
+    def __init__(self, calib_dir, path=None) :
+        """Constructor.
+        @param calib_dir - path to the top directory of the tree, for example /reg/d/psdm/CXI/cxitut13/calib
+        @param path - path to the manifest file, by default it is defined by path_to_manifest_default
+        """
+        self.calib_dir = os.path.normpath(os.path.abspath(calib_dir))
+        self.path = path_to_manifest_default(self.calib_dir) if path is None else path
+        self.dirs = {}        # relative path : directory record
+        self.t_refresh = 0    # time of the last complete refresh
+        self.is_changed = False
+        self._indexes = {}    # relative path : (mtime, CalibRunIndex)
+        self.load()
+
+#------------------------------
+
+    def relpath(self, path) :
+        """Returns path relative to the calib_dir, '' for calib_dir itself, or None if path is out of the tree"""
+        p = os.path.normpath(os.path.abspath(path))
+        if p == self.calib_dir : return ''
+        if not p.startswith(self.calib_dir + os.sep) : return None
+        return p[len(self.calib_dir)+1:]
+
+    def abspath(self, rel) :
+        return os.path.join(self.calib_dir, rel) if rel else self.calib_dir
+
+    def contains(self, path) :
+        return self.relpath(path) is not None
+
+#------------------------------
+
+    def load(self) :
+        """Loads manifest from file if it exists and is consistent with calib_dir"""
+        if not os.path.exists(self.path) : return False
+        try :
+            with open(self.path, 'r') as f : d = json.load(f)
+        except Exception as err :
+            logger.warning('Manifest %s is not loaded: %s' % (self.path, err), __name__)
+            return False
+        if d.get('version') != MANIFEST_VERSION or d.get('calib_dir') != self.calib_dir :
+            logger.warning('Manifest %s is inconsistent with %s - ignored' % (self.path, self.calib_dir), __name__)
+            return False
+        self.dirs = d.get('dirs', {})
+        logger.debug('Manifest for %s is loaded from %s, ndirs: %d' % (self.calib_dir, self.path, len(self.dirs)), __name__)
+        return True
+
+    def save(self, force=False) :
+        """Atomically saves compact manifest in file if it has been changed"""
+        if not (self.is_changed or force) : return False
+        d = {'version'  : MANIFEST_VERSION,
+             'calib_dir': self.calib_dir,
+             'time'     : time(),
+             'dirs'     : self.dirs}
+        dname = os.path.dirname(self.path)
+        try :
+            if not os.path.exists(dname) : os.makedirs(dname)
+            fd, tmp = tempfile.mkstemp(dir=dname, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f : json.dump(d, f, separators=(',',':'))
+            os.replace(tmp, self.path)
+        except Exception as err :
+            logger.warning('Manifest %s is not saved: %s' % (self.path, err), __name__)
+            return False
+        self.is_changed = False
+        logger.debug('Manifest for %s is saved in %s' % (self.calib_dir, self.path), __name__)
+        return True
+
+#------------------------------
+
+    def _scan_dir(self, path, mtime) :
+        """Lists directory and returns its record"""
+        subdirs, files = [], {}
+        for entry in os.scandir(path) :
+            try :
+                if entry.is_dir() : subdirs.append(entry.name)
+                else              : files[entry.name] = _file_record(entry.name, entry.stat())
+            except OSError : # file is removed in between
+                continue
+        rec = {'mtime':mtime, 'subdirs':sorted(subdirs), 'files':files, 'history':None}
+        if HISTORY_FNAME in files : rec['history'] = files[HISTORY_FNAME][0]
+        return rec
+
+    def _update_history(self, rel, rec) :
+        """HISTORY is appended in place, that does not change directory mtime - check it separately"""
+        if rec['history'] is None : return False
+        try : st = os.stat(os.path.join(self.abspath(rel), HISTORY_FNAME))
+        except OSError : return False
+        if st.st_size == rec['history'] : return False
+        rec['files'][HISTORY_FNAME] = _file_record(HISTORY_FNAME, st)
+        rec['history'] = st.st_size
+        return True
+
+    def refresh(self, path=None) :
+        """Re-scans directories of the (sub-)tree with changed mtime, returns the number of re-listed directories"""
+        rel_top = '' if path is None else self.relpath(path)
+        if rel_top is None :
+            logger.warning('Path %s is not in the tree %s' % (path, self.calib_dir), __name__)
+            return 0
+
+        prefix = rel_top + os.sep
+        old = dict((k,v) for k,v in self.dirs.items() if (not rel_top) or k == rel_top or k.startswith(prefix))
+        for k in old : del self.dirs[k]
+
+        nscan = 0
+        stack = [rel_top]
+        while stack :
+            rel = stack.pop()
+            try : mtime = os.stat(self.abspath(rel)).st_mtime
+            except OSError : continue
+            rec = old.get(rel)
+            if rec is None or rec['mtime'] != mtime :
+                try : rec = self._scan_dir(self.abspath(rel), mtime)
+                except OSError : continue
+                nscan += 1
+            elif self._update_history(rel, rec) :
+                self.is_changed = True
+            self.dirs[rel] = rec
+            stack.extend(os.path.join(rel, d) if rel else d for d in rec['subdirs'])
+
+        if nscan or len(old) != sum(1 for k in old if k in self.dirs) : self.is_changed = True
+        if not rel_top : self.t_refresh = time()
+        logger.debug('Manifest refresh for %s: re-listed %d of %d directories'%\
+                     (self.abspath(rel_top), nscan, len(self.dirs)), __name__)
+        return nscan
+
+#------------------------------
+
+    def _record(self, path) :
+        rel = self.relpath(path)
+        return None if rel is None else self.dirs.get(rel)
+
+    def isdir(self, path) :
+        return self._record(path) is not None
+
+    def isfile(self, path) :
+        rec = self._record(os.path.dirname(path))
+        return rec is not None and os.path.basename(path) in rec['files']
+
+    def exists(self, path) :
+        return self.isdir(path) or self.isfile(path)
+
+    def listdir(self, path) :
+        """Returns sorted list of sub-directories and files in directory or None if directory is not in manifest"""
+        rec = self._record(path)
+        if rec is None : return None
+        return sorted(rec['subdirs'] + list(rec['files'].keys()))
+
+    def files(self, path) :
+        """Returns dictionary {name:[size, mtime, begin, end]} of files in directory or None"""
+        rec = self._record(path)
+        return None if rec is None else rec['files']
+
+    def history_offset(self, path) :
+        """Returns size of the HISTORY file in directory or None"""
+        rec = self._record(path)
+        return None if rec is None else rec['history']
+
+    def list_of_sorted_calib_files(self, path) :
+        """Returns the list of CalibFile objects sorted as in CalibFileFinder"""
+        files = self.files(path)
+        if files is None : return []
+        items = [(name, r[2], r[3]) for name, r in files.items() if r[2] >= 0]
+        return CalibFileColumns.from_ranges(*zip(*items)).calib_files() if items else []
+
+    def run_index(self, path) :
+        """Returns CalibRunIndex for calib-type directory, index is cached until directory mtime is changed"""
+        rec = self._record(path)
+        if rec is None : return CalibRunIndex([], path=path)
+        rel = self.relpath(path)
+        mtime, index = self._indexes.get(rel, (None, None))
+        if index is None or mtime != rec['mtime'] :
+            index = CalibRunIndex(self.list_of_sorted_calib_files(path), path=self.abspath(rel))
+            self._indexes[rel] = (rec['mtime'], index)
+        return index
+
+    def total_size(self) :
+        return sum(r[0] for rec in self.dirs.values() for r in rec['files'].values())
+
+    def number_of_files(self) :
+        return sum(len(rec['files']) for rec in self.dirs.values())
+
+    def print_manifest(self) :
+        print('Manifest %s for %s' % (self.path, self.calib_dir))
+        for rel in sorted(self.dirs) :
+            rec = self.dirs[rel]
+            print('  %s  subdirs: %d  files: %d  history: %s' % (rel if rel else '.', len(rec['subdirs']), len(rec['files']), str(rec['history'])))
+        print('Number of dirs: %d  files: %d  total size: %d' % (len(self.dirs), self.number_of_files(), self.total_size()))
+
+#------------------------------
+# Process-wide registry of manifests
+#------------------------------
+
+_manifests = {} # calib_dir : CalibTreeManifest
+
+def get_manifest(calib_dir, refresh=True, max_age_sec=0) :
+    """Returns CalibTreeManifest for calib_dir from registry or loads it from file,
+       complete tree is refreshed and saved if the last refresh is older than max_age_sec
+    """
+    calib_dir = os.path.normpath(os.path.abspath(calib_dir))
+    m = _manifests.get(calib_dir)
+    if m is None :
+        m = _manifests[calib_dir] = CalibTreeManifest(calib_dir)
+    if refresh and time() - m.t_refresh > max_age_sec :
+        m.refresh()
+        m.save()
+    return m
+
+
+def calib_dir_for_path(path) :
+    """Returns registered tree containing path or the calib directory
+       for path like .../calib/<Type>::CalibV1/<src>/<ctype> or None
+    """
+    p = os.path.normpath(os.path.abspath(path))
+    for calib_dir in _manifests :
+        if p == calib_dir or p.startswith(calib_dir + os.sep) : return calib_dir
+    parts = p.split(os.sep)
+    for i, part in enumerate(parts) :
+        if i > 1 and '::' in part : return os.sep.join(parts[:i])
+    return None
+
+
+def manifest_for_path(path) :
+    """Returns manifest (without complete refresh) for tree containing path or None"""
+    calib_dir = calib_dir_for_path(path)
+    return None if calib_dir is None else get_manifest(calib_dir, refresh=False)
+
+
+def _refreshed_manifest_for_path(path) :
+    """Returns manifest for path only if its tree was refreshed in this process, othervise None"""
+    m = manifest_for_path(path)
+    return m if (m is not None and m.t_refresh > 0 and m.contains(path)) else None
+
+
+def listdir(path) :
+    """Returns sorted list of names in directory from refreshed manifest if available, othervise from os.listdir"""
+    m = _refreshed_manifest_for_path(path)
+    names = None if m is None else m.listdir(path)
+    return sorted(os.listdir(path)) if names is None else names
+
+
+def isdir(path) :
+    m = _refreshed_manifest_for_path(path)
+    return os.path.isdir(path) if m is None else m.isdir(path)
+
+
+def isfile(path) :
+    m = _refreshed_manifest_for_path(path)
+    return os.path.isfile(path) if m is None else m.isfile(path)
+
+
+def exists(path) :
+    m = _refreshed_manifest_for_path(path)
+    return os.path.exists(path) if m is None else m.exists(path)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    calib_dir = sys.argv[1] if len(sys.argv) > 1 else '/reg/d/psdm/CXI/cxitut13/calib'
+    if not os.path.exists(calib_dir) : sys.exit('Directory %s DOES NOT EXIST' % calib_dir)
+
+    from time import time as t
+    t0 = t(); m = get_manifest(calib_dir);     print('Load/refresh time %.3f sec' % (t()-t0))
+    t0 = t(); nscan = m.refresh();             print('Refresh time %.3f sec, re-listed %d dirs' % (t()-t0, nscan))
+    m.print_manifest()
+    sys.exit('End of test')
+
+#------------------------------
@@ -13,8 +13,11 @@ import os
 import sys
 import CalibManager.GlobalUtils as gu
 import CalibManager.FileDeployer as fdmets
+import CalibManager.EventKeyParser as ekp
 from CalibManager.FileNameManager import fnm
 from CalibManager.ConfigParametersForApp import cp
+from CalibManager.DarkProcState import DarkProcState
+from CalibManager.ScanResultCache import scan_result_cache, has_sources_of_detectors, is_type_pattern
 import Detector.UtilsCalib as uc
 
 def dsnamex_is_xtc_file(dsnamex):
@@ -74,9 +77,7 @@ def print_list_of_xtc_files(title='List of xtc files'):
     if dsnamex_is_xtc_file(dsnamex):
         logger.info('%s    ... xtc file is specified in --dsnamex' % (title))
     else:
-        pattern = '-r%s' % cp.str_run_number.value()
-        lst = fnm.get_list_of_xtc_files()
-        lst_for_run = [path for path in lst if pattern in os.path.basename(path)]
+        lst_for_run = fnm.get_list_of_xtc_files_for_run()
         logger.info(title + '\n'.join(lst_for_run))
 
 def txt_of_sources_in_run(self):
@@ -146,44 +147,18 @@ def scan_event_keys(pattern='EventKey(type=psana.'):
     return sset
 
 def parse_str_event_key(s, pattern='EventKey(type=psana.'):
-    """ parse (str) like: EventKey(type=psana.CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2')"""
-    pos1 = s.find(pattern) + len(pattern)
-    pos2 = s.rfind(')')
-    s1 = s[pos1:pos2]
-    fields = s1.split(',') # splits: CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2'
-    #print fields
-
-    type = fields[0]                            # CsPad2x2.ElementV1
-    if type.find('ConfigV') != -1: return None  # remove ConfigV from lists
-    #print 'type: ', type
-    tparts = type.split('.')
-    type_old = '%s::%s' % (tparts[0],tparts[1]) if len(tparts) == 2 else type # CsPad2x2.ElementV1 -> CsPad2x2::ElementV1
-
-    if len(fields)<2: return None
-    patt = 'src='
-    pos1 = fields[1].find(patt) + len(patt)
-    detinfo_src = fields[1][pos1:].strip('"\'') # DetInfo(CxiDg2.0:Cspad2x2.0)
-    #print 'detinfo_src: ', detinfo_src
-
-    pos1 = detinfo_src.find('(') + 1
-    pos2 = detinfo_src.rfind(')')
-    src  = detinfo_src[pos1:pos2] # if pos2 != -1 elsw detinfo_src[pos1:]  # CxiDg2.0:Cspad2x2.0
-    #print 'type:%s  src:%s' % (type, src)
-    return type_old, src
+    """ parse (str) like: EventKey(type=psana.CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2')
+        returns ('CsPad2x2::ElementV1', 'CxiDg2.0:Cspad2x2.0') or None
+    """
+    return ekp.parse_str_event_key(s, pattern)
 
 def make_list_of_types_and_sources(set_of_str_event_keys):
-    list_of_types = []
-    list_of_sources = []
-    for s in set_of_str_event_keys:
-        resp = parse_str_event_key(s)
-        if resp is None: continue
-        list_of_types.append(resp[0])
-        list_of_sources.append(resp[1])
-    return list_of_types, list_of_sources
+    return ekp.types_and_sources_in_strings(set_of_str_event_keys)
 
 def print_list_of_types_and_sources(list_of_types, list_of_sources, title='Data Types and Sources from xtc file scan:\n'):
     """replacement for cp.blsp.txt_list_of_types_and_sources()"""
-    logger.info(title + '\n'+ '\n'.join(['  %30s: %s'%(t, s) for t, s in zip(list_of_types, list_of_sources)]))
+    logger.info(title + '\n'+ '\n'.join(['  %30s: %s%s'%(t, s, ' (type pattern from RegDB)' if is_type_pattern(t) else '')\
+                                          for t, s in zip(list_of_types, list_of_sources)]))
 
 def str_command_for_peds_aver(str_sources):
     """Returns str command for dark run average, for example:
@@ -206,7 +181,7 @@ def str_command_for_peds_aver(str_sources):
     intnhi = cp.mask_intnhi.value()
     evcode = cp.bat_dark_sele.value()
     nrecs  = cp.nrecs
-    nrecs1 = cp.nrecs1
+    nrecs1 = cp.bat_dark_nrecs1.value()
     exp_name = cp.exp_name.value() #  needed in case of stand-alone xtc file...
 
     if srcs == '':
@@ -244,7 +219,78 @@ def str_command_for_peds_aver(str_sources):
 
     return command
 
-def command_for_peds_aver(str_sources):
+def fnames_peds_checkpoints(str_sources):
+    """Returns list of checkpoint file names like ./work/clb-xpptut15-r0054-peds-ckpt-XppGon.0:Cspad.0.npz"""
+    from CalibManager.PedestalEngine import fname_from_template
+    return [os.path.splitext(fname_from_template(fnm.path_peds_template(), cp.exp_name.value(), cp.str_run_number.value(), 'ckpt', src))[0] + '.npz'\
+            for src in str_sources.split(',')]
+
+def peds_aver_in_process(str_sources, state=None):
+    """Evaluates dark constants for all sources in one pass by the in-process PedestalEngine,
+       saves files with the same names as det_ndarr_raw_proc.
+       Accumulators are saved in checkpoints every cp.bat_dark_ckpt_events events,
+       averaging resumes from existing checkpoints. Events are selected by EVR codes cp.bat_dark_sele as -c of det_ndarr_raw_proc,
+       the range of cp.nrecs records is the same as events evskip <= i < events.
+    """
+    from CalibManager.PedestalEngine import accumulate_from_psana, remove_checkpoints
+    if str_sources == '':
+        logger.warning('Requested detector(s): "%s" is(are) are not found in data' % ' '.join(cp.list_of_dets_selected()))
+        return False
+    dsnamex = cp.dsnamex.value()
+    dsname = dsnamex if dsnamex_is_xtc_file(dsnamex) else cp.dsname.value()
+    evskip = cp.bat_dark_start.value() - 1
+    events = cp.bat_dark_end.value()
+    srcs = str_sources.split(',')
+    fnames_ckpt = fnames_peds_checkpoints(str_sources)
+    if state is not None: state.set_checkpoints(fnames_ckpt)
+    engines = accumulate_from_psana(dsname, srcs, events, evskip, cp.dict_of_peds_engine_pars(),\
+                                    fnames_ckpt=fnames_ckpt, nevts_ckpt=cp.bat_dark_ckpt_events.value(), evcodes=cp.bat_dark_sele.value())
+    for src, pe in zip(srcs, engines):
+        if not pe.nevt:
+            logger.warning('No data found for source %s in %s' % (src, dsname))
+            return False
+        pe.save(fnm.path_peds_template(), cp.exp_name.value(), cp.str_run_number.value(), src)
+    remove_checkpoints(fnames_ckpt)
+    if state is not None: state.set_checkpoints([])
+    logger.info('Avereging for run %s is completed' % cp.str_run_number.value())
+    return True
+
+def peds_aver_sharded(str_sources, state=None):
+    """Splits event range in cp.bat_dark_nshards shards processed by separate jobs of cp.bat_executor,
+       merges partial accumulators and saves files with the same names as det_ndarr_raw_proc.
+       Shards completed earlier are restored from state, shard jobs are killed if they are not done in cp.job_timeout_sec.
+    """
+    from CalibManager.ShardedPedestals import ShardedPedestals
+    from CalibManager.BatchExecutor import get_executor
+    if str_sources == '':
+        logger.warning('Requested detector(s): "%s" is(are) are not found in data' % ' '.join(cp.list_of_dets_selected()))
+        return False
+    dsnamex = cp.dsnamex.value()
+    dsname = dsnamex if dsnamex_is_xtc_file(dsnamex) else cp.dsname.value()
+    sp = ShardedPedestals(dsname, str_sources, cp.bat_dark_start.value() - 1, cp.bat_dark_end.value(), cp.bat_dark_nshards.value(),\
+                          fnm.path_peds_template(), cp.exp_name.value(), cp.str_run_number.value(), cp.dict_of_peds_engine_pars(),\
+                          nevts_ckpt=cp.bat_dark_ckpt_events.value(), evcodes=cp.bat_dark_sele.value())
+    on_poll = None
+    if state is not None:
+        if state.resumed: logger.info('Resume: %d of %d shards are done earlier' % (sp.restore(state.shards()), len(sp.shards)))
+        on_poll = lambda sp: state.set_shards(sp.shard_records())
+    executor = get_executor(cp.bat_executor.value(), cp.bat_local_ncores.value())
+    sp.submit(executor, cp.bat_queue.value(), fnm.logname_base())
+    if on_poll is not None: on_poll(sp)
+    status = sp.wait(executor, on_poll=on_poll, timeout_sec=cp.job_timeout_sec.value())
+    logger.info('Shards of run %s:\n%s' % (cp.str_run_number.value(), sp.summary()))
+    if status != 'DONE': return False
+    try:
+        sp.merge_and_save()
+    except (IOError, OSError, ValueError) as err:
+        logger.warning('Merging of shards for run %s failed: %s' % (cp.str_run_number.value(), err))
+        return False
+    logger.info('Avereging for run %s is completed' % cp.str_run_number.value())
+    return True
+
+def command_for_peds_aver(str_sources, state=None):
+    if cp.bat_dark_nshards.value() > 1: return peds_aver_sharded(str_sources, state)
+    if cp.bat_peds_engine.value() == 'numpy': return peds_aver_in_process(str_sources, state)
     command = str_command_for_peds_aver(str_sources)
     if command is None: return False
     logname = fnm.path_peds_aver_log() # log file name for averaging
@@ -258,6 +304,7 @@ def command_for_peds_aver(str_sources):
 
 def remove_subprocess_logs():
     for fname in (fnm.path_peds_aver_log(), fnm.path_peds_scan_log()):
+        if not os.path.exists(fname): continue
         logger.debug('remove subprocess log file %s' % fname)
         os.remove(fname)
     logger.info('See log file: %s' % cp.logname.value())
@@ -279,9 +326,13 @@ class CommandLineCalib():
         print_list_of_sources_from_regdb(self.sep)
 
         gu.create_directory(fnm.dir_results(), mode=self.dirmode)
+        self.state = DarkProcState(fnm.path_peds_state(), dict(cp.dict_of_dark_proc_key(), dsname=self.dsname), resume=self.resume)
 
         if self.process:
             self.proc_dark_run_interactively(self.sep)
+        elif self.deployonly:
+            logger.info(self.sep + 'Deploy files processed earlier in work directory %s' % self.workdir)
+            self.scan_sources()
         else:
             logger.critical(self.sep + '\nDARK PROCESSING OPTION IS TURNED OFF...'\
                             + '\nAdd option "-P" in the command line to process files\n')
@@ -297,6 +348,8 @@ class CommandLineCalib():
         cp.commandlinecalib = self
         self.count_msg = 0
         self.set_of_str_event_keys = None
+        self.list_of_types = None
+        self.list_of_sources = None
 
         if kwa['run'] is None: exit_for_missing_parameter('--run or -r')
         self.run = kwa['run']
@@ -340,6 +393,9 @@ class CommandLineCalib():
         self.workdir     = kwa['workdir']
         self.process     = kwa['process']
         self.deploy      = kwa['deploy']
+        self.deployonly  = kwa.get('deployonly', False)
+        self.dryrun      = kwa.get('dryrun', False)
+        self.resume      = not kwa.get('noresume', False)
         self.deploygeo   = kwa['deploygeo']
         self.zeropeds    = kwa['zeropeds']
         self.dirmode     = kwa['dirmode']
@@ -352,7 +408,10 @@ class CommandLineCalib():
         self.instr_name  = self.exp_name[:3]
 
         cp.nrecs         = kwa['num_events']
-        cp.nrecs1        = kwa['nrecs1']
+        cp.bat_dark_nrecs1.setValue(kwa['nrecs1'])
+        if kwa.get('nshards') is not None: cp.bat_dark_nshards.setValue(kwa['nshards'])
+        if kwa.get('executor') is not None: cp.bat_executor.setValue(kwa['executor'])
+        if kwa.get('queue') is not None: cp.bat_queue.setValue(kwa['queue'])
 
         cp.str_run_number.setValue(self.str_run_number)
         cp.exp_name      .setValue(self.exp_name)
@@ -409,6 +468,9 @@ class CommandLineCalib():
         + '\n     rmsnhi        : %f' % self.rmsnhi\
         + '\n     process       : %s' % self.process\
         + '\n     deploy        : %s' % self.deploy\
+        + '\n     deployonly    : %s' % self.deployonly\
+        + '\n     dryrun        : %s' % self.dryrun\
+        + '\n     resume        : %s' % self.resume\
         + '\n     deploygeo     : %s' % self.deploygeo\
         + '\n     zeropeds      : %s' % self.zeropeds\
         + '\n     dirmode       : %s' % oct(self.dirmode)\
@@ -418,23 +480,63 @@ class CommandLineCalib():
 
         logger.info(msg)
 
+    def scan_sources(self):
+        event_keys = self.state.scan_event_keys()
+        type_srcs = self.cached_type_sources() if event_keys is None else None
+        if type_srcs is not None:
+            logger.info('Scan is skipped, use sources from scan cache %s' % fnm.path_scan_cache())
+            self.list_of_types = [t for t, s in type_srcs]
+            self.list_of_sources = [s for t, s in type_srcs]
+        else:
+            if event_keys is not None:
+                logger.info('Resume: use scan results saved in %s' % self.state.fname)
+            else:
+                event_keys = scan_event_keys()
+                self.state.set_scan_event_keys(event_keys)
+            self.set_of_str_event_keys = set(event_keys)
+            self.list_of_types, self.list_of_sources = make_list_of_types_and_sources(self.set_of_str_event_keys)
+            self.scan_cache().put(self.exp_name, self.runnum, self.dsname, list(zip(self.list_of_types, self.list_of_sources)), origin='scan')
+        print_list_of_types_and_sources(self.list_of_types, self.list_of_sources)
+
+    def scan_cache(self):
+        return scan_result_cache(fnm.path_scan_cache())
+
+    def cached_type_sources(self):
+        """Returns list of (type, src) from scan cache pre-filled from RegDB if it has sources of selected detectors, or None"""
+        import CalibManager.RegDBUtils as ru
+        list_of_sources = None if dsnamex_is_xtc_file(self.dsnamex) else\
+                          (lambda : ru.list_of_sources_in_run(self.instr_name, self.exp_name, self.runnum))
+        type_srcs = self.scan_cache().get_or_prefill(self.exp_name, self.runnum, self.dsname, list_of_sources, cp.dict_of_det_data_types)
+        if type_srcs is None: return None
+        if self.scan_cache().origin(self.exp_name, self.runnum, self.dsname) == 'scan'\
+        or has_sources_of_detectors(type_srcs, cp.list_of_dets_selected()): return type_srcs
+        return None
+
     def proc_dark_run_interactively(self, sep='--'):
         #command_for_peds_scan()
-        self.set_of_str_event_keys = scan_event_keys()
-        self.list_of_types, self.list_of_sources = make_list_of_types_and_sources(self.set_of_str_event_keys)
-        print_list_of_types_and_sources(self.list_of_types, self.list_of_sources)
+        self.scan_sources()
         str_sources = self.str_of_sources()
         logger.debug('use string sources: %s' % str_sources)
         #sys.exit('TEST EXIT')
 
-        if not command_for_peds_aver(str_sources):
+        if self.state.is_done('averaged') and self.peds_files_exist(str_sources):
+            logger.info(sep + 'Resume: averaging for run %s is completed earlier, state file %s' % (self.str_run_number, self.state.fname))
+            return
+
+        if not command_for_peds_aver(str_sources, self.state):
             msg = sep + 'Subprocess for averaging is completed with warning/error message(s);'\
                   +'\nsee details in the logfile(s).'
             logger.critical(msg)
+        else:
+            self.state.set_stage('averaged')
         print_dark_ave_log(sep)
 
+    def peds_files_exist(self, str_sources):
+        lst = gu.get_list_of_files_for_list_of_insets(fnm.path_peds_ave(), [s for s in str_sources.split(',') if s])
+        return lst != [] and all(os.path.exists(fname) for fname in lst)
+
     def get_list_of_type_sources(self):
-        if self.set_of_str_event_keys is None: self.proc_dark_run_interactively()
+        if self.list_of_sources is None: self.proc_dark_run_interactively()
         return list(zip(self.list_of_types, self.list_of_sources))
 
     def list_of_types_and_sources_for_detector(self, det_name):
@@ -522,11 +624,15 @@ class CommandLineCalib():
 
             s = fdmets.deploy_calib_files(self.str_run_number, self.str_run_range, mode='calibrun-dark', ask_confirm=False,\
                                           zeropeds=self.zeropeds, deploygeo=self.deploygeo,\
-                                          dirmode=self.dirmode, filemode=self.filemode, group=self.group, mets_from=self)
+                                          dirmode=self.dirmode, filemode=self.filemode, group=self.group, mets_from=self,\
+                                          dryrun=self.dryrun)
             if s:
                 logger.warning('Problem with deployment of calibration files...')
+            elif self.dryrun:
+                logger.info('Dry run of deployment is completed, see the deployment plan')
             else:
                 logger.info('Deployment of calibration files is completed')
+                if self.state.is_done('averaged'): self.state.set_stage('deployed')
         else:
             logger.critical(self.sep + 'FILE DEPLOYMENT OPTION IS TURNED OFF...'\
                      +'\nAdd option "-D" in the command line to deploy files\n')
@@ -535,7 +641,8 @@ class CommandLineCalib():
         """ Using shape of array for evaluated pedestals, add in the work directory additional files for Rayonix
             with zero peds and geometry
         """
-        from PSCalib.NDArrIO import load_txt, save_txt #, list_of_comments
+        from PSCalib.NDArrIO import save_txt #, list_of_comments
+        from .NDArrTextLoader import load_txt
         from . import AppDataPath as apputils
         fname_geo  = str(apputils.AppDataPath('CalibManager/scripts/geometry-rayonix.template').path())
         logger.info('\n%s\nfname_geo: %s' % (100*'_', fname_geo))
@@ -49,9 +49,7 @@ class ConfigFileGenerator(object) :
         './myxtc/xpp/xppi0613/xtc/e319-r0173-s00-c00.xtc ./myxtc/xpp/xppi0613/xtc/e319-r0173-s01-c00.xtc'
         """
         xtcdir = fnm.path_to_xtc_dir() # './myxtc/xpp/xppi0613/xtc/'
-        pattern = '-r%s' % cp.str_run_number.value()
-        lst = fnm.get_list_of_xtc_files()
-        lst_for_run = [os.path.join(xtcdir, path) for path in lst if pattern in os.path.basename(path)]
+        lst_for_run = [os.path.join(xtcdir, fname) for fname in fnm.get_list_of_xtc_files_for_run()]
         return ' '.join(lst_for_run)
 
 #-----------------------------
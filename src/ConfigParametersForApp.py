@@ -178,6 +178,7 @@ class ConfigParametersForApp(ConfigParameters):
 
         # FileDeployer.py
         self.fname_history      = self.declareParameter( name='HISTORY_FILE_NAME', val_def='HISTORY',      type='str' )
+        self.deploy_dedup       = self.declareParameter( name='DEPLOY_DEDUP',      val_def=True,           type='bool' ) # skip or extend identical files
 
         # GUIMainTabs.py
         self.current_tab    = self.declareParameter( name='CURRENT_TAB'      , val_def='Status',        type='str' )
@@ -248,6 +249,17 @@ class ConfigParametersForApp(ConfigParameters):
         # For batch jobs
         self.bat_queue               = self.declareParameter( name='BATCH_QUEUE',                val_def=self.list_of_queues[0], type='str' )
         self.bat_submit_interval_sec = self.declareParameter( name='BATCH_SUBMIT_INTERVAL_SEC',  val_def=30,      type='int' )
+        self.bat_cmd_submit          = self.declareParameter( name='BATCH_CMD_SUBMIT',           val_def='bsub',  type='str' )
+        self.bat_cmd_status          = self.declareParameter( name='BATCH_CMD_STATUS',           val_def='bjobs', type='str' )
+        self.bat_cmd_kill            = self.declareParameter( name='BATCH_CMD_KILL',             val_def='bkill', type='str' )
+        self.bat_status_ttl_sec      = self.declareParameter( name='BATCH_STATUS_TTL_SEC',       val_def=2,       type='float' )
+        self.bat_executor            = self.declareParameter( name='BATCH_EXECUTOR',             val_def='lsf',   type='str' ) # 'lsf', 'local', 'inproc'
+        self.bat_local_ncores        = self.declareParameter( name='BATCH_LOCAL_NCORES',         val_def=0,       type='int' ) # 0 - all cores
+        self.bat_peds_engine         = self.declareParameter( name='BATCH_PEDS_ENGINE',          val_def='det_ndarr_raw_proc', type='str' ) # or 'numpy'
+        self.bat_dark_nshards        = self.declareParameter( name='BATCH_DARK_NSHARDS',         val_def=1,       type='int' ) # >1 - sharded averaging
+        self.bat_dark_ckpt_events    = self.declareParameter( name='BATCH_DARK_CKPT_EVENTS',     val_def=500,     type='int' ) # 0 - no accumulator checkpoints
+        self.bat_dark_nrecs1         = self.declareParameter( name='BATCH_DARK_NRECS1',          val_def=50,      type='int' ) # events of stage 1 gate, 0 - single-stage gate
+        self.bat_dark_resume         = self.declareParameter( name='BATCH_DARK_RESUME',          val_def=True,    type='bool') # resume from state file
 
         # GUIMaskEditor.py
         cdir = '/reg/g/psdm/detector/alignment/cspad/calib-cxi-ds1-2014-03-19/calib/'
@@ -940,6 +952,20 @@ class ConfigParametersForApp(ConfigParameters):
     def list_of_dets_selected(self):
         return [det for det,state in zip(self.list_of_dets,self.det_cbx_states_list) if state.value()]
 
+    def dict_of_peds_engine_pars(self):
+        """Returns dict of PedestalEngine parameters from mask thresholds"""
+        return dict(int_lo=self.mask_min_thr.value(),     int_hi=self.mask_max_thr.value(),\
+                    rms_lo=self.mask_rms_thr_min.value(), rms_hi=self.mask_rms_thr_max.value(),\
+                    intnlo=self.mask_intnlo.value(),      intnhi=self.mask_intnhi.value(),\
+                    rmsnlo=self.mask_rmsnlo.value(),      rmsnhi=self.mask_rmsnhi.value(),\
+                    nrecs1=self.bat_dark_nrecs1.value())
+
+    def dict_of_dark_proc_key(self):
+        """Returns dict of parameters which define results of dark processing, state file is valid for the same key"""
+        return dict(exp=self.exp_name.value(), run=self.str_run_number.value(), dets=self.list_of_dets_selected(),\
+                    evskip=self.bat_dark_start.value()-1, events=self.bat_dark_end.value(), evcode=self.bat_dark_sele.value(),\
+                    engine=self.bat_peds_engine.value(), nshards=self.bat_dark_nshards.value(), pars=self.dict_of_peds_engine_pars())
+
     def print_dict_of_det_data_types(self):
         s = 'List of detector names and associated types:'
         for det, type in self.dict_of_det_data_types.items():
@@ -0,0 +1,180 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module DarkProcState
+#
+#------------------------------------------------------------------------
+
+"""DarkProcState - per-run state file for checkpoint/resume of dark run processing
+
+State of dark processing for run is kept in json file (FileNameManager.path_peds_state(),
+e.g. ./work/clb-xpptut15-r0054-peds-state.json) and is re-written atomically at each transition:
+  - stage: 'init' -> 'scanned' -> 'submitted' -> 'averaged' -> 'deployed'
+  - scan results (list of str EventKey-s found in scan),
+  - batch job id-s and executor name,
+  - shard records (index, event range, status, attempts, job id) of sharded averaging,
+  - file names of accumulator checkpoints saved every cp.bat_dark_ckpt_events events.
+State is valid only for the same key - dict of parameters which define results of processing
+(exp, run, dataset, detectors, event range, gate and thresholds, ...),
+for different key processing starts from scratch.
+
+Usage ::
+
+    from CalibManager.DarkProcState import DarkProcState
+
+    st = DarkProcState('./work/clb-xpptut15-r0054-peds-state.json', key=cp.dict_of_dark_proc_key())
+    if st.is_done('scanned') : keys = st.scan_event_keys()
+    else : st.set_scan_event_keys(keys)   # sets stage 'scanned'
+    st.set_job('aver', job_id, 'lsf')     # sets stage 'submitted'
+    st.set_stage('averaged')
+    st.reset()                            # removes state file
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import json
+from time import time, strftime, localtime
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+list_of_stages = ('init', 'scanned', 'submitted', 'averaged', 'deployed')
+
+#------------------------------
+
+class DarkProcState(object) :
+    """Loads, updates and atomically saves per-run state of dark processing"""
+
+    def __init__(self, fname, key, resume=True) :
+        """Constructor.
+        @param fname - state file name
+        @param key - dict of parameters, state file with different key is ignored
+        @param resume - False - ignore existing state file and start from scratch
+        """
+        self.fname = fname
+        self.key   = json.loads(json.dumps(key)) # tuples -> lists etc. to compare with loaded key
+        self.d     = None
+        if resume : self.load()
+        if self.d is None : self.d = self._empty()
+        self.resumed = self.d['stage'] != 'init'
+
+    def _empty(self) :
+        return {'key'         : self.key,
+                'stage'       : 'init',
+                'scan'        : None,
+                'jobs'        : {},
+                'shards'      : [],
+                'checkpoints' : []}
+
+    def load(self) :
+        """Loads state file if it exists and has the same key"""
+        if not os.path.exists(self.fname) : return
+        try :
+            with open(self.fname, 'r') as f : d = json.load(f)
+        except (IOError, ValueError) as err :
+            logger.warning('state file %s is ignored: %s' % (self.fname, err), __name__)
+            return
+        if d.get('key') != self.key :
+            logger.info('state file %s is for different parameters - processing starts from scratch' % self.fname, __name__)
+            return
+        self.d = d
+        logger.info('resume dark processing from state file %s stage: %s saved at %s'%\
+                    (self.fname, d['stage'], d.get('time', 'N/A')), __name__)
+
+    def save(self) :
+        """Writes state in temporary file and renames it, state file is either old or new, never partial"""
+        self.d['time'] = strftime('%Y-%m-%d %H:%M:%S', localtime(time()))
+        tmp = '%s.%d.tmp' % (self.fname, os.getpid())
+        with open(tmp, 'w') as f : json.dump(self.d, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.fname)
+
+    def reset(self) :
+        """Removes state file, starts from scratch"""
+        if os.path.exists(self.fname) : os.remove(self.fname)
+        self.d = self._empty()
+        self.resumed = False
+
+#------------------------------
+
+    def stage(self) :
+        return self.d['stage']
+
+    def set_stage(self, stage) :
+        if stage not in list_of_stages : raise ValueError('unknown stage %s, allowed: %s' % (stage, str(list_of_stages)))
+        self.d['stage'] = stage
+        self.save()
+        logger.debug('stage %s is saved in %s' % (stage, self.fname), __name__)
+
+    def is_done(self, stage) :
+        """Returns True if the stage is reached"""
+        return list_of_stages.index(self.d['stage']) >= list_of_stages.index(stage)
+
+    def set_scan_event_keys(self, event_keys) :
+        """Saves scan results, stage is set to 'scanned' if it was not reached"""
+        self.d['scan'] = sorted(event_keys)
+        self.set_stage(self.d['stage'] if self.is_done('scanned') else 'scanned')
+
+    def scan_event_keys(self) :
+        """Returns list of str EventKey-s saved at scan or None"""
+        return self.d['scan']
+
+    def set_job(self, name, job_id, executor) :
+        self.d['jobs'][name] = {'id' : job_id, 'executor' : executor, 'time' : time()}
+        self.set_stage('submitted')
+
+    def job(self, name) :
+        """Returns dict {'id':..., 'executor':..., 'time':...} for job name or None"""
+        return self.d['jobs'].get(name)
+
+    def set_shards(self, records) :
+        """Saves list of shard records if they are changed"""
+        if records == self.d['shards'] : return
+        self.d['shards'] = records
+        self.save()
+
+    def shards(self) :
+        return self.d['shards']
+
+    def set_checkpoints(self, fnames) :
+        self.d['checkpoints'] = list(fnames)
+        self.save()
+
+    def checkpoints(self) :
+        return self.d['checkpoints']
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    fname = os.path.join(tempfile.mkdtemp(), 'clb-xpptut15-r0054-peds-state.json')
+    key = dict(exp='xpptut15', run='0054', dets=('CSPAD',), evskip=0, events=1000)
+
+    st = DarkProcState(fname, key)
+    print('resumed: %s stage: %s' % (st.resumed, st.stage()))
+    st.set_scan_event_keys(["EventKey(type=psana.CsPad.DataV2, src='DetInfo(XppGon.0:Cspad.0)')"])
+    st.set_job('aver', '123456', 'lsf')
+    st.set_shards([{'index':0, 'status':'DONE'}, {'index':1, 'status':'RUN'}])
+
+    st = DarkProcState(fname, key)
+    print('resumed: %s stage: %s scanned: %s averaged: %s job: %s' % (st.resumed, st.stage(), st.is_done('scanned'), st.is_done('averaged'), st.job('aver')))
+    print('scan: %s shards: %s' % (st.scan_event_keys(), st.shards()))
+
+    st = DarkProcState(fname, dict(key, events=2000))
+    print('different key - resumed: %s stage: %s' % (st.resumed, st.stage()))
+    print(open(fname).read())
+    sys.exit('End of test')
+
+#------------------------------
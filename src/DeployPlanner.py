@@ -0,0 +1,281 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module DeployPlanner
+#
+#------------------------------------------------------------------------
+
+"""DeployPlanner - dry-run plan of deployment with conflict and shadowing analysis
+
+For list of deployment commands 'cp path_inp <calib>/<dtype>/<src>/<ctype>/<begin>-<end>.data'
+the run validity map of each target calib-type directory is evaluated before and after deployment
+with the sweep of CalibFileFinder.resolve_actual_run_ranges. Plan contains for each directory:
+  - new files with size, and existing files which are replaced (overwritten),
+  - validity segments before and after deployment,
+  - changes - run ranges which switch constants, with file names before and after,
+  - shadowed files - existing files which are in use for fewer runs after deployment (or become unused),
+  - counts of runs which switch constants or get constants for the first time, and byte volume.
+Directory content is taken from the calib tree manifest if available (no stat of files), othervise from os.scandir,
+nothing is changed on disk.
+
+Usage ::
+
+    from CalibManager.DeployPlanner import deploy_plan, txt_plan, txt_plan_summary, txt_plan_of_source
+
+    plan = deploy_plan(['cp ./work/clb-xpptut15-r0054-peds-ave-XppGon.0:Cspad.0.txt'\\
+                        ' /reg/d/psdm/XPP/xpptut15/calib/CsPad::CalibV1/XppGon.0:Cspad.0/pedestals/54-end.data'])
+    print(plan['nruns_changed'], plan['bytes_new'], plan['dirs'][0]['shadowed'])
+    print(txt_plan(plan))
+    print(txt_plan_summary(plan))
+    print(txt_plan_of_source(plan, 'XppGon.0:Cspad.0')) # for confirmation of deployment per source
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+from bisect import bisect_right
+from time import time
+
+from CalibManager.CalibFileFinder import CalibFileFinder, CalibFileColumns, parse_calib_fname,\
+                                         _resolve_validity_segments # sweep of resolve_actual_run_ranges
+import CalibManager.CalibTreeManifest as ctm
+
+#------------------------------
+
+def files_in_directory(d) :
+    """Returns dict {name:size} of calibration files in directory from refreshed calib tree manifest if possible,
+       othervise from os.scandir with size None (not evaluated)
+    """
+    if not os.path.isdir(d) : return {}
+    m = ctm.manifest_for_path(d)
+    if m is not None :
+        m.refresh(d)
+        files = m.files(d)
+        if files is not None : return dict((name, r[0]) for name, r in files.items() if r[2] >= 0)
+    with os.scandir(d) as it :
+        return dict((entry.name, None) for entry in it if entry.name.endswith('.data'))
+
+def file_size(d, name, sizes) :
+    size = sizes.get(name)
+    if size is None :
+        try :
+            size = os.path.getsize(os.path.join(d, name))
+        except OSError :
+            size = 0
+    return size
+
+def _segments(names, ranges, max_run) :
+    """Returns list of (begin, end, name) validity segments for list of calibration file names with ranges {name:(begin, end)},
+       as 'segments' of resolve_actual_run_ranges, resolved on columns without CalibFile objects.
+    """
+    if not names : return []
+    cols = CalibFileColumns.from_ranges(names, [ranges[n][0] for n in names], [ranges[n][1] for n in names])
+    sorted_names = cols.sorted_names()
+    segs = []
+    for b, e, i in zip(*_resolve_validity_segments(cols.begin.tolist(), cols.end.tolist())) :
+        if b > max_run : break
+        segs.append((b, min(e, max_run), sorted_names[i]))
+    return segs
+
+def _clip(segs, run_min, run_max) :
+    """Returns segments clipped to [run_min, run_max]"""
+    return [(max(b, run_min), min(e, run_max), name) for b, e, name in segs if e >= run_min and b <= run_max]
+
+def _concatenate(*lists_of_segs) :
+    """Returns concatenated sorted lists of segments, adjacent segments of the same file are merged"""
+    segs = []
+    for b, e, name in (s for lst in lists_of_segs for s in lst) :
+        if segs and segs[-1][2] == name and segs[-1][1] == b-1 : segs[-1] = (segs[-1][0], e, name)
+        else : segs.append((b, e, name))
+    return segs
+
+def _name_for_run(segs, starts, run) :
+    i = bisect_right(starts, run) - 1
+    return segs[i][2] if i >= 0 and run <= segs[i][1] else None
+
+def diff_segments(before, after, names_replaced=(), run_min=0, run_max=None) :
+    """Returns list of (begin, end, name_before, name_after) for run ranges in [run_min, run_max] where file in use is changed,
+       file in names_replaced is considered as changed even if its name is the same.
+    """
+    if run_max is not None :
+        before, after = _clip(before, run_min, run_max), _clip(after, run_min, run_max)
+    starts_b, starts_a = [s[0] for s in before], [s[0] for s in after]
+    bounds = sorted(set([s[0] for s in before + after] + [s[1]+1 for s in before + after]))
+    changes = []
+    for b, bnext in zip(bounds[:-1], bounds[1:]) :
+        nb, na = _name_for_run(before, starts_b, b), _name_for_run(after, starts_a, b)
+        if nb == na and na not in names_replaced : continue
+        if nb is None and na is None : continue
+        if changes and changes[-1][1] == b-1 and changes[-1][2:] == (nb, na) : changes[-1] = (changes[-1][0], bnext-1, nb, na)
+        else : changes.append((b, bnext-1, nb, na))
+    return changes
+
+def _ranges_of_file(segs, names) :
+    """Returns dict {name:[(begin, end),...]} of run ranges where files of names are in use"""
+    d = dict((name, []) for name in names)
+    for b, e, name in segs :
+        if name in d : d[name].append((b, e))
+    return d
+
+def nruns(ranges) :
+    return sum(e - b + 1 for b, e in ranges)
+
+#------------------------------
+
+def plan_for_directory(d, new_files, max_run=None) :
+    """Returns plan dict for calib-type directory d and list of new files [(name, path_inp), ...]"""
+    if max_run is None : max_run = CalibFileFinder.max_run_number
+    sizes = files_in_directory(d)
+    ranges = dict((name, parse_calib_fname(name)) for name in sizes)
+    existing = dict((name, size) for name, size in sizes.items() if ranges[name] is not None)
+    names_new = [name for name, path_inp in new_files if parse_calib_fname(name) is not None]
+    names_replaced = [name for name in names_new if name in existing]
+    before = _segments(list(existing.keys()), ranges, max_run)
+    ranges_new = [parse_calib_fname(name) for name in names_new]
+    ranges.update(zip(names_new, ranges_new))
+    if ranges_new :
+        # files affect only runs in their ranges, map after deployment is re-resolved in the window of new files
+        run_min, run_max = min(b for b, e in ranges_new), min(max(e for b, e in ranges_new), max_run)
+        names_window = [n for n in existing if n not in names_new and ranges[n][1] >= run_min and ranges[n][0] <= run_max]
+        after = _concatenate(_clip(before, 0, run_min-1),\
+                             _clip(_segments(names_window + names_new, ranges, max_run), run_min, run_max),\
+                             _clip(before, run_max+1, max_run))
+        changes = diff_segments(before, after, names_replaced, run_min, run_max)
+    else :
+        after, changes = before, []
+
+    names_changed = sorted(set(nb for b, e, nb, na in changes if nb is not None and nb not in names_new))
+    used_before, used_after = _ranges_of_file(before, names_changed), _ranges_of_file(after, names_changed + names_new)
+    shadowed = [{'name' : name, 'before' : used_before[name], 'after' : used_after[name]} for name in names_changed]
+
+    parts = os.path.normpath(d).rsplit(os.sep, 3)
+    dtype, src, ctype = parts[-3:] if len(parts) == 4 else (None, None, os.path.basename(d))
+    bytes_new = 0
+    list_of_new = []
+    for name, path_inp in new_files :
+        size = os.path.getsize(path_inp) if path_inp is not None and os.path.exists(path_inp) else 0
+        bytes_new += size
+        list_of_new.append({'name' : name, 'path_inp' : path_inp, 'bytes' : size,\
+                            'replaces' : name in existing, 'bytes_replaced' : file_size(d, name, existing) if name in existing else 0,\
+                            'runs' : used_after.get(name, [])})
+    return {'dir'            : d,
+            'dtype'          : dtype,
+            'src'            : src,
+            'ctype'          : ctype,
+            'new'            : list_of_new,
+            'before'         : before,
+            'after'          : after,
+            'changes'        : changes,
+            'shadowed'       : shadowed,
+            'nruns_changed'  : nruns([(b, e) for b, e, nb, na in changes if nb is not None]),
+            'nruns_new'      : nruns([(b, e) for b, e, nb, na in changes if nb is None]),
+            'bytes_new'      : bytes_new,
+            'bytes_replaced' : sum(f['bytes_replaced'] for f in list_of_new)}
+
+def deploy_plan(list_of_cmds, max_run=None) :
+    """Returns plan dict {'dirs':[plan_for_directory,...], 'nruns_changed', 'nruns_new', 'bytes_new', 'bytes_replaced', 'time_sec'}
+       for list of commands like 'cp path_inp path_out' (or 'mv'), commands are not executed.
+    """
+    t0 = time()
+    dict_of_dirs = {}
+    for cmd in list_of_cmds :
+        action, path_inp, path_out = cmd.split()
+        d, name = os.path.split(os.path.abspath(path_out))
+        dict_of_dirs.setdefault(d, []).append((name, path_inp))
+    dirs = [plan_for_directory(d, new_files, max_run) for d, new_files in sorted(dict_of_dirs.items())]
+    return {'dirs'           : dirs,
+            'nruns_changed'  : sum(p['nruns_changed']  for p in dirs),
+            'nruns_new'      : sum(p['nruns_new']      for p in dirs),
+            'bytes_new'      : sum(p['bytes_new']      for p in dirs),
+            'bytes_replaced' : sum(p['bytes_replaced'] for p in dirs),
+            'time_sec'       : time() - t0}
+
+#------------------------------
+
+def _txt_ranges(ranges) :
+    return ', '.join('%04d-%04d' % (b, e) for b, e in ranges) if ranges else 'none'
+
+def _txt_segments(segs) :
+    return ' | '.join('%04d-%04d %s' % (b, e, name) for b, e, name in segs) if segs else 'no files'
+
+def txt_plan_summary(plan) :
+    """Returns one-line summary of plan"""
+    nnew = sum(len(p['new']) for p in plan['dirs'])
+    nrep = sum(1 for p in plan['dirs'] for f in p['new'] if f['replaces'])
+    nshd = sum(len(p['shadowed']) for p in plan['dirs'])
+    return 'Deployment plan: %d file(s) %d bytes in %d directories, %d replaced file(s) %d bytes, %d shadowed file(s),'\
+           ' runs switching constants: %d, runs getting constants: %d' %\
+           (nnew, plan['bytes_new'], len(plan['dirs']), nrep, plan['bytes_replaced'], nshd, plan['nruns_changed'], plan['nruns_new'])
+
+def txt_plan_of_source(plan, src) :
+    """Returns short text of plan for directories of source src: action and validity run ranges of each new file,
+       e.g. '  pedestals/54-end.data REPLACES existing, in use for runs: 0054-0059'
+    """
+    lines = []
+    for p in plan['dirs'] :
+        if p['src'] != src : continue
+        for f in p['new'] :
+            lines.append('  %s/%s %s, in use for runs: %s' % (p['ctype'], f['name'], 'REPLACES existing' if f['replaces'] else 'new',\
+                         _txt_ranges(f['runs'])))
+        if p['shadowed'] : lines.append('  %s: %d shadowed file(s)' % (p['ctype'], len(p['shadowed'])))
+    return '\n'.join(lines) if lines else '  no files'
+
+def txt_plan(plan) :
+    """Returns text of plan"""
+    lines = [txt_plan_summary(plan) + ' (planned in %.1f ms)' % (plan['time_sec']*1000)]
+    for p in plan['dirs'] :
+        lines.append('%s' % p['dir'])
+        for f in p['new'] :
+            lines.append('  new %s  %d bytes%s, in use for runs: %s' % (f['name'], f['bytes'],\
+                         ' REPLACES existing file of %d bytes' % f['bytes_replaced'] if f['replaces'] else '', _txt_ranges(f['runs'])))
+        if p['changes'] :
+            run_min, run_max = p['changes'][0][0], p['changes'][-1][1]
+            lines.append('  before (runs %04d-%04d): %s' % (run_min, run_max, _txt_segments(_clip(p['before'], run_min, run_max))))
+            lines.append('  after  (runs %04d-%04d): %s' % (run_min, run_max, _txt_segments(_clip(p['after'],  run_min, run_max))))
+        else :
+            lines.append('  validity of files is not changed')
+        for b, e, nb, na in p['changes'] :
+            lines.append('  runs %04d-%04d (%d runs): %s -> %s' % (b, e, e-b+1, nb if nb is not None else 'NO CONSTANTS', na))
+        for s in p['shadowed'] :
+            lines.append('  shadowed: %s in use for %s -> %s' % (s['name'], _txt_ranges(s['before']), _txt_ranges(s['after'])))
+    return '\n'.join(lines)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+
+    d = tempfile.mkdtemp()
+    dir_peds = os.path.join(d, 'calib', 'CsPad::CalibV1', 'XppGon.0:Cspad.0', 'pedestals')
+    dir_rms  = os.path.join(d, 'calib', 'CsPad::CalibV1', 'XppGon.0:Cspad.0', 'pixel_rms')
+    os.makedirs(dir_peds)
+    for name in ('10-end.data', '30-49.data', '60-end.data') :
+        with open(os.path.join(dir_peds, name), 'w') as f : f.write('peds %s\n' % name)
+    inp = os.path.join(d, 'peds.txt')
+    with open(inp, 'w') as f : f.write('new peds\n')
+
+    cmds = ['cp %s %s' % (inp, os.path.join(dir_peds, '40-end.data')),
+            'cp %s %s' % (inp, os.path.join(dir_rms, '40-end.data'))]
+    plan = deploy_plan(cmds)
+    print(txt_plan(plan))
+    print('plan of source:\n%s' % txt_plan_of_source(plan, 'XppGon.0:Cspad.0'))
+    print(txt_plan(deploy_plan(['cp %s %s' % (inp, os.path.join(dir_peds, '60-end.data'))])))
+
+    for i in range(5000) : open(os.path.join(dir_peds, '%d-%d.data' % (100+i, 100+i+3)), 'w').close()
+    for cmds in (['cp %s %s' % (inp, os.path.join(dir_peds, '40-end.data'))], ['cp %s %s' % (inp, os.path.join(dir_peds, '40-59.data'))]) :
+        plan = deploy_plan(cmds)
+        print('directory with %d files: planned in %.1f ms, %s' % (5003, plan['time_sec']*1000, txt_plan_summary(plan)))
+    sys.exit('End of test')
+
+#------------------------------
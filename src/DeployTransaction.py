@@ -0,0 +1,389 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module DeployTransaction
+#
+#------------------------------------------------------------------------
+
+"""DeployTransaction - all-or-nothing deployment of a batch of calibration files
+
+Deployment commands 'cp path_inp path_out' and 'mv path_inp path_out' of one deployment
+are executed in phases:
+  - lock    - exclusive flock on the lock file of each target (ctype) directory, in sorted order,
+              deployments of other operators/processes to the same directories wait up to lock_timeout_sec,
+              GUI uses short LOCK_TIMEOUT_SEC_GUI and reports deployment in progress (status 'locked');
+              lock file is opened read-only and created with group-writable filemode, so it can be locked
+              by operators other than its owner,
+  - dedup   - (optional) content of file is compared by hash with files in target directory,
+              file is not written if identical file is already in use for its run range (skip),
+              or identical file ending just before its run range is renamed to cover it (extend),
+              see CalibFileDedup.dedup_plan,
+  - stage   - files are copied in thread pool to fsync-ed temporary files in target directories,
+  - commit  - existing targets are preserved as hard-linked backups and temporary files are renamed
+              to targets; any failure in stage or commit rolls back all files to their previous state,
+  - history - one block of records is appended to HISTORY file of each directory by a single write,
+              file renamed by dedup extend gets explicit rename record (see rename_record),
+  - cleanup - backups and sources of 'mv' commands are removed, locks are released.
+Method run() returns manifest - dict with status, per-file records and time of each phase.
+
+Usage ::
+
+    from CalibManager.DeployTransaction import DeployTransaction
+
+    tr = DeployTransaction(list_of_cmds, filemode=0o664, group='ps-users', dedup=True,
+                           fname_history='HISTORY', history_record=lambda cmd : 'file:... copy_of:...\\n')
+    manifest = tr.run()
+    print(manifest['status'])    # 'committed', 'rolled_back', 'failed' or 'locked' (nothing is changed)
+    print(manifest['phases'])    # {'lock': 0.0001, 'dedup': 0.002, 'stage': 0.012, 'commit': 0.001, 'history': 0.0003, 'cleanup': 0.0002}
+    print(manifest['saved_bytes'])
+    print(tr.summary())
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import shutil
+import fcntl
+from time import time, sleep, strftime
+from concurrent.futures import ThreadPoolExecutor
+
+from CalibManager.Logger import logger
+import CalibManager.AtomicFileCopy as afc
+import CalibManager.CalibFileDedup as cfd
+
+#------------------------------
+
+FNAME_LOCK = '.deploy.lock'
+LOCK_TIMEOUT_SEC     = 600 # wait for deployment of other process in batch and command line
+LOCK_TIMEOUT_SEC_GUI = 2   # short wait, GUI thread is not blocked
+
+class DeployLocked(IOError) :
+    """Target directory is locked by other deployment in progress"""
+    pass
+
+#------------------------------
+
+def rename_record(path_old, path_new, reason='dedup-extend') :
+    """Returns HISTORY record for file renamed in target directory"""
+    return 'file:%s  renamed_from:%s  reason:%s  time:%s\n' %\
+           (os.path.basename(path_new).ljust(14), os.path.basename(path_old), reason, strftime('%Y-%m-%dT%H:%M:%S  zone:%Z'))
+
+#------------------------------
+
+class DeployTransaction(object) :
+    """Executes list of cp/mv deployment commands as a single transaction"""
+
+    def __init__(self, list_of_cmds, filemode=0o664, group='ps-users', fname_history='HISTORY',\
+                 history_record=None, nthreads=8, lock_timeout_sec=LOCK_TIMEOUT_SEC, dedup=False) :
+        """Constructor.
+        @param list_of_cmds - list of commands like 'cp path_inp path_out'
+        @param fname_history - name of history file in target directories, '' or None - history is not updated
+        @param history_record - callable returning history record str for command, None - history is not updated
+        @param nthreads - number of threads for staging of files
+        @param lock_timeout_sec - transaction gets status 'locked' if directory locks are not acquired in this time
+        @param dedup - True - files with identical content already deployed for the run range are not written
+        """
+        self.list_of_cmds = list(list_of_cmds)
+        self.filemode = filemode
+        self.group = group
+        self.fname_history = fname_history
+        self.history_record = history_record
+        self.nthreads = nthreads
+        self.lock_timeout_sec = lock_timeout_sec
+        self.do_dedup = dedup
+        self.locks = []
+        self.manifest = {'status' : None, 'error' : None, 'files' : [], 'history' : {}, 'phases' : {},\
+                         'saved_bytes' : 0, 'time_total' : 0}
+
+    def _phase(self, name, method) :
+        t0 = time()
+        try :
+            return method()
+        finally :
+            self.manifest['phases'][name] = time() - t0
+
+    def run(self) :
+        """Executes transaction, returns manifest, never raises for file system errors"""
+        t0 = time()
+        try :
+            self._phase('parse', self.parse)
+            self._phase('lock', self.lock)
+            try :
+                if self.do_dedup : self._phase('dedup', self.dedup)
+                self._phase('stage', self.stage)
+                self._phase('commit', self.commit)
+            except (OSError, IOError) as err :
+                self.manifest['error'] = str(err)
+                self._phase('rollback', self.rollback)
+                self.manifest['status'] = 'rolled_back'
+                logger.warning('deployment is rolled back: %s' % err, __name__)
+            else :
+                self.manifest['status'] = 'committed'
+                self._phase('history', self.append_history)
+            self._phase('cleanup', self.cleanup)
+        except DeployLocked as err : # nothing is changed
+            self.manifest['error'] = str(err)
+            self.manifest['status'] = 'locked'
+            logger.warning('deployment is not started: %s' % err, __name__)
+        except (OSError, IOError, ValueError) as err : # nothing is changed
+            self.manifest['error'] = str(err)
+            self.manifest['status'] = 'failed'
+            logger.warning('deployment failed: %s' % err, __name__)
+        finally :
+            self.unlock()
+        self.manifest['time_total'] = time() - t0
+        return self.manifest
+
+#------------------------------
+
+    def parse(self) :
+        files = self.manifest['files']
+        for cmd in self.list_of_cmds :
+            action, path_inp, path_out = afc.parse_deploy_command(cmd)
+            files.append({'cmd' : cmd, 'action' : action, 'path_inp' : path_inp, 'path_out' : path_out,\
+                          'dir' : os.path.dirname(os.path.abspath(path_out)), 'nbytes' : 0,\
+                          'replaced' : os.path.exists(path_out), 'status' : 'planned',\
+                          'tmp' : None, 'backup' : None, 'dedup' : None, 'dedup_file' : None, 'path_ext' : None})
+        paths_out = [f['path_out'] for f in files]
+        if len(set(os.path.abspath(p) for p in paths_out)) != len(paths_out) :
+            raise ValueError('the same target file in several deployment commands')
+
+    def directories(self) :
+        return sorted(set(f['dir'] for f in self.manifest['files']))
+
+    def lock(self) :
+        """Acquires exclusive locks of target directories in sorted order to avoid deadlocks"""
+        t0 = time()
+        for d in self.directories() :
+            if not os.path.isdir(d) : raise IOError('target directory %s does not exist' % d)
+            path = os.path.join(d, FNAME_LOCK)
+            fexists = os.path.exists(path)
+            flock = os.open(path, os.O_RDONLY | os.O_CREAT, self.filemode)
+            self.locks.append(flock)
+            if not fexists :
+                try :
+                    afc.set_permissions(flock, self.filemode, self.group)
+                except OSError as err : # lock file is created concurrently by other operator
+                    logger.debug('permissions of %s are not changed: %s' % (path, err), __name__)
+            while True :
+                try :
+                    fcntl.flock(flock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (OSError, IOError) :
+                    if time() - t0 > self.lock_timeout_sec :
+                        raise DeployLocked('deploy in progress, directory %s is locked by other deployment for more than %g sec'\
+                                           % (d, self.lock_timeout_sec))
+                    if int(time() - t0) % 10 == 0 : logger.info('wait for deployment lock of %s' % d, __name__)
+                    sleep(min(1., 0.1*self.lock_timeout_sec))
+
+    def unlock(self) :
+        for flock in self.locks :
+            fcntl.flock(flock, fcntl.LOCK_UN)
+            os.close(flock)
+        self.locks = []
+
+    def dedup(self) :
+        """Plans skip or extend for files with identical content in target directory,
+           only for directories with a single file of transaction, as the plan is evaluated for the current directory content.
+        """
+        files = self.manifest['files']
+        nfiles_in_dir = {}
+        for f in files : nfiles_in_dir[f['dir']] = nfiles_in_dir.get(f['dir'], 0) + 1
+        for f in files :
+            if nfiles_in_dir[f['dir']] > 1 : continue
+            action, name = cfd.dedup_plan(f['path_inp'], f['path_out'])
+            if action == 'deploy' : continue
+            f['dedup'] = action
+            f['dedup_file'] = os.path.join(f['dir'], name)
+            if action == 'extend' : f['path_ext'] = os.path.join(f['dir'], cfd.extended_name(name, os.path.basename(f['path_out'])))
+            saved = os.path.getsize(f['path_inp'])
+            self.manifest['saved_bytes'] += saved
+            logger.info('dedup: %s is identical to %s, %s, %d bytes are not written' %\
+                        (f['path_inp'], f['dedup_file'],\
+                         'file is already in use for runs of %s' % os.path.basename(f['path_out']) if action == 'skip' else\
+                         'file is renamed to %s' % os.path.basename(f['path_ext']), saved), __name__)
+
+    def stage(self) :
+        """Copies all files to temporary files in target directories, raises on the first failure"""
+        def proc(f) :
+            f['tmp'], f['nbytes'] = afc.copy_to_temporary(f['path_inp'], f['path_out'], self.filemode, self.group)
+            f['status'] = 'staged'
+
+        for f in self.manifest['files'] :
+            if f['dedup'] is not None : f['status'] = 'staged'
+        files = [f for f in self.manifest['files'] if f['dedup'] is None]
+        nthreads = min(self.nthreads, len(files))
+        if nthreads < 2 :
+            for f in files : proc(f)
+            return
+        with ThreadPoolExecutor(max_workers=nthreads) as pool :
+            for r in [pool.submit(proc, f) for f in files] : r.result() # re-raise exceptions of threads
+
+    def commit(self) :
+        """Renames temporary files to targets, existing targets are kept as backups for rollback"""
+        for f in self.manifest['files'] :
+            if f['dedup'] == 'skip' :
+                f['status'] = 'skipped'
+                continue
+            if f['dedup'] == 'extend' :
+                os.replace(f['dedup_file'], f['path_ext'])
+                f['status'] = 'committed'
+                logger.info('dedup-extend: %s is renamed to %s' % (f['dedup_file'], os.path.basename(f['path_ext'])), __name__)
+                continue
+            if os.path.exists(f['path_out']) :
+                f['backup'] = afc.temporary_path(f['path_out']) + '.bak'
+                try :
+                    os.link(f['path_out'], f['backup'])
+                except OSError : # file system without hard links
+                    shutil.copy2(f['path_out'], f['backup'])
+            os.replace(f['tmp'], f['path_out'])
+            f['tmp'] = None
+            f['status'] = 'committed'
+        for d in self.directories() : afc.fsync_directory(d)
+
+    def rollback(self) :
+        """Restores targets from backups, removes new targets and temporary files"""
+        for f in reversed(self.manifest['files']) :
+            try :
+                if f['status'] == 'committed' and f['dedup'] == 'extend' :
+                    os.replace(f['path_ext'], f['dedup_file'])
+                elif f['status'] == 'committed' :
+                    if f['backup'] is not None :
+                        os.replace(f['backup'], f['path_out'])
+                        f['backup'] = None
+                    else :
+                        os.remove(f['path_out'])
+                if f['tmp'] is not None and os.path.exists(f['tmp']) : os.remove(f['tmp'])
+                f['tmp'] = None
+            except OSError as err :
+                logger.error('rollback of %s failed: %s' % (f['path_out'], err), __name__)
+            f['status'] = 'rolled_back' if f['status'] in ('staged', 'committed', 'skipped') else 'not_deployed'
+
+    def append_history(self) :
+        """Appends one block of records to history file of each directory"""
+        if not self.fname_history or self.history_record is None : return
+        blocks = {}
+        for f in self.manifest['files'] :
+            if f['status'] != 'committed' : continue
+            recs = blocks.setdefault(f['dir'], [])
+            if f['path_ext'] is None :
+                recs.append(self.history_record(f['cmd']))
+                continue
+            recs.append(rename_record(f['dedup_file'], f['path_ext']))
+            recs.append(self.history_record('%s %s %s' % (f['action'], f['path_inp'], f['path_ext'])))
+        for d, recs in sorted(blocks.items()) :
+            path = os.path.join(d, self.fname_history)
+            try :
+                fexists = os.path.exists(path)
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, self.filemode)
+                try :
+                    os.write(fd, ''.join(recs).encode())
+                    if not fexists : afc.set_permissions(fd, self.filemode, self.group)
+                finally :
+                    os.close(fd)
+                self.manifest['history'][path] = len(recs)
+                logger.info('append %d record(s) to HISTORY file: %s' % (len(recs), path), __name__)
+            except OSError as err : # files are already deployed
+                logger.warning('HISTORY file %s is not updated: %s' % (path, err), __name__)
+
+    def cleanup(self) :
+        """Removes backups and temporary files, removes sources of committed 'mv' commands"""
+        for f in self.manifest['files'] :
+            for k in ('backup', 'tmp') :
+                if f[k] is not None and os.path.exists(f[k]) : os.remove(f[k])
+                f[k] = None
+            if f['action'] == 'mv' and f['status'] in ('committed', 'skipped') :
+                try :
+                    os.remove(f['path_inp'])
+                except OSError as err :
+                    logger.warning('source of mv %s is not removed: %s' % (f['path_inp'], err), __name__)
+
+#------------------------------
+
+    def summary(self) :
+        """Returns str summary of manifest"""
+        m = self.manifest
+        lines = ['deployment %s: %d file(s), %d bytes, %d bytes saved by dedup, total %.3f sec%s' %\
+                 (m['status'], len(m['files']), sum(f['nbytes'] for f in m['files']), m['saved_bytes'], m['time_total'],\
+                  '' if m['error'] is None else ', error: %s' % m['error'])]
+        lines.append('  phases: ' + '  '.join('%s: %.4f' % (k, v) for k, v in m['phases'].items()))
+        for f in m['files'] :
+            kind = ('dedup-%s' % f['dedup']) if f['dedup'] else 'replaced' if f['replaced'] else 'new'
+            lines.append('  %-12s %-13s %10d  %s' % (f['status'], kind, f['nbytes'], f['cmd']))
+            if f['dedup'] == 'extend' :
+                lines.append('  %-12s %-13s %10s  rename %s -> %s' % ('', '', '', f['dedup_file'], os.path.basename(f['path_ext'])))
+        return '\n'.join(lines)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+
+    d = tempfile.mkdtemp()
+    dir_work = os.path.join(d, 'work')
+    dirs_calib = [os.path.join(d, 'calib', 'CsPad::CalibV1', 'XppGon.0:Cspad.0', ctype) for ctype in ('pedestals', 'pixel_rms')]
+    for dd in [dir_work] + dirs_calib : os.makedirs(dd)
+
+    list_of_cmds = []
+    for i, dd in enumerate(dirs_calib) :
+        p = os.path.join(dir_work, 'clb-xpptut15-r0054-%d.txt' % i)
+        with open(p, 'w') as f : f.write('new constants %d\n' % i)
+        list_of_cmds.append('cp %s %s' % (p, os.path.join(dd, '54-end.data')))
+    with open(os.path.join(dirs_calib[0], '54-end.data'), 'w') as f : f.write('old constants\n')
+
+    record = lambda cmd : 'file:%s  copy_of:%s\n' % (os.path.basename(cmd.split()[2]), cmd.split()[1])
+    tr = DeployTransaction(list_of_cmds, group=None, history_record=record)
+    tr.run()
+    print(tr.summary())
+    print('HISTORY: %s' % open(os.path.join(dirs_calib[0], 'HISTORY')).read().strip())
+
+    # failure of the last file rolls back the first one
+    with open(list_of_cmds[0].split()[1], 'w') as f : f.write('newer constants\n')
+    tr = DeployTransaction(list_of_cmds + ['cp %s/missing.txt %s/55-end.data' % (dir_work, dirs_calib[1])], group=None, history_record=record)
+    tr.run()
+    print(tr.summary())
+    print('content after rollback: %s' % open(list_of_cmds[0].split()[2]).read().strip())
+    print('files left in calib dir: %s' % sorted(os.listdir(dirs_calib[0])))
+
+    tr = DeployTransaction(['mv %s %s/56-end.data' % (list_of_cmds[1].split()[1], dirs_calib[1])], group=None)
+    print('mv: %s, source exists: %s' % (tr.run()['status'], os.path.exists(list_of_cmds[1].split()[1])))
+
+    # re-deployment of identical constants
+    p = os.path.join(dir_work, 'clb-xpptut15-r0060.txt')
+    with open(p, 'w') as f : f.write('new constants 1\n')
+    for fname in ('60-end.data', '50-55.data') :
+        tr = DeployTransaction(['cp %s %s/%s' % (p, dirs_calib[1], fname)], group=None, history_record=record, dedup=True)
+        tr.run()
+        print(tr.summary())
+    print('files in calib dir: %s' % sorted(os.listdir(dirs_calib[1])))
+
+    # identical constants for run range adjacent to existing file extend its name
+    dir_ext = os.path.join(d, 'calib', 'CsPad::CalibV1', 'XppGon.0:Cspad.0', 'common_mode')
+    os.makedirs(dir_ext)
+    shutil.copy2(p, os.path.join(dir_ext, '50-53.data'))
+    tr = DeployTransaction(['cp %s %s/54-end.data' % (p, dir_ext)], group=None, history_record=record, dedup=True)
+    tr.run()
+    print(tr.summary())
+    print('files in calib dir: %s' % sorted(os.listdir(dir_ext)))
+    print('HISTORY:\n%s' % open(os.path.join(dir_ext, 'HISTORY')).read().strip())
+
+    # deployment in progress in other process
+    with open(os.path.join(dir_ext, FNAME_LOCK), 'r') as flock :
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        t0 = time()
+        m = DeployTransaction(['cp %s %s/70-end.data' % (p, dir_ext)], group=None, lock_timeout_sec=LOCK_TIMEOUT_SEC_GUI).run()
+        print('locked directory: status %s in %.1f sec, error: %s' % (m['status'], time()-t0, m['error']))
+    sys.exit('End of test')
+
+#------------------------------
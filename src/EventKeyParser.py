@@ -0,0 +1,165 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module EventKeyParser
+#
+#------------------------------------------------------------------------
+
+"""EventKeyParser - parsing of psana EventKey strings in scan logs
+
+One compiled regular expression is used for single strings (CommandLineCalib.parse_str_event_key)
+and for scan log files (BatchLogScanParser). Files are streamed once in large binary blocks,
+lines containing pattern are deduplicated with a hash table before parsing, and parsed (type, src)
+are deduplicated with a set, so the cost is linear in file size.
+
+EventKey string like
+    EventKey(type=psana.CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2')
+is parsed to ('CsPad2x2::ElementV1', 'CxiDg2.0:Cspad2x2.0'), ConfigV* types are skipped.
+
+Usage ::
+
+    from CalibManager.EventKeyParser import parse_str_event_key, types_and_sources_in_file
+
+    type_src = parse_str_event_key("EventKey(type=psana.CsPad.DataV2, src='DetInfo(CxiDs1.0:Cspad.0)')")
+    list_of_types, list_of_sources = types_and_sources_in_file('./work/log_peds_scan.txt')
+
+    # benchmark on generated 100 MB log:
+    python -m CalibManager.EventKeyParser 100
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import re
+
+#------------------------------
+
+PATTERN_EVENT_KEY = 'EventKey(type=psana.'
+
+_dict_of_regex = {}
+
+def regex_event_key(pattern=PATTERN_EVENT_KEY) :
+    """Returns compiled expression with groups type (like CsPad2x2.ElementV1) and src (like CxiDg2.0:Cspad2x2.0)"""
+    if pattern not in _dict_of_regex :
+        _dict_of_regex[pattern] = re.compile(re.escape(pattern) + r"""(?P<type>[^,)\s]+),\s*src=['"]?[^(,'"]*\((?P<src>[^)\n]*)\)""")
+    return _dict_of_regex[pattern]
+
+def type_old(type) :
+    """Returns type in old style: CsPad2x2.ElementV1 -> CsPad2x2::ElementV1, or None for ConfigV types"""
+    if 'ConfigV' in type : return None # remove ConfigV from lists
+    tparts = type.split('.')
+    return '%s::%s' % (tparts[0], tparts[1]) if len(tparts) == 2 else type
+
+def parse_str_event_key(s, pattern=PATTERN_EVENT_KEY) :
+    """Returns (type, src) for str like: EventKey(type=psana.CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2')
+       or None if string is not an EventKey or its type is ConfigV.
+    """
+    m = regex_event_key(pattern).search(s)
+    if m is None : return None
+    t = type_old(m.group('type'))
+    return None if t is None else (t, m.group('src'))
+
+def types_and_sources_in_strings(strings, pattern=PATTERN_EVENT_KEY) :
+    """Returns lists of types and sources for iterable of EventKey strings, unique (type, src) in order of appearance"""
+    seen = set()
+    list_of_types, list_of_sources = [], []
+    for s in strings :
+        resp = parse_str_event_key(s, pattern)
+        if resp is None or resp in seen : continue
+        seen.add(resp)
+        list_of_types.append(resp[0])
+        list_of_sources.append(resp[1])
+    return list_of_types, list_of_sources
+
+def types_and_sources_in_file(path, pattern=PATTERN_EVENT_KEY, block_size=1<<23) :
+    """Streams file once in blocks of block_size bytes,
+       returns lists of types and sources, unique (type, src) in order of appearance.
+    """
+    pat = pattern.encode()
+    unique_lines = {} # ordered as dict, values are not used
+    tail = b''
+    with open(path, 'rb') as f :
+        while True :
+            block = f.read(block_size)
+            if block :
+                lines = (tail + block).split(b'\n')
+                tail = lines.pop() # partial line is carried over to the next block
+            else :
+                lines = [tail]
+            for line in dict.fromkeys(lines) : # repeated lines of block are dropped at C speed
+                if pat in line : unique_lines.setdefault(line)
+            if not block : break
+    return types_and_sources_in_strings((line.decode(errors='replace') for line in unique_lines), pattern)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import os
+    import sys
+    import tempfile
+    from time import time
+
+    def legacy_types_and_sources_in_file(path, pattern=PATTERN_EVENT_KEY) :
+        """Former BatchLogScanParser algorithm: list-deduplicated lines and str.find parsing"""
+        list_of_found_lines = []
+        for line in open(path, 'r') :
+            if pattern in line :
+                line_st = line.rstrip('\n').strip(' ')
+                if line_st in list_of_found_lines : continue
+                list_of_found_lines.append(line_st)
+        list_of_types, list_of_sources = [], []
+        for line in list_of_found_lines :
+            line1 = line[line.find(pattern) + len(pattern):line.rfind(')')]
+            fields = line1.split(',')
+            if fields[0].find('ConfigV') != -1 : continue
+            if len(fields) < 2 : continue
+            detinfo_src = fields[1][fields[1].find('src=') + 4:].strip('"\'')
+            t = type_old(fields[0])
+            s = detinfo_src[detinfo_src.find('(') + 1:detinfo_src.rfind(')')]
+            list_of_types.append(t)
+            list_of_sources.append(s)
+        return list_of_types, list_of_sources
+
+    keys = ["EventKey(type=psana.CsPad.DataV2, src='DetInfo(CxiDs1.0:Cspad.0)', alias='DsaCsPad')",
+            "EventKey(type=psana.CsPad.ConfigV5, src='DetInfo(CxiDs1.0:Cspad.0)', alias='DsaCsPad')",
+            "EventKey(type=psana.CsPad2x2.ElementV1, src='DetInfo(CxiDg2.0:Cspad2x2.0)', alias='Dg2CsPad2x2')",
+            "EventKey(type=psana.Epix.ElementV3, src='DetInfo(XppGon.0:Epix100a.1)', alias='epix')",
+            "EventKey(type=psana.Bld.BldDataEBeamV7, src='BldInfo(EBeam)')",
+            "EventKey(type=psana.EvrData.DataV4, src='DetInfo(NoDetector.0:Evr.0)')"]
+    for s in keys : print('%-100s -> %s' % (s, parse_str_event_key(s)))
+
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    path = os.path.join(tempfile.mkdtemp(), 'log_peds_scan.txt')
+    with open(path, 'w') as f :
+        nbytes, i = 0, 0
+        while nbytes < size_mb * 1e6 :
+            lines = ['scan event %8d fiducials %d time %.6f' % (i, 3*i, i/120.)] + keys
+            if i % 10 == 0 : lines.append("EventKey(type=psana.Acqiris.DataDescV1, src='DetInfo(CxiEndstation.0:Acqiris.%d)', alias='acq%d')" % (i, i))
+            s = '\n'.join(lines) + '\n'
+            f.write(s)
+            nbytes += len(s)
+            i += 1
+    print('generated %s: %.1f MB, %d events' % (path, os.path.getsize(path)/1e6, i))
+
+    t0 = time()
+    types, srcs = types_and_sources_in_file(path)
+    dt_new = time() - t0
+    print('streaming set-based parser: %.3f sec, %d unique (type, src)' % (dt_new, len(srcs)))
+
+    t0 = time()
+    types_l, srcs_l = legacy_types_and_sources_in_file(path)
+    dt_old = time() - t0
+    print('legacy list-based parser: %.3f sec, speedup: %.1f, results are identical: %s'%\
+          (dt_old, dt_old/dt_new, (types_l, srcs_l) == (types, srcs)))
+    sys.exit('End of test')
+
+#------------------------------
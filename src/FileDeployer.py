@@ -8,6 +8,9 @@ logger = logging.getLogger(__name__)
 from CalibManager.ConfigParametersForApp import cp
 from CalibManager.FileNameManager import fnm
 import CalibManager.GlobalUtils as gu
+import CalibManager.AtomicFileCopy as afc
+from CalibManager.DeployTransaction import DeployTransaction, LOCK_TIMEOUT_SEC, LOCK_TIMEOUT_SEC_GUI
+import CalibManager.DeployPlanner as dp
 
 
 def get_list_of_deploy_commands_and_sources_dark(str_run_number, str_run_range, zeropeds=False, deploygeo=False, mets_from=cp.blsp):
@@ -74,8 +77,8 @@ def get_list_of_deploy_commands_and_sources_dcs(str_run_number, str_run_range, m
 
 
 def deploy_calib_files(str_run_number, str_run_range, mode='calibrun-dark', ask_confirm=True, zeropeds=False, deploygeo=False,\
-                       dirmode=0o2775, filemode=0o664, group='ps-users', mets_from=cp.blsp):
-    """Deploys the calibration file(s)"""
+                       dirmode=0o2775, filemode=0o664, group='ps-users', mets_from=cp.blsp, dryrun=False):
+    """Deploys the calibration file(s), for dryrun=True only logs the deployment plan"""
 
     list_of_deploy_commands, list_of_sources = get_list_of_deploy_commands_and_sources(str_run_number, str_run_range, mode, zeropeds, deploygeo, mets_from)
     msg = 'Deploy calibration file(s):'
@@ -88,16 +91,27 @@ def deploy_calib_files(str_run_number, str_run_range, mode='calibrun-dark', ask_
     msg =  '\nTentative deployment commands:\n' + '\n'.join(list_of_deploy_commands)
     logger.info(msg)
 
+    plan = fd.deployPlan([cmd for cmd in list_of_deploy_commands if os.path.exists(cmd.split()[1])])
+    if dryrun:
+        logger.info('Dry run - calibration files are not deployed')
+        return 0
+
     list_src_cbx = [[src,True] for src in list_of_sources]
     if ask_confirm:
-        resp = gu.changeCheckBoxListInPopupMenu(list_src_cbx, win_title='Confirm depl. for:')
+        # popup entries show the plan for each source, selected states are copied back to list_src_cbx
+        list_plan_cbx = [['%s\n%s' % (src, dp.txt_plan_of_source(plan, src)), True] for src in list_of_sources]
+        resp = gu.changeCheckBoxListInPopupMenu(list_plan_cbx, win_title='Confirm depl. for:')
         if resp != 1:
             logger.info('Deployment is cancelled!')
             return 2
+        for src_cbx, (txt, state) in zip(list_src_cbx, list_plan_cbx): src_cbx[1] = state
 
-    for cmd in list_of_deploy_commands:
-        #print 'cmd: ', cmd
-        if is_allowed_command(cmd, list_src_cbx): fd.procDeployCommand(cmd, mode, dirmode=dirmode, filemode=filemode, group=group)
+    list_of_allowed_commands = [cmd for cmd in list_of_deploy_commands if is_allowed_command(cmd, list_src_cbx)]
+    manifest = fd.procDeployCommands(list_of_allowed_commands, mode, dirmode=dirmode, filemode=filemode, group=group,\
+                                     dedup=cp.deploy_dedup.value(), from_gui=ask_confirm)
+    if manifest['status'] != 'committed':
+        logger.warning('Deployment is %s, calibration files are not changed' % manifest['status'])
+        return 4
 
     #---->>> DCS hdf5 file deployment
     return deploy_calib_files_dcs(str_run_number, str_run_range, mode, list_src_cbx, mets_from)
@@ -226,16 +240,8 @@ class FileDeployer(object):
         pass
 
 
-    def procDeployCommand(self, cmd, comment='dark', dirmode=0o2775, filemode=0o664, group='ps-users'):
-        """Accepts command like 'cp path_inp path_out' and replace it by command 'cat path_inp > path_out'"""
-
-        cmd_seq = cmd.split()
-        action, path_inp, path_out = cmd_seq
-        #------------------------------------------------------------------------------------
-        # USE cat in stead of cp and move in order to create output file with ACL permissions
-        #------------------------------------------------------------------------------------
-        cmd_cat = 'cat %s > %s' % (path_inp, path_out)
-
+    def createOutputDirs(self, path_out, dirmode=0o2775, group='ps-users'):
+        """Creates missing directories of the calib tree <calib>/<dtype>/<src>/<ctype>/ for output file"""
         dir_ctype, fname      = path_out  .rsplit('/',1)
         dir_src,   calib_type = dir_ctype .rsplit('/',1)
         dir_dtype, src        = dir_src   .rsplit('/',1)
@@ -249,50 +255,78 @@ class FileDeployer(object):
             if not dir_exists:
                 gu.create_directory(dir, mode=dirmode, group=group)
 
-        fexists = os.path.exists(path_out)
 
-        #os.system(cmd_cat)
-        stream = os.popen(cmd_cat)
-        resp = stream.read()
-        msg = 'command: %s' % cmd_cat
-        if resp: msg += '\n  resp:%s' % resp
-        logger.info(msg)
+    def deployPlan(self, list_of_cmds):
+        """Logs the dry-run plan of deployment (see DeployPlanner) with validity of files before and after deployment,
+           returns plan dict
+        """
+        plan = dp.deploy_plan(list_of_cmds)
+        logger.info('\n' + dp.txt_plan(plan))
+        return plan
 
-        if (not fexists) and os.path.exists(path_out):
-            os.chmod(path_out, filemode)
-            gu.cgu.change_file_ownership(path_out, user=None, group=group)
 
-        if action == 'mv' and resp == '': os.system('rm %s'%(path_inp))
-        #self.changeFilePermissions(path_out)
-        self.addHistoryRecord(cmd, comment, filemode=filemode, group=group)
+    def planDeployCommands(self, list_of_cmds):
+        """Logs the dry-run plan of deployment, returns one-line summary of the plan"""
+        return dp.txt_plan_summary(self.deployPlan(list_of_cmds))
+
+
+    def procDeployCommand(self, cmd, comment='dark', dirmode=0o2775, filemode=0o664, group='ps-users', from_gui=False):
+        """Accepts command like 'cp path_inp path_out' or 'mv path_inp path_out' and executes it in process,
+           see procDeployCommands
+        """
+        return self.procDeployCommands([cmd], comment, dirmode=dirmode, filemode=filemode, group=group, from_gui=from_gui)
+
+
+    def procDeployCommands(self, list_of_cmds, comment='dark', dirmode=0o2775, filemode=0o664, group='ps-users', nthreads=8, dedup=False,\
+                           from_gui=False):
+        """Accepts commands like 'cp path_inp path_out' and deploys all files in one DeployTransaction:
+           target directories are locked, files are copied in thread pool to temporary files in target directories
+           and renamed atomically, all files are deployed or none, one block of records is appended to each HISTORY file.
+           New file gets filemode and group, replaced file keeps its permissions and ACL, source is removed for 'mv'.
+           For dedup=True file is not written if identical file is already in use for its run range,
+           or identical file for adjacent run range is extended by rename (see CalibFileDedup).
+           For from_gui=True locks are awaited for LOCK_TIMEOUT_SEC_GUI only, so GUI thread is not blocked,
+           deployment in progress in other process is reported in message box.
+           Returns manifest of DeployTransaction, status 'locked' - nothing is deployed because of deployment in progress.
+        """
+        #------------------------------------------------------------------------------------
+        # temporary file in output directory is created with ACL permissions as by 'cat in > out'
+        #------------------------------------------------------------------------------------
+        for cmd in list_of_cmds:
+            action, path_inp, path_out = afc.parse_deploy_command(cmd)
+            self.createOutputDirs(path_out, dirmode=dirmode, group=group)
+
+        tr = DeployTransaction(list_of_cmds, filemode=filemode, group=group, fname_history=cp.fname_history.value(),\
+                               history_record=lambda cmd: self.historyRecord(cmd, comment), nthreads=nthreads, dedup=dedup,\
+                               lock_timeout_sec=LOCK_TIMEOUT_SEC_GUI if from_gui else LOCK_TIMEOUT_SEC)
+        manifest = tr.run()
+        if manifest['status'] == 'committed': logger.info(tr.summary())
+        else                                : logger.warning(tr.summary())
+        if from_gui and manifest['status'] == 'locked':
+            gu.confirm_dialog_box(text='Deploy in progress by other operator or process,\nnothing is deployed, try again later.\n\n%s'\
+                                  % manifest['error'], title='Deploy in progress')
+        return manifest
 
 
     def changeFilePermissions(self, path, mode=0o664):
-        cmd = 'chmod %d %s' % (mode,path)
-        msg = 'change permissions for file: %s' % cmd
+        msg = 'change permissions for file: %s mode: %s' % (path, oct(mode))
         logger.info(msg)
-        os.system(cmd)
-
+        os.chmod(path, mode)
 
-    def addHistoryRecord(self, cmd, comment='dark', filemode=0o664, group='ps-users'):
-        #print 'cmd  = ', cmd
-        fname_history  = cp.fname_history.value()
-        if fname_history == '': return
 
+    def historyRecord(self, cmd, comment='dark'):
+        """Returns record for HISTORY file for command like 'cp path_inp path_out'"""
         exp_name       = cp.exp_name.value()
         str_run_number = cp.str_run_number.value()
 
         user   = gu.get_login()
-        login  = gu.get_login()
         host   = gu.get_hostname()
         tstamp = gu.get_current_local_time_stamp(fmt='%Y-%m-%dT%H:%M:%S  zone:%Z')
 
         cmd_cp, path_inp, path_out = cmd.split()
-        dir_inp, fname_inp = path_inp.rsplit('/',1)
         dir_out, fname_out = path_out.rsplit('/',1)
-        path_history = os.path.join(dir_out,fname_history)
 
-        rec = 'file:%s  copy_of:%s  exp:%s  run:%s  comment:%s  user:%s  host:%s  cptime:%s\n' % \
+        return 'file:%s  copy_of:%s  exp:%s  run:%s  comment:%s  user:%s  host:%s  cptime:%s\n' % \
               (fname_out.ljust(14),
                path_inp,
                #fname_inp,
@@ -303,6 +337,17 @@ class FileDeployer(object):
                host,
                tstamp.ljust(29))
 
+
+    def addHistoryRecord(self, cmd, comment='dark', filemode=0o664, group='ps-users'):
+        #print 'cmd  = ', cmd
+        fname_history  = cp.fname_history.value()
+        if fname_history == '': return
+
+        dir_out, fname_out = cmd.split()[2].rsplit('/',1)
+        path_history = os.path.join(dir_out,fname_history)
+
+        rec = self.historyRecord(cmd, comment)
+
         logger.debug('record for HISTORY: \n%s to history file' % rec)
         logger.info('append HISTORY file: %s' % path_history)
 
@@ -13,6 +13,7 @@ import os
 
 from   CalibManager.ConfigParametersForApp import cp
 import CalibManager.GlobalUtils as gu
+from   CalibManager.XtcInventory import get_xtc_inventory
 
 def log_file_cpo():
     """Returns name like /reg/g/psdm/logs/calibman/2016/07/2016-07-19-12:20:59-log-dubrovin-562.txt"""
@@ -101,32 +102,44 @@ class FileNameManager:
         if cp.exp_name.value()   is None: return None
         return os.path.join(cp.instr_dir.value(), cp.instr_name.value(), cp.exp_name.value(), 'xtc')
 
+    def xtc_inventory(self):
+        """Returns XtcInventory for xtc directory, it is cached and re-built only if the directory mtime has changed"""
+        return get_xtc_inventory(self.path_to_xtc_dir())
+
     def get_list_of_xtc_files(self):
-        return gu.get_list_of_files_in_dir_for_ext(self.path_to_xtc_dir(), '.xtc')
+        return self.xtc_inventory().list_of_files()
 
     def get_list_of_xtc_runs(self):
         """Returns the list of xtc runs as string, for example:  ['0001', '0202', '0203', '0204',...]"""
-        list_of_xtc_files = self.get_list_of_xtc_files()
-        list_of_xtc_runs = []
-        for fname in list_of_xtc_files:
-            exp, run, stream, chunk, ext = gu.parse_xtc_file_name(fname)
-            if run in list_of_xtc_runs: continue
-            list_of_xtc_runs.append(run)
-        return list_of_xtc_runs
+        return self.xtc_inventory().list_of_runs()
 
     def get_list_of_xtc_run_nums(self):
         """Returns the list of xtc integer run numbers:  [1, 202, 203, 204,...]"""
-        return [int(run) for run in self.get_list_of_xtc_runs()]
+        return self.xtc_inventory().list_of_run_nums()
+
+    def get_list_of_xtc_files_for_run(self, str_run_number=None):
+        """Returns sorted list of xtc file names for run, by default for cp.str_run_number"""
+        run = cp.str_run_number.value() if str_run_number is None else str_run_number
+        return self.xtc_inventory().files_for_run(run)
+
+    def get_list_of_xtc_all_files_for_run(self, str_run_number=None):
+        """Returns list of xtc, *.xtc.inprogress and smalldata/*.smd.xtc[.inprogress] file names relative to xtc directory"""
+        run = cp.str_run_number.value() if str_run_number is None else str_run_number
+        return self.xtc_inventory().all_files_for_run(run)
+
+    def get_list_of_xtc_runs_growing(self, dt_sec=60):
+        """Returns the list of xtc runs which have *.xtc.inprogress files or chunks modified within dt_sec"""
+        return self.xtc_inventory().runs_growing(dt_sec)
+
+    def xtc_total_bytes_for_run(self, str_run_number=None):
+        """Returns total size of xtc files for run, by default for cp.str_run_number"""
+        run = cp.str_run_number.value() if str_run_number is None else str_run_number
+        return self.xtc_inventory().total_bytes(run, refresh=True)
 
     def path_to_xtc_files_for_run(self):
         """Returns somthing like /reg/d/psdm/CXI/cxitut13/xtc/e304-r0022-*.xtc"""
         if cp.str_run_number.value() == 'None': return None
-        pattern = '-r' + cp.str_run_number.value()
-        for fname in self.get_list_of_xtc_files():
-            if fname.find(pattern) != -1:
-                exp, runnum, stream, chunk, ext = gu.parse_xtc_file_name(fname) # Parse: e170-r0003-s00-c00.xtc
-                return os.path.join(self.path_to_xtc_dir(), exp + '-r' + runnum + '-*.xtc')
-        return None
+        return self.xtc_inventory().path_for_run(cp.str_run_number.value())
 
     def get_list_of_metrology_text_files(self):
         return [self.path_metrology_text()]
@@ -182,6 +195,12 @@ class FileNameManager:
     def path_peds_aver_batch_log(self):
         return self.path_peds_aver_log()
 
+    def path_peds_state(self):
+        return self.path_prefix_dark() + 'peds-state.json'
+
+    def path_scan_cache(self):
+        return cp.dir_work.value() + '/scan-cache.json'
+
     def path_peds_template(self):
         return self.path_prefix() + '#exp-#run-peds-#type-#src.txt'
 
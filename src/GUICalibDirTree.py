@@ -9,6 +9,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from .ConfigParametersForApp import cp
 from CalibManager.Logger                 import logger
 from .FileNameManager        import fnm
+from . import CalibTreeManifest     as ctm
 
 
 try:
@@ -116,6 +117,9 @@ class GUICalibDirTree(QtWidgets.QWidget):
 
         self.model = QtGui.QStandardItemModel()
         self.model.setHorizontalHeaderLabels('x')
+
+        calib_dir = fnm.path_to_calib_dir()
+        manifest = ctm.get_manifest(calib_dir) if calib_dir is not None and os.path.isdir(calib_dir) else None
         #self.model.setHorizontalHeaderItem(1,QtGui.QStandardItem('Project Title'))
         #self.model.setVerticalHeaderLabels('abc')
 
@@ -148,6 +152,9 @@ class GUICalibDirTree(QtWidgets.QWidget):
                     itemt = QtGui.QStandardItem(QString(t))
                     itemt.setIcon(cp.icon_folder_closed)
                     itemt.setCheckable(True)
+                    if manifest is not None:
+                        nfiles = len(manifest.list_of_sorted_calib_files(os.path.join(calib_dir, v, d, t)))
+                        itemt.setToolTip('%d calibration file(s)' % nfiles)
                     itemd.appendRow(itemt)
 
 
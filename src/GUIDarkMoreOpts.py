@@ -116,7 +116,7 @@ class GUIDarkMoreOpts(QtWidgets.QWidget) :
     def showToolTips(self):
         pass
         self.but_srcs.setToolTip('Show data sources from DB')
-        self.but_sxtc.setToolTip('Show data types and sources from xtc file scan')
+        self.but_sxtc.setToolTip('Show data types and sources from scan cache or xtc file scan')
         self.but_flst.setToolTip('Show status list of output files')
         self.but_fxtc.setToolTip('Show input xtc files for run %s' % self.run_number)
         self.but_view.setToolTip('Start text file browser in separate window')
@@ -213,10 +213,10 @@ class GUIDarkMoreOpts(QtWidgets.QWidget) :
 
 
     def on_but_sxtc(self) :
-        """Print sources from XTC scan log
+        """Print sources from scan cache (pre-filled from RegDB) or XTC scan log
         """
         self.exportLocalPars()
-        txt = '\n' + 50*'-' + '\nData Types and Sources from xtc scan of the\n' \
+        txt = '\n' + 50*'-' + '\nData Types and Sources from scan cache or xtc scan of the\n' \
             + cp.blsp.txt_list_of_types_and_sources()
         
         logger.info(txt, __name__)
@@ -251,12 +251,14 @@ class GUIDarkMoreOpts(QtWidgets.QWidget) :
         logger.debug('on_but_fxtc', __name__)
         #list_of_files = self.get_list_of_files_peds()
         dir_xtc = fnm.path_to_xtc_dir()
-        list_of_files = gu.get_list_of_files_in_dir_for_part_fname(dir_xtc, pattern='-r'+self.run_number)
+        list_of_names = fnm.get_list_of_xtc_all_files_for_run(self.run_number) # xtc, in progress and smalldata chunks
+        width = max([22] + [len(name) for name in list_of_names])
         msg = '\n' + 50*'-' + '\nXTC files in %s for run %s:\n' % (dir_xtc, self.run_number)
-        for fname in list_of_files :
+        for name in list_of_names :
 
+            fname      = os.path.join(dir_xtc, name)
             exists     = os.path.exists(fname)
-            msg += '%s  %s' % (os.path.basename(fname).ljust(22), self.dict_status[exists].ljust(5))
+            msg += '%s  %s' % (name.ljust(width), self.dict_status[exists].ljust(5))
 
             if exists :
                 ctime_sec  = os.path.getctime(fname)
@@ -20,6 +20,7 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 
 from CalibManager.ConfigParametersForApp import cp
 from CalibManager.Logger                 import logger
+import CalibManager.CalibTreeManifest    as ctm
 
 #------------------------------
 
@@ -104,13 +105,15 @@ class GUIDirTree(QtWidgets.QWidget):
         if dir_top is not None :
             self.dir_top = dir_top
         self.model.clear()
+        if os.path.isdir(self.dir_top) :
+            ctm.get_manifest(self.dir_top) # re-lists only changed directories of the tree
         self.fill_dir_tree(self.dir_top)
         self.view.expandAll()
 
 
     def fill_dir_tree(self, path, item=None, level=0) :
 
-        if not os.path.exists(path) :
+        if not ctm.exists(path) :
             return #'Path %s DOES NOT EXIST' % path
 
         item_parent = self.model.invisibleRootItem() if item is None else item
@@ -118,14 +121,14 @@ class GUIDirTree(QtWidgets.QWidget):
         item_add = QtGui.QStandardItem(QString(os.path.basename(path)))
         item_parent.appendRow(item_add)
 
-        if os.path.isfile(path) :
+        if ctm.isfile(path) :
             #item_add.setIcon(cp.icon_table)
             item_add.setCheckable(True) 
             return
 
-        elif os.path.isdir(path) :
+        elif ctm.isdir(path) :
             item_add.setIcon(cp.icon_folder_open)
-            list_of_fnames = sorted(os.listdir(path))
+            list_of_fnames = ctm.listdir(path)
             if list_of_fnames == [] :
                 return # 'Directory %s IS EMPTY!' %  path     
 
@@ -257,12 +257,10 @@ class GUIFileManagerGroupControl(QtWidgets.QWidget) :
             txt += '\n' + cmd
         logger.info(txt, __name__)
 
-        msg = 'Approve commands \njust printed in the logger'
+        msg = 'Approve commands \njust printed in the logger\n\n%s' % fd.planDeployCommands(list_of_cmds)
         if self.approveCommand(self.but_copy, msg) :
 
-            for cmd in list_of_cmds :
-                fd.procDeployCommand(cmd, 'group-file-manager')
-            #    #os.system(cmd)
+            fd.procDeployCommands(list_of_cmds, 'group-file-manager', from_gui=True)
 
             if cp.guistatus is not None : cp.guistatus.updateStatusInfo()
 
@@ -273,8 +273,8 @@ class GUIFileManagerSingleControl(QtWidgets.QWidget) :
         cmd = 'mv %s %s' % (self.str_path(), self.get_out_path())
         if self.approveCommand(self.but_copy, cmd):
             #os.system(cmd)
-            fd.procDeployCommand(cmd, 'single-file-manager')
-            self.resetFieldsOnDelete()
+            manifest = fd.procDeployCommand(cmd, 'single-file-manager', from_gui=True)
+            if manifest['status'] == 'committed': self.resetFieldsOnDelete()
             if cp.guistatus is not None: cp.guistatus.updateStatusInfo()
 
 
@@ -287,7 +287,7 @@ class GUIFileManagerSingleControl(QtWidgets.QWidget) :
         cmd = 'cp %s %s' % (self.str_path(), self.get_out_path())
         if self.approveCommand(self.but_copy, cmd):
             #os.system(cmd)
-            fd.procDeployCommand(cmd, 'single-file-manager')
+            fd.procDeployCommand(cmd, 'single-file-manager', from_gui=True)
             if cp.guistatus is not None: cp.guistatus.updateStatusInfo()
 
 
@@ -303,6 +303,7 @@ class GUIFileManagerSingleControl(QtWidgets.QWidget) :
 
     def approveCommand(self, but, cmd):
         msg = 'Approve command:\n' + cmd
+        if cmd.split()[0] in ('cp', 'mv'): msg += '\n\n' + fd.planDeployCommands([cmd])
         resp = gu.confirm_or_cancel_dialog_box(parent=but, text=msg, title='Please confirm or cancel!')
         if resp:
             logger.info('Approved command:\n' + cmd, __name__)
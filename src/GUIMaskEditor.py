@@ -38,6 +38,8 @@ import CalibManager.GlobalUtils          as     gu
 from CalibManager.PlotImgSpe             import *
 from CalibManager.GUIFileBrowser         import *
 from CalibManager.FileNameManager        import fnm
+from CalibManager.NDArrTextLoader       import load_txt
+import CalibManager.GeometryCache        as     gc
 
 from CorAna.MaskEditor import MaskEditor
 
@@ -326,7 +328,7 @@ class GUIMaskEditor(Frame) :
 
     def openFileWithImageArray(self) :
          path = self.fname_roi_img.value()
-         self.img_arr = gu.get_image_array_from_file(path) # , dtype=np.float32)
+         self.img_arr = gu.get_image_array_from_file(path, gfname=self.fname_geometry.value()) # , dtype=np.float32)
          #print 'openFileWithImageArray: self.arr.shape:', self.img_arr.shape
          #print self.img_arr
 
@@ -407,20 +409,19 @@ class GUIMaskEditor(Frame) :
              ( gfname, afname )
         logger.info(msg, __name__)
 
-        geometry = GeometryAccess(gfname, 0)
-        iX, iY = geometry.get_pixel_coord_indexes()
+        geo = gc.geometry(gfname) # cached per content of geometry file
 
         if afname == '' : afname = None
         afext = '' if afname is None else os.path.splitext(afname)[1]
 
-        nda = np.ones(iX.shape, dtype=np.uint16) if afname is None else \
+        nda = np.ones(geo.shape, dtype=np.uint16) if afname is None else \
               np.load(afname) if afext == '.npy' else \
-              np.loadtxt(afname) #, dtype=np.uint16)
-        nda.shape = iX.shape 
+              load_txt(afname) #, dtype=np.uint16)
+        nda.shape = geo.shape
 
         #if mcbits :  nda *= geometry.get_pixel_mask(mbits=mcbits)
  
-        return img_from_pixel_arrays(iX, iY, W=nda) 
+        return geo.reconstruct(nda)
 
 
     def on_but_reco_image(self):
@@ -461,25 +462,19 @@ class GUIMaskEditor(Frame) :
              ( ifname, ofname, gfname )
         logger.info(msg, __name__)
 
-        geometry = GeometryAccess(gfname, 0)
-        iX, iY = geometry.get_pixel_coord_indexes()
+        geo = gc.geometry(gfname) # cached per content of geometry file
+        iX, iY = geo.get_pixel_coord_indexes()
+        geo_pixel_mask = geo.get_pixel_mask(mbits=mcbits) if mcbits else None
         msg = 'Pixel index array iX, iY shapes: %s,  %s' % (str(iX.shape), str(iY.shape))
         logger.info(msg, __name__)
 
-        ifext = os.path.splitext(ifname)[1]
         ofext = os.path.splitext(ofname)[1]
 
-        mask_roi = np.load(ifname) if ifext == '.npy' else np.loadtxt(ifname, dtype=np.uint16)
+        mask_roi = gc.load_roi_mask(ifname)
 
-        mask_nda = np.array([mask_roi[r,c] for r,c in zip(iX, iY)], dtype=np.uint8) # 155 msec
-        geo_pixel_mask = geometry.get_pixel_mask(mbits=mcbits)
+        mask_nda = gc.roi_mask_to_ndarray(mask_roi, iX, iY, geo_pixel_mask, dtype=np.uint8)
 
-        #print 'mask_nda       dtype, shape:', mask_nda.dtype, mask_nda.shape
-        #print 'geo_pixel_mask dtype, shape:', geo_pixel_mask.dtype, geo_pixel_mask.shape
-
-        if mcbits : mask_nda *= geo_pixel_mask
-
-        img_mask_test = img_from_pixel_arrays(iX, iY, W=mask_nda) 
+        img_mask_test = geo.reconstruct(mask_nda)
 
         if ofext == '.npy' : np.save(ofname, mask_nda)
         else               :
@@ -575,12 +575,10 @@ class GUIMetrology(Frame) :
         logger.info(txt, __name__)
 
 
-        msg = 'Approve commands \njust printed in the logger'
+        msg = 'Approve commands \njust printed in the logger\n\n%s' % fd.planDeployCommands(list_of_cmds)
         if self.approveCommand(self.butDeploy, msg) :
 
-            for cmd in list_of_cmds :
-                fd.procDeployCommand(cmd, 'metrology-alignment')
-                #print 'Command for deployer: ', cmd
+            fd.procDeployCommands(list_of_cmds, 'metrology-alignment', from_gui=True)
 
             if cp.guistatus is not None : cp.guistatus.updateStatusInfo()
 
@@ -0,0 +1,327 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module GeometryCache
+#
+#------------------------------------------------------------------------
+
+"""GeometryCache - process-wide cache of geometry pixel arrays, image reconstruction, and ROI mask conversion
+
+Pixel image-index arrays iX, iY (GeometryAccess.get_pixel_coord_indexes) and pixel mask
+(GeometryAccess.get_pixel_mask(mbits)) are evaluated once per content of geometry file
+and saved in .npz file in the user cache directory (~/.cache/CalibManager/geometry),
+keyed by the content digest of geometry file and mask bits. Repeated conversions load
+these arrays without parsing of geometry and evaluation of pixel coordinates.
+
+ROI mask image is converted to data-shaped ndarray by single fancy-indexed gather mask_roi[iX, iY].
+
+GeometryCache keeps in memory GeometryEntry objects for geometry files, keyed by content digest,
+with LRU eviction by total size of arrays. Entry holds index arrays, image shape, flat image index of pixels,
+pixel masks for requested mbits, and pixel coordinates, loaded from the .npz store or evaluated on first request.
+Entry mirrors methods get_pixel_coord_indexes, get_pixel_mask, and get_pixel_coords of GeometryAccess,
+and reconstructs image from data-shaped ndarray by single scatter to flat image index.
+
+Usage ::
+
+    import CalibManager.GeometryCache as gc
+
+    geo = gc.geometry(gfname)              # GeometryEntry from process-wide cache gc.geometry_cache
+    img = geo.reconstruct(nda)             # as img_from_pixel_arrays(iX, iY, W=nda)
+    img = gc.reconstruct(gfname, nda)
+    iX, iY = geo.get_pixel_coord_indexes()
+    pmask = geo.get_pixel_mask(mbits=0xffff)
+    X, Y, Z = geo.get_pixel_coords()
+
+    iX, iY, pmask = gc.pixel_index_arrays('/reg/d/psdm/CXI/cxitut13/calib/CsPad::CalibV1/CxiDs1.0:Cspad.0/geometry/0-end.data', mbits=0xffff)
+    mask_nda = gc.roi_mask_to_ndarray(mask_roi, iX, iY, pmask, dtype=np.uint8)
+
+    # many ROI masks against one geometry
+    list_of_ofnames = gc.roi_mask_files_to_ndarrays(gfname, ['roi1.npy', 'roi2.txt'], mbits=0xffff)
+
+    # command line:
+    roicon -p4 -g <geometry-file> roi-mask-1.npy roi-mask-2.txt ...
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from CalibManager.Logger          import logger
+from CalibManager.CalibFileDedup  import file_digest
+from CalibManager.NDArrTextLoader import load_txt
+
+#------------------------------
+
+DIR_CACHE_DEFAULT = os.path.join(os.path.expanduser('~'), '.cache', 'CalibManager', 'geometry')
+MAX_BYTES_MEMORY  = 512<<20 # size of arrays of geometry entries kept in memory
+
+#------------------------------
+
+def path_to_index_arrays(gfname, mbits=0, cache_dir=DIR_CACHE_DEFAULT) :
+    """Returns path to .npz file with index arrays for content of geometry file and mask bits"""
+    return os.path.join(cache_dir, '%s-%x.npz' % (file_digest(gfname), mbits))
+
+def save_arrays(path, **arrays) :
+    """Saves arrays in .npz file atomically"""
+    d = os.path.dirname(path)
+    if not os.path.exists(d) : os.makedirs(d)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f : np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def save_index_arrays(path, iX, iY, pmask=None) :
+    """Saves index arrays in .npz file atomically"""
+    if pmask is None : save_arrays(path, iX=iX, iY=iY)
+    else             : save_arrays(path, iX=iX, iY=iY, pmask=pmask)
+
+def load_index_arrays(path) :
+    """Returns (iX, iY, pmask) from .npz file, pmask is None if it is not saved"""
+    with np.load(path) as d :
+        return d['iX'], d['iY'], (d['pmask'] if 'pmask' in d.files else None)
+
+def evaluate_index_arrays(gfname, mbits=0) :
+    """Returns (iX, iY, pmask) evaluated by GeometryAccess, pmask is None for mbits=0"""
+    from PSCalib.GeometryAccess import GeometryAccess
+    geometry = GeometryAccess(gfname, 0)
+    iX, iY = geometry.get_pixel_coord_indexes()
+    pmask = geometry.get_pixel_mask(mbits=mbits) if mbits else None
+    return iX, iY, pmask
+
+def pixel_index_arrays(gfname, mbits=0, cache_dir=DIR_CACHE_DEFAULT) :
+    """Returns (iX, iY, pmask) for geometry file from cache in cache_dir or evaluated and saved in cache,
+       pmask is None for mbits=0, cache_dir=None - cache is not used.
+    """
+    if cache_dir is None : return evaluate_index_arrays(gfname, mbits)
+    path = path_to_index_arrays(gfname, mbits, cache_dir)
+    if os.path.exists(path) :
+        try :
+            return load_index_arrays(path)
+        except (OSError, IOError, ValueError, KeyError) as err :
+            logger.debug('geometry cache %s is ignored: %s' % (path, err), __name__)
+    iX, iY, pmask = evaluate_index_arrays(gfname, mbits)
+    try :
+        save_index_arrays(path, iX, iY, pmask)
+    except OSError as err :
+        logger.debug('geometry cache for %s is not saved: %s' % (gfname, err), __name__)
+    return iX, iY, pmask
+
+#------------------------------
+
+def roi_mask_to_ndarray(mask_roi, iX, iY, pmask=None, dtype=None) :
+    """Returns data-shaped ndarray of ROI mask image values at pixel indexes, multiplied by pixel mask if specified"""
+    if mask_roi.ndim != 2 or iX.max() >= mask_roi.shape[0] or iY.max() >= mask_roi.shape[1] :
+        raise ValueError('ROI mask image shape %s does not cover pixel indexes of geometry, max iX=%d iY=%d'%\
+                         (str(mask_roi.shape), iX.max(), iY.max()))
+    mask_nda = mask_roi[iX, iY]
+    if dtype is not None : mask_nda = mask_nda.astype(dtype, copy=False)
+    if pmask is not None : mask_nda *= pmask.astype(mask_nda.dtype, copy=False)
+    return mask_nda
+
+def load_roi_mask(ifname) :
+    return np.load(ifname) if os.path.splitext(ifname)[1] == '.npy' else load_txt(ifname, dtype=np.uint16)
+
+def save_ndarray_mask(ofname, mask_nda) :
+    """Saves mask ndarray in .npy, or in text file re-shaped to 2-d"""
+    if os.path.splitext(ofname)[1] == '.npy' :
+        np.save(ofname, mask_nda)
+    else :
+        np.savetxt(ofname, mask_nda.reshape((mask_nda.size//mask_nda.shape[-1], mask_nda.shape[-1])), fmt='%d', delimiter=' ')
+
+def ndarray_fname_for_roi(ifname, suffix='-nda') :
+    """Returns name of output ndarray file for ROI mask file, e.g. roi-mask.npy -> roi-mask-nda.npy"""
+    root, ext = os.path.splitext(ifname)
+    return '%s%s%s' % (root, suffix, ext if ext else '.txt')
+
+def roi_mask_files_to_ndarrays(gfname, list_of_ifnames, list_of_ofnames=None, mbits=0xffff, dtype=None) :
+    """Converts ROI mask image files to ndarray mask files using one geometry, returns list of output file names"""
+    geo = geometry(gfname)
+    iX, iY = geo.get_pixel_coord_indexes()
+    pmask = geo.get_pixel_mask(mbits) if mbits else None
+    if list_of_ofnames is None : list_of_ofnames = [ndarray_fname_for_roi(f) for f in list_of_ifnames]
+    for ifname, ofname in zip(list_of_ifnames, list_of_ofnames) :
+        save_ndarray_mask(ofname, roi_mask_to_ndarray(load_roi_mask(ifname), iX, iY, pmask, dtype))
+        logger.info('ROI mask %s is converted to ndarray %s' % (ifname, ofname), __name__)
+    return list_of_ofnames
+
+#------------------------------
+
+class GeometryEntry(object) :
+    """Pixel arrays for content of one geometry file, arrays are loaded from .npz store or evaluated on first request"""
+
+    def __init__(self, gfname, digest, cache_dir=DIR_CACHE_DEFAULT, arrays=None) :
+        """@param arrays - (iX, iY) if already available, otherwise they are loaded or evaluated"""
+        self.gfname = gfname
+        self.digest = digest
+        self.cache_dir = cache_dir
+        self.lock = Lock()
+        self.masks = {}    # {mbits: pmask}
+        self.coords = None # (X, Y, Z)
+        self.iX, self.iY = arrays if arrays is not None else pixel_index_arrays(gfname, 0, cache_dir)[:2]
+        self.shape = self.iX.shape
+        self.img_shape = (int(self.iX.max())+1, int(self.iY.max())+1)
+        self.index = np.ravel_multi_index((self.iX.ravel(), self.iY.ravel()), self.img_shape) # flat image index of pixels
+
+
+    def get_pixel_coord_indexes(self) :
+        return self.iX, self.iY
+
+
+    def get_pixel_mask(self, mbits=0xffff) :
+        with self.lock :
+            pmask = self.masks.get(mbits)
+        if pmask is None :
+            pmask = pixel_index_arrays(self.gfname, mbits, self.cache_dir)[2]
+            with self.lock :
+                self.masks[mbits] = pmask
+        return pmask
+
+
+    def get_pixel_coords(self) :
+        """Returns (X, Y, Z) pixel coordinates as GeometryAccess.get_pixel_coords()"""
+        if self.coords is not None : return self.coords
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, '%s-xyz.npz' % self.digest)
+        if path is not None and os.path.exists(path) :
+            with np.load(path) as d : coords = d['X'], d['Y'], d['Z']
+        else :
+            from PSCalib.GeometryAccess import GeometryAccess
+            coords = GeometryAccess(self.gfname, 0).get_pixel_coords()
+            if path is not None :
+                try :
+                    save_arrays(path, X=coords[0], Y=coords[1], Z=coords[2])
+                except OSError as err :
+                    logger.debug('pixel coordinates for %s are not saved: %s' % (self.gfname, err), __name__)
+        self.coords = coords
+        return coords
+
+
+    def reconstruct(self, nda, dtype=np.float32, vbase=0) :
+        """Returns image for data-shaped ndarray as img_from_pixel_arrays(iX, iY, W=nda, dtype, vbase)"""
+        if nda.size != self.index.size :
+            raise ValueError('ndarray size %d is not equal to the number of pixels %d in geometry %s' % (nda.size, self.index.size, self.gfname))
+        img = np.full(self.img_shape, vbase, dtype=dtype)
+        img.reshape(-1)[self.index] = np.asarray(nda).reshape(-1)
+        return img
+
+
+    def nbytes(self) :
+        arrays = [self.iX, self.iY, self.index] + [m for m in self.masks.values() if m is not None] + list(self.coords or ())
+        return sum(a.nbytes for a in arrays)
+
+
+class GeometryCache(object) :
+    """LRU cache of GeometryEntry objects keyed by content digest of geometry file, limited by size of arrays in memory"""
+
+    def __init__(self, max_bytes=MAX_BYTES_MEMORY, cache_dir=DIR_CACHE_DEFAULT) :
+        """@param cache_dir - directory of .npz store, None - arrays are evaluated, not stored"""
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+
+    def geometry(self, gfname) :
+        """Returns GeometryEntry for geometry file, the same object for unchanged content"""
+        digest = file_digest(gfname)
+        with self.lock :
+            geo = self.entries.pop(digest, None)
+            if geo is not None :
+                self.entries[digest] = geo
+                return geo
+        geo = GeometryEntry(gfname, digest, self.cache_dir)
+        with self.lock :
+            self.entries[digest] = geo
+            self.evict(keep=digest)
+        return geo
+
+
+    def evict(self, keep=None) :
+        """Removes least recently used entries while total size exceeds max_bytes"""
+        total = sum(g.nbytes() for g in self.entries.values())
+        for digest in list(self.entries) :
+            if total <= self.max_bytes : break
+            if digest == keep : continue
+            total -= self.entries.pop(digest).nbytes()
+
+
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+
+#------------------------------
+
+geometry_cache = GeometryCache()
+
+def geometry(gfname) :
+    """Returns GeometryEntry for geometry file from process-wide cache"""
+    return geometry_cache.geometry(gfname)
+
+def reconstruct(gfname, nda, dtype=np.float32, vbase=0) :
+    """Returns image for data-shaped ndarray using geometry file from process-wide cache"""
+    return geometry(gfname).reconstruct(nda, dtype, vbase)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    from time import time
+
+    d = tempfile.mkdtemp()
+    gfname = os.path.join(d, 'geometry-0-end.data')
+    with open(gfname, 'w') as f : f.write('# geometry of test detector\n')
+
+    # CSPAD-like index arrays: 32 segments 185x388 on 1750x1750 image
+    shape = (32, 185, 388)
+    iX = np.random.randint(0, 1750, size=shape).astype(np.uint32)
+    iY = np.random.randint(0, 1750, size=shape).astype(np.uint32)
+    pmask = (np.random.random(shape) > 0.01).astype(np.uint8)
+    mask_roi = (np.random.random((1750, 1750)) > 0.5).astype(np.uint16)
+
+    t0 = time(); ref = np.array([mask_roi[r,c] for r,c in zip(iX, iY)]) * pmask; t1 = time()
+    nda = roi_mask_to_ndarray(mask_roi, iX, iY, pmask, dtype=np.uint8);        t2 = time()
+    print('list comprehension: %.4f sec, gather: %.4f sec, identical: %s, shape %s dtype %s' %\
+          (t1-t0, t2-t1, np.array_equal(ref, nda), str(nda.shape), nda.dtype))
+
+    path = path_to_index_arrays(gfname, 0xffff, os.path.join(d, 'cache'))
+    save_index_arrays(path, iX, iY, pmask)
+    t0 = time(); x, y, m = load_index_arrays(path); t1 = time()
+    print('cached index arrays %s loaded in %.4f sec, identical: %s' %\
+          (os.path.basename(path), t1-t0, all(np.array_equal(a, b) for a, b in ((x, iX), (y, iY), (m, pmask)))))
+    print('output name for roi-mask.npy: %s, for roi.txt: %s' % (ndarray_fname_for_roi('roi-mask.npy'), ndarray_fname_for_roi('roi.txt')))
+    try :
+        roi_mask_to_ndarray(mask_roi[:100, :100], iX, iY)
+    except ValueError as err :
+        print('ValueError: %s' % err)
+
+    # image reconstruction: scatter vs assignment through fancy index as in img_from_pixel_arrays
+    ix = np.arange(1750*1750, dtype=np.uint32)[:iX.size]
+    np.random.shuffle(ix)
+    iX, iY = (ix // 1750).reshape(shape), (ix % 1750).reshape(shape)
+    geo = GeometryEntry(gfname, file_digest(gfname), cache_dir=None, arrays=(iX, iY))
+    nda = np.random.random(shape).astype(np.float32)
+    t0 = time(); img = geo.reconstruct(nda); t1 = time()
+    ref = np.zeros((iX.max()+1, iY.max()+1), dtype=np.float32); ref[iX, iY] = nda; t2 = time()
+    print('reconstruct: %.4f sec, fancy-index assignment: %.4f sec, identical: %s, image shape %s' %\
+          (t1-t0, t2-t1, np.array_equal(img, ref), str(img.shape)))
+
+    gcache = GeometryCache(max_bytes=geo.nbytes()+1, cache_dir=os.path.join(d, 'cache'))
+    gcache.entries[geo.digest] = geo
+    t0 = time(); same = gcache.geometry(gfname) is geo; t1 = time()
+    print('cached entry is returned: %s in %.6f sec, entry size %.1f MB' % (same, t1-t0, geo.nbytes()/1e6))
+    sys.exit('End of test')
+
+#------------------------------
@@ -42,6 +42,10 @@ import PyCSPadImage.CSPAD2x2ImageUtils as cspad2x2img
 import PyCSPadImage.CSPADImageUtils    as cspadimg
 
 from .CalibFileFinder import *
+from . import CalibTreeManifest as ctm
+from . import SubprocSupervisor as sps
+from . import NDArrTextLoader as ntl
+from . import GeometryCache as gc
 import PSCalib.GlobalUtils as cgu
 
 QtCore, QtGui, QtWidgets = None, None, None
@@ -181,26 +185,14 @@ def call(command_seq, shell=False):
     subprocess.call(command_seq, shell=shell) # , stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
 
 
-def subproc_in_log(command_seq, logname, env=None, shell=False, tmax_sec=500):
+def subproc_in_log(command_seq, logname, env=None, shell=False, tmax_sec=500, on_tick=None):
     """execute command_seq in subprocess, output results in log file,
-       returns error message or completein message.
-       ex: command_seq=['bsub', '-q', cp.batch_queue, '-o', 'log-ls.txt', 'ls -l']
+       returns error message or empty string for successful completion.
+       Returns as soon as subprocess exits, process group is terminated if tmax_sec is exceeded,
+       on_tick() is called while waiting, e.g. QCoreApplication.processEvents.
+       ex: command_seq=['event_keys', '-d', 'exp=xpptut15:run=54', '-n', '10']
     """
-    log = open(logname, 'w')
-    p = subprocess.Popen(command_seq, stdout=log, stderr=log, env=env, shell=shell) #, stdin=subprocess.STDIN, stderr=subprocess.PIPE
-    #p.wait()
-    t0_sec = time()
-    sys.stdout.write('subprocess is started')
-    sys.stdout.flush()
-    while p.poll() is None:
-      sleep(5)
-      dt = time()-t0_sec
-      sys.stdout.write('\rsubprocess is working for %.0f sec' % dt)
-      sys.stdout.flush()
-      if p and dt>tmax_sec:
-        logger.info('subprocess is working too long - terminate waiting loop' % dt)
-        break
-    err = p.stderr.read() if p and p.stderr is not None else 'subprocess is completed'
+    rc, err = sps.run_in_log(command_seq, logname, env=env, shell=shell, tmax_sec=tmax_sec, on_tick=on_tick)
     return err
 
 
@@ -473,7 +465,9 @@ def get_text_content_of_calib_dir_for_detector(path, det='cspad', subdir='CsPad:
         txt = 'Path %s DOES NOT EXIST' % path
         return txt
 
-    list_of_fnames = os.listdir(path)
+    if level == 0: ctm.get_manifest(path) # re-lists only changed directories of the calib tree
+
+    list_of_fnames = ctm.listdir(path)
 
     if list_of_fnames == []:
         txt += '\n' + (level+1)*'    ' + 'Directory IS EMPTY!'
@@ -508,7 +502,7 @@ def get_text_content_of_calib_dir_for_detector(path, det='cspad', subdir='CsPad:
         txt +='\n' + (level+1)*'    ' + file
 
         path_to_child = os.path.join(path, file)
-        if os.path.isdir(path_to_child): txt += get_text_content_of_calib_dir_for_detector(path_to_child, det, subdir, level=level+1, calib_type=calib_type)
+        if ctm.isdir(path_to_child): txt += get_text_content_of_calib_dir_for_detector(path_to_child, det, subdir, level=level+1, calib_type=calib_type)
 
     return txt
 
@@ -721,16 +715,18 @@ def get_array_from_file(fname, dtype=np.float32):
         print('Get array from file: %s' % fname)
 
         if fname_ext == '.npy':
-            return np.load(fname) # load as binary
+            return np.load(fname, mmap_mode='c') # load as binary, memory-mapped copy-on-write
         else:
-            return np.loadtxt(fname, dtype=dtype)
+            return ntl.load_txt(fname, dtype=dtype) # parsed once, then memory-mapped from .npy sidecar
     else:
         logger.warning(fname + ' is not available')
         return None
 
 
-def get_image_array_from_file(fname, dtype=np.float32):
-
+def get_image_array_from_file(fname, dtype=np.float32, gfname=None):
+    """Returns image for array from file, data-shaped array is reconstructed using geometry file gfname
+       (pixel arrays cached per content of geometry file) if it is specified and matches the array size.
+    """
     arr = get_array_from_file(fname, dtype)
     if arr is None:
         logger.warning('None is loaded from file %s' % fname)
@@ -738,7 +734,17 @@ def get_image_array_from_file(fname, dtype=np.float32):
 
     img_arr = None
 
-    if   arr.size == 32*185*388: # CSPAD
+    geo = None
+    if gfname and os.path.exists(gfname):
+        try:
+            geo = gc.geometry(gfname)
+        except Exception as err:
+            logger.warning('Geometry from file %s is not available: %s' % (gfname, err))
+
+    if geo is not None and arr.size == geo.index.size:
+        img_arr = geo.reconstruct(arr)
+
+    elif arr.size == 32*185*388: # CSPAD
         arr.shape = (32*185,388)
         img_arr = cspadimg.get_cspad_raw_data_array_image(arr)
 
@@ -0,0 +1,201 @@
+"""Module HistStats - histogram statistics for PlotImgSpeWidget and histogram plots of command line apps.
+
+CumulativeHistogram is built once per array as fine-binned cumulative distribution,
+histogram for any bins or range (zmin, zmax), including log bins, is derived from it
+by interpolation at bin edges in O(bins) without access to the array.
+Bins narrower than the fine bin, e.g. for zoomed range of integer data with outliers,
+are counted exactly by np.histogram of the array, as interpolation would spread counts over them.
+proc_stat evaluates moments of histogram with vectorized bin centers,
+add_stat_text and hist1d draw histogram with statistics on matplotlib axes.
+
+Usage::
+
+    from CalibManager.HistStats import CumulativeHistogram, proc_stat, add_stat_text, hist1d
+
+    ch = CumulativeHistogram(arr)             # once per array
+    ch = CumulativeHistogram(sample, weight=scale, vrange=(vmin, vmax)) # for sample of array with exact min and max
+    counts, edges = ch.histogram(bins=100)    # full range
+    counts, edges = ch.histogram(bins=100, range=(zmin, zmax))
+    counts = ch.counts(np.logspace(0, 4, 101))
+    mean, rms, err_mean, err_rms, neff, skew, kurt, err_err, sum_w = proc_stat(counts, edges)
+
+    fig, axhi, hi = hist1d(arr, bins=100, amp_range=(-2,2), title='Segment tilt') # with statistics box
+
+This software was developed for the LCLS project.
+If you use all or part of it, please give an appropriate acknowledgment.
+"""
+
+from math import log10, sqrt
+
+import numpy as np
+
+
+NBINS_FINE = 1<<14 # number of bins in cumulative histogram
+
+
+class CumulativeHistogram(object):
+    """Fine-binned cumulative distribution of array values, non-finite values are ignored"""
+
+    def __init__(self, arr, nbins_fine=NBINS_FINE, weight=1., vrange=None):
+        """@param weight - weight of each entry, e.g. to scale sampled array to the number of entries in original array
+           @param vrange - exact (vmin, vmax) of original array if arr is its sample, default - min and max of arr
+        """
+        a = np.asarray(arr).ravel()
+        if a.size and not np.isfinite(a).all(): a = a[np.isfinite(a)]
+        self.sample, self.weight = a, weight
+        if vrange is not None: self.vmin, self.vmax = float(vrange[0]), float(vrange[1])
+        else: self.vmin, self.vmax = (float(a.min()), float(a.max())) if a.size else (0., 0.)
+        lo, hi = self.range()
+        counts, self.edges = np.histogram(a, bins=nbins_fine, range=(lo, hi))
+        self.width_fine = (hi-lo)/nbins_fine
+        self.cumsum = np.zeros(nbins_fine+1)
+        np.cumsum(counts*weight, out=self.cumsum[1:])
+        self.sum_w = self.cumsum[-1]
+
+
+    def range(self):
+        """Returns default histogram range as for np.histogram"""
+        return (self.vmin-0.5, self.vmax+0.5) if self.vmin == self.vmax else (self.vmin, self.vmax)
+
+
+    def counts(self, edges):
+        """Returns counts for bins with edges, values out of edges are not counted,
+           bins narrower than the fine bin are counted exactly from the array.
+        """
+        edges = np.asarray(edges, dtype=np.float64)
+        if edges.size > 1 and np.diff(edges).min() < self.width_fine:
+            return np.histogram(self.sample, bins=edges)[0]*self.weight
+        return np.diff(np.interp(edges, self.edges, self.cumsum))
+
+
+    def histogram(self, bins=100, range=None):
+        """Returns (counts, edges) as np.histogram, bins - number of bins or array of edges"""
+        if np.ndim(bins) == 0:
+            lo, hi = self.range() if range is None else range
+            edges = np.linspace(lo, hi, int(bins)+1)
+        else:
+            edges = np.asarray(bins, dtype=np.float64)
+        return self.counts(edges), edges
+
+
+def bin_centers(bins, nbins=None):
+    bins = np.asarray(bins, dtype=np.float64)
+    center = 0.5*(bins[:-1] + bins[1:])
+    return center if nbins is None else center[:nbins]
+
+
+def proc_stat(weights, bins):
+    """Returns mean, rms, err_mean, err_rms, neff, skew, kurt, err_err, sum_w of histogram"""
+    weights = np.asarray(weights, dtype=np.float64)
+    center = bin_centers(bins, weights.size)
+
+    sum_w  = weights.sum()
+    if sum_w <= 0: return  0, 0, 0, 0, 0, 0, 0, 0, 0
+
+    sum_w2 = np.dot(weights, weights)
+    neff   = sum_w*sum_w/sum_w2 if sum_w2>0 else 0
+    mean   = np.dot(weights, center)/sum_w
+    d      = center - mean
+    wd2    = weights*d*d
+    m2     = wd2.sum() / sum_w
+    m3     = np.dot(wd2, d) / sum_w
+    m4     = np.dot(wd2, d*d) / sum_w
+
+    rms  = sqrt(m2) if m2>0 else 0
+    rms2 = m2
+
+    err_mean = rms/sqrt(neff)
+    err_rms  = err_mean/sqrt(2)
+
+    skew, kurt, var_4 = 0, 0, 0
+
+    if rms>0 and rms2>0:
+        skew  = m3/(rms2 * rms)
+        kurt  = m4/(rms2 * rms2) - 3
+        var_4 = (m4 - rms2*rms2*(neff-3)/(neff-1))/neff if neff>1 else 0
+    err_err = sqrt(sqrt(var_4)) if var_4>0 else 0
+    return mean, rms, err_mean, err_rms, neff, skew, kurt, err_err, sum_w
+
+
+def add_stat_text(axhi, weights, bins, fmt='Mean=%.6f%s%.6f\nRMS=%.6f%s%.6f\n'):
+    """Draws box with histogram statistics in the right top corner of axes"""
+    mean, rms, err_mean, err_rms, neff, skew, kurt, err_err, sum_w = proc_stat(weights,bins)
+    pm = r'$\pm$'
+    txt = 'Entries=%d\n' % sum_w\
+        + fmt % (mean, pm, err_mean, rms, pm, err_rms)\
+        + r'$\gamma1$=%.3f  $\gamma2$=%.3f' % (skew, kurt)
+    xb,xe = axhi.get_xlim()
+    yb,ye = axhi.get_ylim()
+    x = xb + (xe-xb)*0.98
+    y = yb + (ye-yb)*0.95
+
+    if axhi.get_yscale() == 'log':
+        log_yb, log_ye = log10(yb), log10(ye)
+        log_y = log_yb + (log_ye-log_yb)*0.95
+        y = 10**log_y
+
+    axhi.text(x, y, txt, fontsize=10, color='k',
+              horizontalalignment='right',
+              verticalalignment='top',
+              rotation=0)
+
+
+def hist1d(arr, bins=None, amp_range=None, weights=None, color=None, show_stat=True, log=False, \
+           figsize=(6,5), axwin=(0.15, 0.12, 0.78, 0.80), \
+           title=None, xlabel=None, ylabel=None, titwin=None, fmt='Mean=%.2f%s%.2f\nRMS=%.2f%s%.2f\n'):
+    """Makes historgam from input array of values (arr), which are sorted in number of bins (bins) in the range (amp_range=(amin,amax))
+    """
+    import matplotlib.pyplot as plt
+    if arr.size==0: return None, None, None
+    fig = plt.figure(figsize=figsize, dpi=80, facecolor='w', edgecolor='w', frameon=True)
+    wtitle = titwin if titwin is not None else title
+    if wtitle is not None and fig.canvas.manager is not None: fig.canvas.manager.set_window_title(wtitle)
+    axhi = fig.add_axes(axwin)
+    hbins = bins if bins is not None else 100
+    hi = axhi.hist(arr.flatten(), bins=hbins, range=amp_range, weights=weights, color=color, log=log)
+    if amp_range is not None: axhi.set_xlim(amp_range) # suppress autoscailing
+    if title  is not None: axhi.set_title(title, color='k', fontsize=20)
+    if xlabel is not None: axhi.set_xlabel(xlabel, fontsize=14)
+    if ylabel is not None: axhi.set_ylabel(ylabel, fontsize=14)
+    if show_stat:
+        weights, bins, patches = hi
+        add_stat_text(axhi, weights, bins, fmt)
+    return fig, axhi, hi
+
+
+if __name__ == "__main__":
+    import sys
+    from time import time
+
+    arr = (np.random.standard_normal(4<<20)*25 + 200).astype(np.float32)
+    arr[:10] = np.nan
+
+    t0 = time()
+    ch = CumulativeHistogram(arr)
+    t1 = time()
+    counts, edges = ch.histogram(100, range=(150, 250))
+    stat = proc_stat(counts, edges)
+    t2 = time()
+    ref, ref_edges = np.histogram(arr[np.isfinite(arr)], bins=100, range=(150, 250))
+    t3 = time()
+    print('cumulative histogram of %d entries: %.3f sec, histogram and stat from it: %.6f sec, np.histogram: %.3f sec'%\
+          (arr.size, t1-t0, t2-t1, t3-t2))
+    print('max relative deviation of counts from np.histogram: %.4f' % (np.abs(counts-ref).max()/ref.max()))
+    print('mean %.3f rms %.3f skew %.3f kurt %.3f entries %d' % (stat[0], stat[1], stat[5], stat[6], stat[8]))
+    print('full range entries: %d, log bins entries: %d' % (ch.histogram(100)[0].sum(), ch.counts(np.logspace(2, 3, 51)).sum()))
+
+    # integer data with saturated pixels, zoomed range is narrower than the fine bin
+    adu = np.concatenate((np.rint(np.random.standard_normal(1<<16)*3 + 1000), [65535, 65535, 65535]))
+    ch = CumulativeHistogram(adu)
+    counts, edges = ch.histogram(40, range=(990, 1010))
+    ref, ref_edges = np.histogram(adu, bins=40, range=(990, 1010))
+    print('zoomed range of ADU data: counts are exact: %s, rms %.3f of exact %.3f' %\
+          (np.array_equal(counts, ref), proc_stat(counts, edges)[1], proc_stat(ref, ref_edges)[1]))
+    assert np.array_equal(counts, ref)
+
+    t0 = time()
+    for i in range(1000): proc_stat(counts, edges)
+    print('proc_stat: %.1f us' % ((time()-t0)*1e3))
+    sys.exit('End of test')
+
+# EOF
@@ -0,0 +1,230 @@
+"""MultiRunCalib - multi-run mode of the dark run processing CLI
+
+Run string like '2,4-7' is expanded to the list of runs [2,4,5,6,7].
+Each run is processed (scan and average) by a separate calibrun subprocess,
+subprocesses are executed concurrently through the BatchExecutor ('local' pool of nworkers or 'lsf').
+Runs which are not submitted, lost by the scheduler, failed or not finished in --timeout sec are failed.
+Constants of successfully processed runs are deployed in run order with validity ranges
+bounded by the next processed run, e.g. 2-3, 4-4, 5-5, 6-6, 7-end.
+Consolidated timing/summary report is logged and saved next to the log file.
+
+Usage ::
+
+    calibrun -e xpptut15 -d CSPAD -r 2,4-7 -P -D --multirun -j 8
+    calibrun -e xpptut15 -d CSPAD -r 2,4-7 -P -D --multirun --executor lsf
+
+This software was developed for the LCLS project.
+If you use all or part of it, please give an appropriate acknowledgment.
+
+@author Mikhail Dubrovin
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import sys
+import shlex
+from time import time, sleep
+
+from CalibManager.BatchExecutor import get_executor
+from CalibManager.SubprocSupervisor import run_in_log
+
+#------------------------------
+
+# (kwargs key, calibrun option) pairs passed from the parent to each run subprocess
+list_of_calibrun_options = (
+    ('exp',         '--exp'),
+    ('dsnamex',     '--dsnamex'),
+    ('detector',    '--detector'),
+    ('event_code',  '--event_code'),
+    ('workdir',     '--workdir'),
+    ('calibdir',    '--calibdir'),
+    ('num_events',  '--num_events'),
+    ('skip_events', '--skip_events'),
+    ('scan_events', '--scan_events'),
+    ('thr_int_min', '--thr_int_min'),
+    ('thr_int_max', '--thr_int_max'),
+    ('thr_rms_min', '--thr_rms_min'),
+    ('thr_rms_max', '--thr_rms_max'),
+    ('intnlo',      '--intnlo'),
+    ('intnhi',      '--intnhi'),
+    ('rmsnlo',      '--rmsnlo'),
+    ('rmsnhi',      '--rmsnhi'),
+    ('dirmode',     '--dirmode'),
+    ('filemode',    '--filemode'),
+    ('group',       '--group'),
+    ('nrecs1',      '--nrecs1'),
+    ('loglev',      '--loglev'),
+    ('nshards',     '--nshards'),
+    ('executor',    '--executor'),
+    ('queue',       '--queue'),
+)
+
+list_of_calibrun_flags = ('zeropeds', 'deploygeo', 'noresume', 'dryrun')
+
+def expand_run_list(str_runs):
+    """Returns sorted list of unique run numbers for string like '2,4-7' -> [2,4,5,6,7]"""
+    runs = set()
+    for field in str_runs.split(','):
+        field = field.strip()
+        if not field: continue
+        if '-' in field:
+            begin, end = field.split('-', 1)
+            runs.update(range(int(begin), int(end)+1))
+        else:
+            runs.add(int(field))
+    return sorted(runs)
+
+def validity_ranges_for_runs(runs, runrange=None):
+    """Returns list of validity range strings for sorted runs,
+       each range ends before the next run, the last one ends at 'end' or at the end of runrange,
+       the first one begins at the beginning of runrange if specified.
+    """
+    begin0, end_last = (runs[0], 'end') if runrange is None else runrange.split('-', 1)
+    ranges = []
+    for i, run in enumerate(runs):
+        begin = int(begin0) if i == 0 else run
+        end = str(runs[i+1]-1) if i+1 < len(runs) else end_last
+        ranges.append('%d-%s' % (begin, end))
+    return ranges
+
+def calibrun_command(kwa, run, process=False, deploy=False, runrange=None):
+    """Returns list of arguments of calibrun command for single run"""
+    scrpath = kwa.get('scrpath') or 'calibrun'
+    cmd = [sys.executable, scrpath] if os.path.exists(scrpath) else [scrpath]
+    cmd += ['--run', str(run), '--logtag', '_r%04d' % run]
+    for key, opt in list_of_calibrun_options:
+        v = kwa.get(key)
+        if v is not None: cmd += [opt, str(v)]
+    cmd += ['--%s' % key for key in list_of_calibrun_flags if kwa.get(key)]
+    if process : cmd.append('--process')
+    if deploy  : cmd += ['--deploy', '--deployonly', '--runrange', runrange]
+    return cmd
+
+#------------------------------
+
+class RunRecord():
+    """Processing and deployment status of a single run"""
+    def __init__(self, run):
+        self.run = run
+        self.job_id = None
+        self.status = None
+        self.log = None
+        self.t_sub = None
+        self.t_run = None
+        self.t_end = None
+        self.runrange = None
+        self.deploy_rc = None
+        self.deploy_sec = None
+
+    def proc_sec(self):
+        if self.t_end is None: return None
+        return self.t_end - (self.t_run if self.t_run is not None else self.t_sub)
+
+
+class MultiRunCalib():
+    """Processes dark runs concurrently and deploys constants in run order"""
+    sep = '\n' + 30*'-' + '\n'
+
+    def __init__(self, **kwa):
+        self.kwa = kwa
+        if kwa['run'] is None: sys.exit('MISSING PARAMETER --run or -r NEEDS TO BE SPECIFIED')
+        dsnamex = kwa.get('dsnamex')
+        if dsnamex is not None and dsnamex[0] != ':':
+            sys.exit('EXIT - multi-run mode can not be used with xtc file in --dsnamex')
+
+        self.runs = expand_run_list(kwa['run'])
+        self.records = [RunRecord(run) for run in self.runs]
+        self.logbase = kwa['logname'].rsplit('.', 1)[0]
+        self.t0 = time()
+        self.t_proc = self.t_deploy = 0
+
+        logger.info(self.sep + 'Multi-run mode for runs: %s' % ' '.join(str(r) for r in self.runs))
+
+        if kwa['process']: self.process_runs()
+        if kwa['deploy']: self.deploy_runs()
+        self.print_summary()
+
+    def process_runs(self):
+        t0 = time()
+        queue = self.kwa.get('queue') or 'psanaq'
+        ex = get_executor(self.kwa.get('executor') or 'local', ncores=self.kwa.get('nworkers'))
+        logger.info('Process %d runs using executor "%s"' % (len(self.runs), ex.name))
+
+        for rec in self.records:
+            rec.log = '%s_r%04d_proc.txt' % (self.logbase, rec.run)
+            command = ' '.join(shlex.quote(s) for s in calibrun_command(self.kwa, rec.run, process=True))
+            rec.job_id, out, err = ex.submit(command, queue, rec.log)
+            rec.t_sub = time()
+            if ex.is_lost(rec.job_id):
+                rec.status = 'FAILED'
+                logger.warning('run %4d is not submitted: %s' % (rec.run, err or out))
+            else:
+                logger.info('run %4d submitted, job id: %s' % (rec.run, rec.job_id))
+
+        timeout_sec = self.kwa.get('timeout') or None
+        outstanding = [rec for rec in self.records if rec.status is None]
+        while outstanding:
+            sleep(1)
+            for rec in list(outstanding):
+                status = ex.status(rec.job_id)
+                if status is None and ex.is_lost(rec.job_id): status = 'LOST' # not found by scheduler any more
+                if status == rec.status: continue
+                rec.status = status
+                if status == 'RUN' and rec.t_run is None: rec.t_run = time()
+                if status in ('DONE', 'EXIT', 'LOST'):
+                    rec.t_end = time()
+                    outstanding.remove(rec)
+                    logger.info('run %4d processing %s in %.1f sec, %d runs remaining'%\
+                                (rec.run, status, rec.proc_sec(), len(outstanding)))
+            if outstanding and timeout_sec is not None and time() - t0 > timeout_sec:
+                for rec in outstanding:
+                    ex.kill(rec.job_id)
+                    rec.status, rec.t_end = 'TIMEOUT', time()
+                logger.warning('processing timeout %d sec is expired, jobs of runs %s are killed'%\
+                               (timeout_sec, ' '.join(str(rec.run) for rec in outstanding)))
+                outstanding = []
+        self.t_proc = time() - t0
+
+    def deploy_runs(self):
+        """Deploys constants of successfully processed runs sequentially in run order"""
+        t0 = time()
+        recs = [rec for rec in self.records if rec.status == 'DONE' or not self.kwa['process']] # failed runs are not deployed
+        if not recs:
+            logger.warning('Nothing to deploy - no run is processed successfully')
+            return
+        for rec, runrange in zip(recs, validity_ranges_for_runs([rec.run for rec in recs], self.kwa.get('runrange'))):
+            rec.runrange = runrange
+            log = '%s_r%04d_deploy.txt' % (self.logbase, rec.run)
+            t1 = time()
+            rec.deploy_rc, err = run_in_log(calibrun_command(self.kwa, rec.run, deploy=True, runrange=runrange), log, tmax_sec=None)
+            rec.deploy_sec = time() - t1
+            if err: logger.warning('run %4d deployment for range %s: %s' % (rec.run, runrange, err))
+            else  : logger.info('run %4d deployed for range %s in %.1f sec' % (rec.run, runrange, rec.deploy_sec))
+        self.t_deploy = time() - t0
+
+    def summary(self):
+        fmt = '%6s  %-12s  %-8s  %9s  %-8s  %9s  %s'
+        lines = [fmt % ('run', 'range', 'process', 'proc_sec', 'deploy', 'depl_sec', 'process log')]
+        sum_proc = 0
+        for rec in self.records:
+            proc_sec = rec.proc_sec()
+            if proc_sec is not None: sum_proc += proc_sec
+            deploy = 'N/A' if rec.deploy_rc is None else ('OK' if rec.deploy_rc == 0 else 'FAILED')
+            lines.append(fmt % (rec.run, rec.runrange or 'N/A', rec.status or 'N/A',\
+                                'N/A' if proc_sec is None else '%.1f' % proc_sec, deploy,\
+                                'N/A' if rec.deploy_sec is None else '%.1f' % rec.deploy_sec, rec.log or ''))
+        t_total = time() - self.t0
+        lines.append('processing wall time: %.1f sec, sum over runs: %.1f sec, speedup: %.2f'%\
+                     (self.t_proc, sum_proc, sum_proc/self.t_proc if self.t_proc else 0))
+        lines.append('deployment wall time: %.1f sec, total wall time: %.1f sec' % (self.t_deploy, t_total))
+        return '\n'.join(lines)
+
+    def print_summary(self):
+        s = self.summary()
+        logger.info(self.sep + 'Multi-run summary:\n' + s)
+        fname = '%s_multirun_summary.txt' % self.logbase
+        with open(fname, 'w') as f: f.write(s + '\n')
+        logger.info('Summary is saved in %s' % fname)
+
+# EOF
@@ -0,0 +1,260 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module NDArrTextLoader
+#
+#------------------------------------------------------------------------
+
+"""NDArrTextLoader - fast loader of numeric ndarray text files with binary sidecar cache
+
+Text files of calibration constants (pedestals, rms, masks, ROI images, ...) have whitespace-delimited numbers
+with optional comment lines beginning with '#'. np.loadtxt of numpy < 1.23 parses them in python per token,
+which takes tens of seconds for CSPAD-size arrays. For old numpy this loader reads file in large chunks
+split at line boundaries, each chunk is tokenized and converted by numpy in C (np.fromstring with separator);
+newer numpy has C implementation of np.loadtxt, which is used directly.
+Shape is defined as in np.loadtxt (rows x columns, squeezed for single row or column),
+or by the metadata comments of PSCalib.NDArrIO.save_txt ('# NDIM n', '# DIM:i n', '# DTYPE t') if they are present.
+Text which can not be parsed by fast tokenizer is loaded by np.loadtxt.
+
+Parsed array is saved in .npy sidecar file in the user cache directory (~/.cache/CalibManager/ndarr)
+with name keyed by the path, size, and mtime of the text file and dtype; next load of unchanged file
+memory-maps the sidecar (copy-on-write, so callers may modify the returned array).
+Sidecars of the previous versions of the same file are removed. Total size of sidecars is limited by max_bytes_cache,
+least recently used sidecars are removed at save (mtime of sidecar is updated at each load).
+
+Usage ::
+
+    from CalibManager.NDArrTextLoader import load_txt, evict_cache
+
+    arr = load_txt('/reg/d/psdm/CXI/cxitut13/calib/CsPad::CalibV1/CxiDs1.0:Cspad.0/pedestals/1-end.data', dtype=np.float32)
+    arr = load_txt('./roi-mask.txt', dtype=np.uint16, cache_dir=None)   # no sidecar cache
+    arr = load_txt('./clb-peds-ave.txt')   # dtype from metadata or float64 as np.loadtxt
+    evict_cache(DIR_CACHE_DEFAULT, max_bytes=0)   # removes all sidecars
+
+    # benchmark on CSPAD-size array:
+    python -m CalibManager.NDArrTextLoader
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import glob
+import hashlib
+import warnings
+
+import numpy as np
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+DIR_CACHE_DEFAULT = os.path.join(os.path.expanduser('~'), '.cache', 'CalibManager', 'ndarr')
+MAX_BYTES_CACHE = 2<<30 # limit of total size of sidecars in cache directory
+
+LOADTXT_IN_C = tuple(int(v) for v in np.__version__.split('.')[:2]) >= (1, 23)
+
+#------------------------------
+
+def path_prefix_cache(fname, cache_dir=DIR_CACHE_DEFAULT) :
+    """Returns prefix of sidecar names for file, the same for all versions of file"""
+    return os.path.join(cache_dir, hashlib.sha1(os.path.abspath(fname).encode()).hexdigest()[:20])
+
+def path_to_cache(fname, dtype, cache_dir=DIR_CACHE_DEFAULT) :
+    """Returns path to .npy sidecar for current size and mtime of file fname and dtype (None - dtype from metadata)"""
+    st = os.stat(fname)
+    sdtype = 'auto' if dtype is None else np.dtype(dtype).str.strip('<>|=')
+    return '%s-%d-%d-%s.npy' % (path_prefix_cache(fname, cache_dir), st.st_size, st.st_mtime_ns, sdtype)
+
+def _metadata(comments) :
+    """Returns (shape, dtype) from NDArrIO metadata comments, None for missing values"""
+    d = {}
+    for line in comments :
+        fields = line.lstrip('#').split()
+        if len(fields) == 2 : d[fields[0]] = fields[1]
+    ndim = d.get('NDIM')
+    shape = None
+    if ndim is not None and ndim.isdigit() :
+        dims = [d.get('DIM:%d' % i) for i in range(int(ndim))]
+        if all(v is not None and v.isdigit() for v in dims) : shape = tuple(int(v) for v in dims)
+    dtype = None
+    if 'DTYPE' in d :
+        try :
+            dtype = np.dtype(d['DTYPE'])
+        except TypeError :
+            pass
+    return shape, dtype
+
+def read_header(fname, maxlines=100) :
+    """Returns list of leading comment lines of text file"""
+    comments = []
+    with open(fname, 'rb') as f :
+        for line in f :
+            line = line.strip()
+            if not line : continue
+            if not line.startswith(b'#') or len(comments) >= maxlines : break
+            comments.append(line.decode(errors='replace'))
+    return comments
+
+def parse_txt(fname, chunk_size=1<<24) :
+    """Parses text file in chunks, returns float64 ndarray of shape as np.loadtxt,
+       raises ValueError if text can not be parsed by fast tokenizer.
+    """
+    chunks = []
+    nrows = 0
+    ncols = None
+    tail = b''
+    with open(fname, 'rb') as f :
+        while True :
+            block = f.read(chunk_size)
+            data = tail + block
+            if block :
+                i = data.rfind(b'\n')
+                data, tail = (data[:i+1], data[i+1:]) if i >= 0 else (b'', data)
+            if b'#' in data : # rare: comment lines are removed
+                data = b'\n'.join(l for l in data.split(b'\n') if not l.lstrip().startswith(b'#'))
+            if data.strip() :
+                if ncols is None : ncols = len(data.lstrip().split(b'\n', 1)[0].split())
+                nrows += sum(1 for l in data.split(b'\n') if l.strip()) if b'\n\n' in data or b'\n \n' in data else\
+                         data.strip().count(b'\n') + 1
+                with warnings.catch_warnings() :
+                    warnings.simplefilter('error') # incomplete parsing is reported by DeprecationWarning in old numpy
+                    try :
+                        chunks.append(np.fromstring(data, dtype=np.float64, sep=' '))
+                    except (DeprecationWarning, ValueError) as err :
+                        raise ValueError('fast tokenizer can not parse %s: %s' % (fname, err))
+            if not block : break
+
+    arr = np.concatenate(chunks) if chunks else np.empty((0,), dtype=np.float64)
+    if nrows == 0 : return arr
+    if arr.size != nrows * ncols : raise ValueError('rows of %s have different number of columns' % fname)
+    arr.shape = (nrows, ncols)
+    return arr.ravel() if nrows == 1 or ncols == 1 else arr # as np.loadtxt
+
+def _load(fname, dtype=None) :
+    """Returns ndarray parsed from text file, shape and dtype are taken from metadata if not specified"""
+    shape, dtype_meta = _metadata(read_header(fname))
+    if dtype is None : dtype = dtype_meta if dtype_meta is not None else np.float64
+    arr = None
+    if not LOADTXT_IN_C :
+        try :
+            arr = parse_txt(fname)
+        except ValueError as err :
+            logger.debug('%s, use np.loadtxt' % err, __name__)
+    if arr is None : arr = np.loadtxt(fname, dtype=np.float64)
+    if shape is not None and int(np.prod(shape)) == arr.size : arr = arr.reshape(shape)
+    return arr.astype(dtype, copy=False)
+
+def evict_cache(cache_dir, max_bytes=MAX_BYTES_CACHE, keep=None) :
+    """Removes least recently used sidecars (by mtime) while their total size exceeds max_bytes, returns number of removed files"""
+    entries = []
+    for p in glob.glob(os.path.join(cache_dir, '*.npy')) :
+        try :
+            st = os.stat(p)
+        except OSError : # removed by other process
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    total = sum(size for t, size, p in entries)
+    nremoved = 0
+    for t, size, p in sorted(entries) :
+        if total <= max_bytes : break
+        if p == keep : continue
+        try :
+            os.remove(p)
+            nremoved += 1
+        except OSError :
+            pass
+        total -= size
+    if nremoved : logger.debug('%d sidecar(s) are removed from cache %s' % (nremoved, cache_dir), __name__)
+    return nremoved
+
+def _save_cache(arr, fname, dtype, cache_dir, max_bytes_cache=MAX_BYTES_CACHE) :
+    """Saves sidecar atomically, removes sidecars of previous versions of file and least recently used sidecars over the limit"""
+    path = path_to_cache(fname, dtype, cache_dir)
+    try :
+        if not os.path.exists(cache_dir) : os.makedirs(cache_dir)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f : np.save(f, arr)
+        os.replace(tmp, path)
+        version = path.rsplit('-', 1)[0] + '-' # prefix-size-mtime-
+        for p in glob.glob(path_prefix_cache(fname, cache_dir) + '-*.npy') :
+            if not p.startswith(version) : os.remove(p)
+        evict_cache(cache_dir, max_bytes_cache, keep=path)
+    except OSError as err :
+        logger.debug('sidecar cache for %s is not saved: %s' % (fname, err), __name__)
+
+def load_txt(fname, dtype=None, cache_dir=DIR_CACHE_DEFAULT, min_size_cache=1<<20, max_bytes_cache=MAX_BYTES_CACHE) :
+    """Returns ndarray from text file, using sidecar cache for files larger than min_size_cache bytes.
+       @param dtype - dtype of returned array, None - from metadata or float64
+       @param cache_dir - directory for .npy sidecar files, None - cache is not used
+       @param max_bytes_cache - limit of total size of sidecars in cache_dir
+    """
+    use_cache = cache_dir is not None and os.path.getsize(fname) >= min_size_cache
+    if use_cache :
+        path = path_to_cache(fname, dtype, cache_dir)
+        if os.path.exists(path) :
+            try :
+                arr = np.load(path, mmap_mode='c')
+                os.utime(path) # recently used
+                return arr
+            except (OSError, ValueError) as err :
+                logger.debug('sidecar cache %s is ignored: %s' % (path, err), __name__)
+    arr = _load(fname, dtype)
+    if use_cache : _save_cache(arr, fname, dtype, cache_dir, max_bytes_cache)
+    return arr
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    from time import time
+
+    d = tempfile.mkdtemp()
+    cache_dir = os.path.join(d, 'cache')
+    fname = os.path.join(d, 'peds.txt')
+    a = (np.random.standard_normal((32*185, 388))*10 + 1000).astype(np.float32)
+    np.savetxt(fname, a, fmt='%.3f', header='DTYPE float32\nNDIM 3\nDIM:0 32\nDIM:1 185\nDIM:2 388')
+    print('file %s size %.1f MB' % (fname, os.path.getsize(fname)/1e6))
+
+    t0 = time(); b = np.loadtxt(fname, dtype=np.float32);              t1 = time()
+    c = load_txt(fname, dtype=np.float32, cache_dir=cache_dir);       t2 = time()
+    e = load_txt(fname, dtype=np.float32, cache_dir=cache_dir);       t3 = time()
+    p = parse_txt(fname);                                             t4 = time()
+    print('np.loadtxt: %.3f sec, load_txt: %.3f sec, sidecar mmap: %.4f sec, chunked parser: %.3f sec, loadtxt in C: %s'%\
+          (t1-t0, t2-t1, t3-t2, t4-t3, LOADTXT_IN_C))
+    print('shapes: %s %s %s, identical: %s %s, memmap: %s' % (b.shape, c.shape, e.shape,\
+          np.array_equal(b.ravel(), c.ravel()), np.array_equal(c, e), isinstance(e, np.memmap)))
+    e[0,0,0] = 0 # copy-on-write
+
+    fname2 = os.path.join(d, 'rms.txt')
+    np.savetxt(fname2, a[:4000], fmt='%.3f')
+    os.utime(path_to_cache(fname, np.float32, cache_dir), (t0-10, t0-10)) # first sidecar is least recently used
+    load_txt(fname2, dtype=np.float32, cache_dir=cache_dir, max_bytes_cache=a.nbytes)
+    print('cache limited to %d bytes, sidecars: %s' % (a.nbytes, sorted(os.path.basename(p)[:20] == os.path.basename(path_prefix_cache(fname2, cache_dir))\
+          for p in glob.glob(os.path.join(cache_dir, '*.npy')))))
+
+    for txt in ('1 2 3\n4 5 6\n', '1\n2\n3\n', '1 2 3\n', '# comment\n1 2\n\n3 4\n', '1 2\n3\n', '1 2 x\n') :
+        p = os.path.join(d, 'small.txt')
+        with open(p, 'w') as f : f.write(txt)
+        try :
+            ref = repr(np.loadtxt(p))
+        except ValueError as err :
+            ref = 'ValueError'
+        try :
+            res = repr(parse_txt(p))
+        except ValueError as err :
+            res = 'ValueError'
+        print('%-28s loadtxt: %-40s parse_txt: %s' % (repr(txt), ref.replace('\n', ''), res.replace('\n', '')))
+    sys.exit('End of test')
+
+#------------------------------
@@ -0,0 +1,538 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module PedestalEngine
+#
+#------------------------------------------------------------------------
+
+"""PedestalEngine - in-process streaming evaluation of pedestals, rms and pixel_status for dark runs
+
+Pure-NumPy alternative to the det_ndarr_raw_proc subprocess. Frames are consumed from any iterator
+of ndarrays in one pass, they are accumulated in blocks of block_size events; per-pixel
+count, sum and sum of squares of intensities within the gate, min, max,
+and counts of intensities below int_lo / above int_hi are kept in float64/int64 arrays.
+Two-stage gating as in det_ndarr_raw_proc (--nrecs1): for nrecs1 > 0 the per-pixel gate is evaluated
+on the first nrecs1 frames (stage 1, see gate_of_stage1) as median -/+ intnlo/intnhi times the spread
+of intensities limited by [int_lo, int_hi], then all frames including the first nrecs1 are accumulated
+within this gate (stage 2); for nrecs1 = 0 the gate is [int_lo, int_hi] for all pixels.
+The gate is saved with partial accumulators, partials are merged only for the same gate;
+accumulate_from_psana evaluates it on the first nrecs1 selected events of the whole event range,
+so event-range shards use the same gate as a single pass.
+Sums of integer ADC values are exact in float64, so results do not depend on block size or event order.
+Partial accumulators can be saved and merged, accumulate_from_psana saves them as checkpoints
+every nevts_ckpt events and resumes accumulation from the last checkpoint.
+Events can be selected by EVR codes as by option -c of det_ndarr_raw_proc: comma separated codes,
+event is selected if it has any of positive codes (OR) and none of negative codes (veto);
+events evskip <= i < events are counted by index in dataset before selection.
+Datasets exp=...:run=... are read in indexed mode (:idx), events of range are accessed by time stamps
+without reading preceding events, so event-range shards read only their own data; xtc files are read sequentially.
+
+Pixel status bits, thresholds are the same as options of det_ndarr_raw_proc (and cp.mask_*):
+    1 - rms > rms_max (hot),        rms_max = min(ave(rms) + rmsnhi*std(rms), rms_hi)
+    2 - rms < rms_min (cold),       rms_min = max(ave(rms) - rmsnlo*std(rms), rms_lo)
+    4 - fraction of events with intensity > int_hi exceeds fraclm (saturated)
+    8 - fraction of events with intensity < int_lo exceeds fraclm (dead)
+   16 - ave > ave_max,              ave_max = min(ave(ave) + intnhi*std(ave), int_hi)
+   32 - ave < ave_min,              ave_min = max(ave(ave) - intnlo*std(ave), int_lo)
+Non-positive number of sigmas turns off the statistical limit and the absolute threshold is used.
+
+Usage ::
+
+    from CalibManager.PedestalEngine import PedestalEngine, frames_from_psana
+
+    pe = PedestalEngine(int_lo=0.1, int_hi=16000, rms_lo=0.1, rms_hi=10000, intnlo=5, intnhi=5, rmsnlo=5, rmsnhi=5, nrecs1=50)
+    pe.process(frames_from_psana('exp=xpptut15:run=54', 'XppGon.0:Cspad.0', events=1000))
+    d = pe.constants()   # {'ave':..., 'rms':..., 'sta':..., 'msk':..., 'max':..., 'min':...}
+    pe.save('./work/clb-#exp-#run-peds-#type-#src.txt', 'xpptut15', 54, 'XppGon.0:Cspad.0')
+
+    engines = accumulate_from_psana('exp=xpptut15:run=54', ['XppGon.0:Cspad.0'], events=1000, pars=dict(int_lo=0.1, int_hi=16000),\
+                                    fnames_ckpt=['./work/clb-xpptut15-r0054-peds-ckpt-XppGon.0:Cspad.0.npz'], nevts_ckpt=500,\
+                                    evcodes='40,-162')
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+from itertools import islice
+import numpy as np
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+dict_of_type_formats = {'ave' : '%.3f',
+                        'rms' : '%.3f',
+                        'sta' : '%d',
+                        'msk' : '%d',
+                        'max' : '%d',
+                        'min' : '%d'}
+
+list_of_types = ['ave', 'rms', 'sta', 'msk', 'max', 'min']
+
+EVR_SOURCE = 'evr0' # source of EVR data for event code selection
+
+def evaluate_limits(arr, nneg=5, npos=5, lim_lo=1, lim_hi=1000, cmt='') :
+    """Returns (lo, hi) limits: ave -/+ n*std of the array values, constrained by absolute limits"""
+    ave, std = arr.mean(), arr.std()
+    lo = max(ave - nneg*std, lim_lo) if nneg > 0 else lim_lo
+    hi = min(ave + npos*std, lim_hi) if npos > 0 else lim_hi
+    logger.debug('evaluate_limits %s: ave=%.3f std=%.3f limits: %.3f %.3f' % (cmt, ave, std, lo, hi), __name__)
+    return lo, hi
+
+def fname_from_template(fntmpl, exp, run, typ, src) :
+    """Returns file name for template like ./work/clb-#exp-#run-peds-#type-#src.txt"""
+    return fntmpl.replace('#exp', exp).replace('#run', 'r%04d' % int(run)).replace('#type', typ).replace('#src', src)
+
+def parse_event_codes(evcodes) :
+    """Returns (codes_on, codes_off) sets for str of comma separated event codes like '40,-162', None for no selection"""
+    if evcodes is None or str(evcodes).strip() in ('', 'None') : return None
+    codes = [int(c) for c in str(evcodes).split(',') if c.strip()]
+    if not codes : return None
+    return set(c for c in codes if c > 0), set(-c for c in codes if c < 0)
+
+def event_is_selected(selection, event_codes) :
+    """Returns True if event with list of EVR event_codes passes selection of parse_event_codes"""
+    if selection is None : return True
+    codes_on, codes_off = selection
+    codes = set(event_codes) if event_codes is not None else set()
+    if codes & codes_off : return False
+    return not codes_on or bool(codes & codes_on)
+
+def gate_of_stage1(frames, int_lo, int_hi, intnlo, intnhi, fraclo=0.05, frachi=0.95) :
+    """Returns per-pixel (gate_lo, gate_hi) float64 arrays evaluated on array of the first nrecs1 frames:
+       median -/+ intnlo/intnhi * spread, spread is half of the distance between fraclo and frachi quantiles,
+       at least 1 ADU, gate is limited by [int_lo, int_hi], non-positive number of sigmas - absolute limit is used.
+    """
+    qlo, med, qhi = np.quantile(frames, (fraclo, 0.5, frachi), axis=0)
+    spread = np.maximum(0.5*(qhi - qlo), 1.)
+    gate_lo = np.maximum(med - intnlo*spread, int_lo) if intnlo > 0 else np.full(med.shape, float(int_lo))
+    gate_hi = np.minimum(med + intnhi*spread, int_hi) if intnhi > 0 else np.full(med.shape, float(int_hi))
+    return gate_lo, gate_hi
+
+def dsname_indexed(dsname) :
+    """Returns dataset name for indexed access like exp=xpptut15:run=54:idx, None if dataset is not exp=...:run=..."""
+    if not dsname.startswith('exp=') : return None
+    return ':'.join([f for f in dsname.split(':') if f not in ('smd', 'idx')] + ['idx'])
+
+def _indexed_events(ds, ifirst, events) :
+    i0 = 0 # index of the first event of run in dataset
+    for run in ds.runs() :
+        times = run.times()
+        for j in range(max(ifirst - i0, 0), min(events - i0, len(times))) :
+            yield i0 + j, run.event(times[j])
+        i0 += len(times)
+        if not i0 < events : break
+
+def events_in_range(dsname, ifirst, events) :
+    """Returns iterator of (i, evt) for events ifirst <= i < events of dataset, DataSource is created at call"""
+    import psana
+    dsidx = dsname_indexed(dsname)
+    if dsidx is None :
+        return islice(enumerate(psana.DataSource(dsname).events()), ifirst, max(ifirst, events))
+    return _indexed_events(psana.DataSource(dsidx), ifirst, events)
+
+#------------------------------
+
+class PedestalEngine(object) :
+    """Accumulates dark frames in one pass and evaluates pedestals, rms and pixel_status"""
+
+    def __init__(self, int_lo=0.1, int_hi=16000, rms_lo=0.1, rms_hi=10000,\
+                 intnlo=5, intnhi=5, rmsnlo=5, rmsnhi=5, fraclm=0.1, block_size=8, nrecs1=0) :
+        """Constructor, parameters have the same meaning as options of det_ndarr_raw_proc.
+        @param block_size - number of frames accumulated in one vectorized update
+        @param nrecs1 - number of frames of stage 1 for evaluation of per-pixel gate, 0 - gate [int_lo, int_hi]
+        """
+        self.int_lo, self.int_hi = int_lo, int_hi
+        self.rms_lo, self.rms_hi = rms_lo, rms_hi
+        self.intnlo, self.intnhi = intnlo, intnhi
+        self.rmsnlo, self.rmsnhi = rmsnlo, rmsnhi
+        self.fraclm     = fraclm
+        self.block_size = block_size
+        self.nrecs1     = nrecs1
+        self.gate_lo    = None # per-pixel gate of stage 1, None - [int_lo, int_hi]
+        self.gate_hi    = None
+        self.stage1     = []   # frames of stage 1
+        self.shape      = None
+        self.nevt       = 0
+        self.block      = None
+        self.nblock     = 0
+
+    def _init_arrays(self, frame) :
+        self.shape  = frame.shape
+        self.dtype  = frame.dtype
+        self.count  = np.zeros(self.shape, dtype=np.int64)   # number of events within gate
+        self.sum1   = np.zeros(self.shape, dtype=np.float64)
+        self.sum2   = np.zeros(self.shape, dtype=np.float64)
+        self.nlo    = np.zeros(self.shape, dtype=np.int64)   # number of events below int_lo
+        self.nhi    = np.zeros(self.shape, dtype=np.int64)   # number of events above int_hi
+        self.arr_max = np.full(self.shape, frame.min(), dtype=self.dtype)
+        self.arr_min = np.full(self.shape, frame.max(), dtype=self.dtype)
+        self.block  = np.empty((self.block_size,) + self.shape, dtype=self.dtype)
+        self.nblock = 0
+
+    def set_gate(self, gate_lo, gate_hi) :
+        """Sets per-pixel gate evaluated earlier, e.g. by gate_of_stage1 on the first frames of event range"""
+        self.gate_lo, self.gate_hi = gate_lo, gate_hi
+
+    def _end_stage1(self) :
+        """Evaluates gate on frames of stage 1 and accumulates them"""
+        frames, self.stage1 = self.stage1, []
+        self.set_gate(*gate_of_stage1(np.array(frames), self.int_lo, self.int_hi, self.intnlo, self.intnhi))
+        logger.info('PedestalEngine stage 1 gate is evaluated on %d frames' % len(frames), __name__)
+        for frame in frames : self._add(frame)
+
+    def add(self, frame) :
+        """Adds one frame, for nrecs1 > 0 the first nrecs1 frames are kept until the gate is evaluated"""
+        if self.nrecs1 > 0 and self.gate_lo is None :
+            self.stage1.append(np.array(frame))
+            if len(self.stage1) == self.nrecs1 : self._end_stage1()
+            return
+        self._add(frame)
+
+    def _add(self, frame) :
+        if self.shape is None : self._init_arrays(frame)
+        elif frame.shape != self.shape :
+            raise ValueError('frame shape %s differs from shape %s of the first frame' % (str(frame.shape), str(self.shape)))
+        self.block[self.nblock] = frame
+        self.nblock += 1
+        self.nevt += 1
+        if self.nblock == self.block_size : self.flush()
+
+    def flush(self) :
+        """Accumulates frames collected in the block, stage 1 is completed if there are less than nrecs1 frames"""
+        if self.stage1 : self._end_stage1()
+        if not self.nblock : return
+        b = self.block[:self.nblock]
+        below, above = b < self.int_lo, b > self.int_hi
+        self.nlo += below.sum(axis=0)
+        self.nhi += above.sum(axis=0)
+        good = ~(below | above) if self.gate_lo is None else (b >= self.gate_lo) & (b <= self.gate_hi)
+        self.count += good.sum(axis=0)
+        bf = np.where(good, b, 0).astype(np.float64)
+        self.sum1 += bf.sum(axis=0)
+        np.square(bf, out=bf)
+        self.sum2 += bf.sum(axis=0)
+        np.maximum(self.arr_max, b.max(axis=0), out=self.arr_max)
+        np.minimum(self.arr_min, b.min(axis=0), out=self.arr_min)
+        self.nblock = 0
+
+    def process(self, frames) :
+        """Consumes iterator of frames (ndarrays, None-s are skipped), returns self"""
+        for frame in frames :
+            if frame is not None : self.add(frame)
+        self.flush()
+        logger.info('PedestalEngine accumulated %d events of shape %s' % (self.nevt, str(self.shape)), __name__)
+        return self
+
+#------------------------------
+
+    list_of_partial_arrays = ('count', 'sum1', 'sum2', 'nlo', 'nhi', 'arr_max', 'arr_min')
+
+    def save_partial(self, fname, **info) :
+        """Saves partial accumulator (nevt, gate, count, sum1, sum2, nlo, nhi, max, min) in compressed npz file,
+           info - optional integer scalars, e.g. evskip and next_event of checkpoint, see partial_info.
+           Empty accumulator is saved without arrays, e.g. for shard without selected events, it is skipped at merge.
+        """
+        self.flush()
+        tmp = fname + '.tmp.npz'
+        arrays = {} if self.shape is None else dict((name, getattr(self, name)) for name in self.list_of_partial_arrays)
+        arrays.update(('info_' + k, np.int64(v)) for k, v in info.items())
+        if self.gate_lo is not None : arrays.update(gate_lo=self.gate_lo, gate_hi=self.gate_hi)
+        np.savez_compressed(tmp, nevt=self.nevt, gate=np.array((self.int_lo, self.int_hi)), **arrays)
+        os.replace(tmp, fname) # partial file is either complete or absent
+        logger.info('saved partial accumulator for %d events: %s' % (self.nevt, fname), __name__)
+
+    def load_partial(self, fname) :
+        """Loads partial accumulator saved by save_partial and merges it, returns self"""
+        with np.load(fname) as d :
+            if tuple(d['gate']) != (self.int_lo, self.int_hi) :
+                raise ValueError('intensity gate %s in %s differs from %s' % (str(tuple(d['gate'])), fname, str((self.int_lo, self.int_hi))))
+            if not int(d['nevt']) :
+                logger.info('empty partial accumulator is skipped: %s' % fname, __name__)
+                return self
+            other = PedestalEngine(self.int_lo, self.int_hi)
+            if 'gate_lo' in d.files : other.set_gate(d['gate_lo'], d['gate_hi'])
+            other.nevt = int(d['nevt'])
+            for name in self.list_of_partial_arrays : setattr(other, name, d[name])
+            other.shape = other.count.shape
+        return self.merge(other)
+
+    def merge(self, other) :
+        """Merges accumulator of other engine with the same gate, returns self.
+           Merged sums of integer data are identical to a single-pass accumulation.
+        """
+        self.flush()
+        other.flush()
+        if other.shape is None : return self
+        if self.gate_lo is None and self.shape is None : self.set_gate(other.gate_lo, other.gate_hi)
+        elif not (self.gate_lo is None and other.gate_lo is None or self.gate_lo is not None and other.gate_lo is not None\
+                  and np.array_equal(self.gate_lo, other.gate_lo) and np.array_equal(self.gate_hi, other.gate_hi)) :
+            raise ValueError('stage 1 gate of merged accumulator differs')
+        if self.shape is None :
+            self.shape, self.nevt = other.shape, other.nevt
+            for name in self.list_of_partial_arrays : setattr(self, name, getattr(other, name).copy())
+            self.dtype = self.arr_max.dtype
+            self.block = np.empty((self.block_size,) + self.shape, dtype=self.dtype) # to continue accumulation
+            return self
+        if other.shape != self.shape :
+            raise ValueError('shape %s of merged accumulator differs from %s' % (str(other.shape), str(self.shape)))
+        self.nevt  += other.nevt
+        self.count += other.count
+        self.sum1  += other.sum1
+        self.sum2  += other.sum2
+        self.nlo   += other.nlo
+        self.nhi   += other.nhi
+        np.maximum(self.arr_max, other.arr_max, out=self.arr_max)
+        np.minimum(self.arr_min, other.arr_min, out=self.arr_min)
+        return self
+
+#------------------------------
+
+    def constants(self) :
+        """Returns dict of arrays for types 'ave', 'rms', 'sta', 'msk', 'max', 'min'"""
+        self.flush()
+        if self.shape is None : raise ValueError('no frames accumulated')
+        cnt = np.maximum(self.count, 1)
+        ave = np.where(self.count > 0, self.sum1 / cnt, 0)
+        av2 = np.where(self.count > 0, self.sum2 / cnt, 0)
+        rms = np.sqrt(np.maximum(av2 - np.square(ave), 0))
+
+        rms_min, rms_max = evaluate_limits(rms, self.rmsnlo, self.rmsnhi, self.rms_lo, self.rms_hi, cmt='RMS')
+        ave_min, ave_max = evaluate_limits(ave, self.intnlo, self.intnhi, self.int_lo, self.int_hi, cmt='AVE')
+        nlim = self.fraclm * self.nevt
+
+        sta = np.zeros(self.shape, dtype=np.int64)
+        sta += (rms > rms_max)
+        sta += (rms < rms_min) * 2
+        sta += (self.nhi > nlim) * 4
+        sta += (self.nlo > nlim) * 8
+        sta += (ave > ave_max) * 16
+        sta += (ave < ave_min) * 32
+
+        msg = 'PedestalEngine status for %d events: bad pixels %d of %d (rms hi %d, rms lo %d, saturated %d, dead %d, ave hi %d, ave lo %d)'%\
+              (self.nevt, np.count_nonzero(sta), sta.size, np.count_nonzero(sta & 1), np.count_nonzero(sta & 2),\
+               np.count_nonzero(sta & 4), np.count_nonzero(sta & 8), np.count_nonzero(sta & 16), np.count_nonzero(sta & 32))
+        logger.info(msg, __name__)
+
+        return {'ave' : ave,
+                'rms' : rms,
+                'sta' : sta,
+                'msk' : (sta == 0).astype(np.int64),
+                'max' : self.arr_max.copy(),
+                'min' : self.arr_min.copy()}
+
+    def save(self, fntmpl, exp, run, src, types=list_of_types, save_txt=None) :
+        """Saves constants in files with names from template like ./work/clb-#exp-#run-peds-#type-#src.txt,
+           returns list of saved file names.
+        """
+        if save_txt is None : from PSCalib.NDArrIO import save_txt
+        d = self.constants()
+        list_of_fnames = []
+        for typ in types :
+            fname = fname_from_template(fntmpl, exp, run, typ, src)
+            fmt = dict_of_type_formats[typ] if typ in ('ave', 'rms') or d[typ].dtype.kind in 'iub' else '%.3f'
+            save_txt(fname, d[typ], cmts=('exp %s run %d src %s type %s events %d' % (exp, int(run), src, typ, self.nevt),), fmt=fmt)
+            logger.info('saved: %s' % fname, __name__)
+            list_of_fnames.append(fname)
+        return list_of_fnames
+
+#------------------------------
+
+def partial_info(fname) :
+    """Returns dict of info scalars saved with partial accumulator"""
+    with np.load(fname) as d :
+        return dict((k[5:], int(d[k])) for k in d.files if k.startswith('info_'))
+
+def fname_checkpoint(fname) :
+    """Returns checkpoint file name for partial file name like ./work/clb-xpptut15-r0054-peds-ckpt-XppGon.0:Cspad.0.npz"""
+    return os.path.splitext(fname)[0] + '-ckpt.npz'
+
+def save_checkpoints(engines, fnames_ckpt, evskip, next_event) :
+    """Saves partial accumulators of engines as checkpoints for events evskip <= i < next_event"""
+    if not all(pe.nevt for pe in engines) : return False # nothing to resume from
+    for pe, fname in zip(engines, fnames_ckpt) : pe.save_partial(fname, evskip=evskip, next_event=next_event)
+    return True
+
+def resume_from_checkpoints(engines, fnames_ckpt, evskip, events) :
+    """Loads checkpoints in empty engines if all of them exist and are consistent,
+       returns index of the next event to process, evskip if there is nothing to resume from.
+    """
+    if not all(os.path.exists(fname) for fname in fnames_ckpt) : return evskip
+    try :
+        infos = [partial_info(fname) for fname in fnames_ckpt]
+        next_events = set(info.get('next_event') for info in infos)
+        if len(next_events) != 1 or any(info.get('evskip') != evskip for info in infos) :
+            logger.warning('inconsistent checkpoints %s are ignored' % ', '.join(fnames_ckpt), __name__)
+            return evskip
+        next_event = next_events.pop()
+        if not evskip < next_event <= events : return evskip
+        loaded = [PedestalEngine(pe.int_lo, pe.int_hi).load_partial(fname) for pe, fname in zip(engines, fnames_ckpt)]
+    except (IOError, OSError, ValueError, KeyError) as err :
+        logger.warning('checkpoints are ignored: %s' % err, __name__)
+        return evskip
+    for pe, other in zip(engines, loaded) : pe.merge(other)
+    logger.info('resume accumulation from checkpoint at event %d, %d events are already accumulated' % (next_event, engines[0].nevt), __name__)
+    return next_event
+
+def remove_checkpoints(fnames_ckpt) :
+    for fname in fnames_ckpt :
+        if os.path.exists(fname) : os.remove(fname)
+
+def gate_from_psana(engines, dets, evr, selection, dsname, evgate, events) :
+    """Sets gate of engines with nrecs1 > 0 evaluated on the first nrecs1 selected events evgate <= i < events"""
+    engs = [(det, pe) for det, pe in zip(dets, engines) if pe.nrecs1 > 0 and pe.gate_lo is None]
+    if not engs : return
+    frames = [[] for det, pe in engs]
+    for i, evt in events_in_range(dsname, evgate, events) :
+        if evr is not None and not event_is_selected(selection, evr.eventCodes(evt)) : continue
+        for (det, pe), lst in zip(engs, frames) :
+            raw = det.raw(evt) if len(lst) < pe.nrecs1 else None
+            if raw is not None : lst.append(np.array(raw))
+        if all(len(lst) >= pe.nrecs1 for (det, pe), lst in zip(engs, frames)) : break
+    for (det, pe), lst in zip(engs, frames) :
+        if lst : pe.set_gate(*gate_of_stage1(np.array(lst), pe.int_lo, pe.int_hi, pe.intnlo, pe.intnhi))
+    logger.info('stage 1 gate is evaluated on %s frames from event %d' % ('/'.join(str(len(lst)) for lst in frames), evgate), __name__)
+
+def accumulate_from_psana(dsname, srcs, events=1000, evskip=0, pars={}, fnames_ckpt=None, nevts_ckpt=0, evcodes=None, gate_range=None) :
+    """Accumulates raw data of sources srcs for events evskip <= i < events in one pass over dataset,
+       returns list of PedestalEngine-s, one per source.
+       If fnames_ckpt (one per source) are specified, accumulation resumes from existing checkpoints
+       and checkpoints are saved every nevts_ckpt events; they are not removed at the end.
+       @param evcodes - str of comma separated EVR codes for event selection, None - all events
+       @param gate_range - (evgate, events) of the whole event range for stage 1 gate if pars has nrecs1 > 0,
+                           default (evskip, events), gate of checkpoint is used on resume.
+    """
+    import psana
+    engines = [PedestalEngine(**pars) for src in srcs]
+    ifirst = evskip if fnames_ckpt is None else resume_from_checkpoints(engines, fnames_ckpt, evskip, events)
+    selection = parse_event_codes(evcodes)
+    dets = [psana.Detector(src) for src in srcs]
+    evr  = psana.Detector(EVR_SOURCE) if selection is not None else None
+    gate_from_psana(engines, dets, evr, selection, dsname, *(gate_range or (evskip, events)))
+    evts = events_in_range(dsname, ifirst, events) # events in checkpoint are not read
+    for i, evt in evts :
+        if evr is None or event_is_selected(selection, evr.eventCodes(evt)) :
+            for det, pe in zip(dets, engines) :
+                raw = det.raw(evt)
+                if raw is not None : pe.add(raw)
+        if nevts_ckpt and fnames_ckpt is not None and (i + 1 - evskip) % nevts_ckpt == 0 :
+            save_checkpoints(engines, fnames_ckpt, evskip, i + 1)
+    for pe in engines : pe.flush()
+    return engines
+
+def save_constants_from_psana(dsname, srcs, fntmpl, exp, run, events=1000, evskip=0, pars={}, evcodes=None) :
+    """Accumulates events evskip <= i < events of dataset in one pass and saves constants of each source
+       in files with names from template fntmpl, returns list of saved files, raises IOError if there is no data for source.
+    """
+    engines = accumulate_from_psana(dsname, srcs, events, evskip, pars, evcodes=evcodes)
+    list_of_fnames = []
+    for src, pe in zip(srcs, engines) :
+        if not pe.nevt : raise IOError('no data found for source %s in events %d-%d of %s' % (src, evskip, events, dsname))
+        list_of_fnames += pe.save(fntmpl, exp, run, src)
+    return list_of_fnames
+
+def frames_from_psana(dsname, src, events=1000, evskip=0, evcodes=None) :
+    """Generator of raw ndarrays of detector src for events evskip <= i < events of dataset dsname selected by evcodes"""
+    import psana
+    selection = parse_event_codes(evcodes)
+    evts = events_in_range(dsname, evskip, events)
+    det = psana.Detector(src)
+    evr = psana.Detector(EVR_SOURCE) if selection is not None else None
+    for i, evt in evts :
+        if evr is None or event_is_selected(selection, evr.eventCodes(evt)) : yield det.raw(evt)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    from time import time
+
+    shape, nevts = (4, 185, 388), 200
+    rng = np.random.default_rng(12345)
+    peds = rng.normal(1000, 50, size=shape)
+    noise = np.full(shape, 5.)
+    noise[0,10,10] = 100 # hot
+    noise[0,20,20] = 0   # cold
+    def synthetic_frames() :
+        for i in range(nevts) :
+            frame = np.rint(peds + noise * rng.standard_normal(shape)).astype(np.uint16)
+            frame[1,5,5] = 0     # dead
+            frame[1,6,6] = 16383 # saturated
+            yield frame
+
+    frames = list(synthetic_frames())
+    t0 = time()
+    pe = PedestalEngine(int_lo=1, int_hi=16000, rms_lo=0.5, rms_hi=100, block_size=8).process(frames)
+    d = pe.constants()
+    print('Consumed time %.3f sec for %d events' % (time()-t0, nevts))
+
+    a = np.array(frames, dtype=np.float64)
+    assert np.allclose(d['ave'][0], a.mean(axis=0)[0]) and np.allclose(d['rms'][0], a.std(axis=0)[0])
+    print('status: hot %d cold %d dead %d saturated %d' % (d['sta'][0,10,10], d['sta'][0,20,20], d['sta'][1,5,5], d['sta'][1,6,6]))
+
+    pe2 = PedestalEngine(int_lo=1, int_hi=16000, rms_lo=0.5, rms_hi=100, block_size=64).process(frames[::-1])
+    d2 = pe2.constants()
+    print('block size and event order independent: %s' % all(np.array_equal(d[t], d2[t]) for t in list_of_types))
+
+    tmpdir = tempfile.mkdtemp()
+    for i, shard in enumerate((frames[:70], frames[70:71], frames[71:])) :
+        PedestalEngine(int_lo=1, int_hi=16000, block_size=5).process(shard).save_partial(os.path.join(tmpdir, 'part%d.npz' % i))
+    pe3 = PedestalEngine(int_lo=1, int_hi=16000, rms_lo=0.5, rms_hi=100)
+    for i in (2, 0, 1) : pe3.load_partial(os.path.join(tmpdir, 'part%d.npz' % i))
+    d3 = pe3.constants()
+    print('merged partials are identical to single pass: %s' % all(np.array_equal(d[t], d3[t]) for t in list_of_types))
+
+    ckpts = [os.path.join(tmpdir, 'ckpt%d.npz' % i) for i in range(2)]
+    engines = [PedestalEngine(int_lo=1, int_hi=16000) for i in range(2)]
+    for pe in engines : pe.process(frames[:120])
+    save_checkpoints(engines, ckpts, 0, 120)
+    engines = [PedestalEngine(int_lo=1, int_hi=16000, rms_lo=0.5, rms_hi=100) for i in range(2)]
+    next_event = resume_from_checkpoints(engines, ckpts, 0, nevts)
+    for pe in engines : pe.process(frames[next_event:])
+    print('resumed at event %d: %s, identical to single pass: %s' % (next_event, partial_info(ckpts[0]),\
+          all(np.array_equal(d[t], engines[1].constants()[t]) for t in list_of_types)))
+    print('checkpoint with other gate is ignored, next event: %d' % resume_from_checkpoints([PedestalEngine(int_lo=2)], ckpts[:1], 0, nevts))
+
+    gframes = [f.copy() for f in frames]
+    for f in gframes[::25] : f[2,0,0] = 3000 # outliers rejected by stage 1 gate
+    gate = gate_of_stage1(np.array(gframes[:50]), 1, 16000, 5, 5)
+    pg = PedestalEngine(int_lo=1, int_hi=16000, block_size=8, nrecs1=50).process(gframes)
+    dg = pg.constants()
+    ga = np.array(gframes, dtype=np.float64)
+    good = (ga >= gate[0]) & (ga <= gate[1])
+    print('stage 1 gate: %.0f-%.0f, pedestal with outliers %.1f, gated %.1f, expected %.1f' % (gate[0][2,0,0], gate[1][2,0,0],\
+          ga[:,2,0,0].mean(), dg['ave'][2,0,0], ga[:,2,0,0][good[:,2,0,0]].mean()))
+    shards = [PedestalEngine(int_lo=1, int_hi=16000, nrecs1=50) for i in range(2)]
+    for pe_s in shards : pe_s.set_gate(*gate)
+    shards[0].process(gframes[:30]).save_partial(os.path.join(tmpdir, 'gpart0.npz'))
+    shards[1].process(gframes[30:]).save_partial(os.path.join(tmpdir, 'gpart1.npz'))
+    pg2 = PedestalEngine(int_lo=1, int_hi=16000, nrecs1=50)
+    for i in (1, 0) : pg2.load_partial(os.path.join(tmpdir, 'gpart%d.npz' % i))
+    print('merged gated partials are identical to single pass: %s' % all(np.array_equal(dg[t], pg2.constants()[t]) for t in list_of_types))
+    try :
+        PedestalEngine(int_lo=1, int_hi=16000).load_partial(os.path.join(tmpdir, 'part0.npz')).load_partial(os.path.join(tmpdir, 'gpart0.npz'))
+    except ValueError as err :
+        print('merge of partials with different gates: %s' % err)
+
+    print('indexed datasets: %s %s' % (dsname_indexed('exp=xpptut15:run=54:smd:dir=/reg/d/psdm/xpp/xpptut15/xtc'), dsname_indexed('./e1-r0054.xtc')))
+    sel = parse_event_codes('40,41,-162')
+    print('event code selection %s: %s' % (str(sel), [event_is_selected(sel, codes) for codes in ([40], [41, 140], [40, 162], [140], None)]))
+    print('veto only: %s, no selection: %s' % ([event_is_selected(parse_event_codes('-162'), codes) for codes in ([40], [162])],\
+          parse_event_codes('None')))
+
+    def save_txt(fname, arr, cmts=(), fmt='%.3f') : np.savetxt(fname, arr.reshape(-1, arr.shape[-1]), fmt=fmt, header='\n'.join(cmts))
+    print(pe.save(os.path.join(tmpdir, 'clb-#exp-#run-peds-#type-#src.txt'), 'xpptut15', 54, 'XppGon.0:Cspad.0', save_txt=save_txt))
+    sys.exit('End of test')
+
+#------------------------------
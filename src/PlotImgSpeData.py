@@ -0,0 +1,306 @@
+"""Module PlotImgSpeData - data access of PlotImgSpeWidget for large (memory-mapped) 2d arrays.
+
+Image is never copied as a whole: the displayed window is taken as strided view of the array
+with step defining the number of displayed pixels not larger than max_size in each dimension,
+so for small zoomed ROI it is loaded in full resolution, for large window - decimated.
+Histogram is evaluated on strided sample of the window with at most max_samples entries,
+intensity limits - exactly, by the min and max of the window read in chunks of rows. Materialized windows are kept in LRU cache limited by size in bytes,
+so returning to previously viewed zoom does not read memory-mapped file again.
+
+ImagePyramid keeps block-averaged levels of the image with factors 2, 4, 8, ... down to screen size.
+Levels are built on demand: the finest level within memory budget max_bytes is averaged from the array
+in one pass of row chunks, coarser levels - from the previous level. View of window is returned from
+the level which has about one level pixel per screen pixel, so imshow renders at screen resolution;
+zoom finer than the finest stored level is taken from the array with stride (through TileCache).
+
+Usage::
+
+    from CalibManager.PlotImgSpeData import open_array, window_step, window_slices, hist_sample, TileCache
+
+    arr = open_array('./averaged-frames.npy')  # np.memmap for .npy
+    tiles = TileCache(max_bytes=256<<20)
+    step = window_step(rows, cols, max_size=2048)
+    win = tiles.get(arr, (r0, r1, c0, c1, step))  # contiguous ndarray of the window
+    sample, scale = hist_sample(win, max_samples=1<<20)  # histogram counts of sample are multiplied by scale*step*step
+    vmin, vmax = window_min_max(arr, r0, r1, c0, c1)  # exact, None if window has no finite values
+
+    pyr = ImagePyramid(arr)
+    img, factor, (ir0, ir1, ic0, ic1) = pyr.view(r0, r1, c0, c1, max_rows=600, max_cols=800, tiles=tiles)
+    # img for 800x600 screen pixels covers array pixels [ir0:ir1, ic0:ic1], it is drawn with imshow extent of these bounds
+
+This software was developed for the LCLS project.
+If you use all or part of it, please give an appropriate acknowledgment.
+"""
+
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+MAX_SIZE_DISPLAY = 2048    # maximal number of displayed pixels per dimension
+MAX_SAMPLES_HIST = 1<<20   # maximal number of entries in histogram sample
+MAX_BYTES_TILES  = 256<<20 # size of rendered tiles cache
+MAX_BYTES_LEVEL  = 64<<20  # size of the finest stored level of image pyramid
+MIN_SIZE_LEVEL   = 128     # coarsest level of image pyramid has at least this size in one dimension
+
+
+def open_array(fname, mmap_mode='c'):
+    """Returns array from .npy file memory-mapped, copy-on-write by default, so in-place operations
+       of the viewer do not change the file and allocate memory only for modified pages.
+    """
+    return np.load(fname, mmap_mode=mmap_mode)
+
+
+def window_step(rows, cols, max_size=MAX_SIZE_DISPLAY):
+    """Returns stride for the window of rows x cols pixels to display at most max_size pixels per dimension"""
+    return max(1, -(-max(rows, cols) // max_size))
+
+
+def window_slices(shape, xmin=None, xmax=None, ymin=None, ymax=None, y_is_flip=False):
+    """Returns (r0, r1, c0, c1) of the window in array of shape (rows, cols) for image coordinates,
+       full array for any of coordinates None.
+    """
+    rows, cols = shape
+    if None in (xmin, xmax, ymin, ymax): return 0, rows, 0, cols
+    xmin, xmax, ymin, ymax = int(xmin), int(xmax), int(ymin), int(ymax)
+    c0, c1 = max(0, xmin), min(cols, xmax)
+    r0, r1 = (max(0, rows-ymax), min(rows, rows-ymin)) if y_is_flip else\
+             (max(0, ymin), min(rows, ymax))
+    return r0, max(r0+1, r1), c0, max(c0+1, c1)
+
+
+def window_view(arr, r0, r1, c0, c1, step=1):
+    """Returns strided view of the window, data are not read"""
+    return arr[r0:r1:step, c0:c1:step]
+
+
+def window_min_max(arr, r0, r1, c0, c1, npix_chunk=1<<24):
+    """Returns exact (min, max) of finite values in window [r0:r1, c0:c1] of array, or None if there are no finite values.
+       Window is read in chunks of rows with about npix_chunk pixels, so memory-mapped array is not loaded as a whole.
+    """
+    vmin = vmax = None
+    k = max(1, npix_chunk // max(1, c1-c0))
+    for r in range(r0, r1, k):
+        block = np.asarray(arr[r:min(r+k, r1), c0:c1])
+        if block.dtype.kind == 'f' and not np.isfinite(block).all(): block = block[np.isfinite(block)]
+        if block.size == 0: continue
+        bmin, bmax = block.min(), block.max()
+        vmin = bmin if vmin is None else min(vmin, bmin)
+        vmax = bmax if vmax is None else max(vmax, bmax)
+    return None if vmin is None else (float(vmin), float(vmax))
+
+
+def hist_sample(arr, max_samples=MAX_SAMPLES_HIST):
+    """Returns (sample, scale) - flat strided sample of array with at most max_samples entries
+       and factor to scale histogram counts of sample to the number of entries in array.
+    """
+    step = max(1, -(-arr.size // max_samples))
+    flat = arr.reshape(-1) if arr.flags.c_contiguous else np.ravel(arr)
+    sample = flat[::step]
+    return sample, float(arr.size)/sample.size if sample.size else 1.
+
+
+def nbytes_of(arr):
+    return arr.size * arr.itemsize
+
+
+class TileCache(object):
+    """LRU cache of materialized windows of arrays limited by total size in bytes"""
+
+    def __init__(self, max_bytes=MAX_BYTES_TILES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.tiles = OrderedDict()
+        self.lock = Lock()
+        self.nhits = 0
+        self.nmisses = 0
+
+
+    def get(self, arr, window):
+        """Returns contiguous copy of window=(r0, r1, c0, c1, step) of array, from cache if available.
+           Tiles are keyed by identity of array object, it has to be kept alive by the caller.
+        """
+        key = (id(arr), arr.shape, arr.dtype.str) + tuple(window)
+        with self.lock:
+            tile = self.tiles.pop(key, None)
+            if tile is not None:
+                self.tiles[key] = tile
+                self.nhits += 1
+                return tile
+        self.nmisses += 1
+        r0, r1, c0, c1, step = window
+        tile = np.ascontiguousarray(window_view(arr, r0, r1, c0, c1, step))
+        if nbytes_of(tile) > self.max_bytes: return tile
+        with self.lock:
+            self.tiles[key] = tile
+            self.nbytes += nbytes_of(tile)
+            while self.nbytes > self.max_bytes:
+                k, t = self.tiles.popitem(last=False)
+                self.nbytes -= nbytes_of(t)
+        return tile
+
+
+    def clear(self, arr=None):
+        """Removes all tiles, or tiles of arr only"""
+        with self.lock:
+            for k in [k for k in self.tiles if arr is None or k[0] == id(arr)]:
+                self.nbytes -= nbytes_of(self.tiles.pop(k))
+
+
+def block_counts(n, factor):
+    """Returns float32 array of numbers of pixels in consecutive blocks of factor pixels along axis of n pixels,
+       the last block is incomplete if n is not a multiple of factor.
+    """
+    return np.minimum(factor, n - factor*np.arange(-(-n//factor))).astype(np.float32)
+
+
+def downsample(arr, factor, nrows_chunk=1<<24, weights=None):
+    """Returns float32 array of factor x factor block means of 2d array, incomplete blocks at the edges
+       are averaged over their pixels, so that image of any level covers the whole array.
+       Array is read in chunks of rows with about nrows_chunk pixels, so memory-mapped array is not loaded as a whole.
+       @param weights - (row_weights, col_weights) of pixels, e.g. block_counts of finer level, None - equal weights
+    """
+    nr, nc = arr.shape
+    rows, cols = -(-nr//factor), -(-nc//factor)
+    out = np.empty((rows, cols), dtype=np.float32)
+    if rows == 0 or cols == 0: return out
+    wr, wc = (np.ones(nr, dtype=np.float32), np.ones(nc, dtype=np.float32)) if weights is None else weights
+    pad_c = cols*factor - nc
+    norm_c = np.pad(wc, (0, pad_c)).reshape(cols, factor).sum(axis=1)
+    k = max(1, nrows_chunk // (cols*factor*factor))
+    for r in range(0, rows, k):
+        n = min(k, rows-r)
+        block = np.asarray(arr[r*factor:(r+n)*factor], dtype=np.float32)
+        wrb = wr[r*factor:(r+n)*factor]
+        if weights is not None: block = block * wrb[:,None] * wc[None,:]
+        pad_r = n*factor - block.shape[0]
+        if pad_r or pad_c: # incomplete blocks are padded by zeros, which do not contribute to sums
+            block, wrb = np.pad(block, ((0, pad_r), (0, pad_c))), np.pad(wrb, (0, pad_r))
+        norm = np.outer(wrb.reshape(n, factor).sum(axis=1), norm_c)
+        out[r:r+n] = block.reshape(n, factor, cols, factor).sum(axis=(1,3)) / norm
+    return out
+
+
+class ImagePyramid(object):
+    """Block-averaged levels of 2d array for rendering of windows at screen resolution"""
+
+    def __init__(self, arr, max_bytes=MAX_BYTES_LEVEL, min_size=MIN_SIZE_LEVEL):
+        self.arr = arr
+        self.min_size = min_size
+        self.levels = {} # {factor: array}
+        self.lock = Lock()
+        rows, cols = arr.shape
+        f = 2
+        while -(-rows//f)*-(-cols//f)*4 > max_bytes: f *= 2
+        self.factor_min = f # finest stored level
+
+
+    def level(self, factor):
+        """Returns level for factor (power of 2, >= factor_min), builds it if necessary"""
+        with self.lock:
+            lev = self.levels.get(factor)
+        if lev is not None: return lev
+        rows, cols = self.arr.shape
+        lev = downsample(self.arr, factor) if factor <= self.factor_min else\
+              downsample(self.level(factor//2), 2, weights=(block_counts(rows, factor//2), block_counts(cols, factor//2)))
+        with self.lock:
+            self.levels[factor] = lev
+        return lev
+
+
+    def factor_for(self, rows, cols, max_rows, max_cols):
+        """Returns power of 2 factor to display window of rows x cols pixels on max_rows x max_cols screen pixels"""
+        f = 1
+        while (rows > f*max_rows or cols > f*max_cols) and min(self.arr.shape)//(2*f) >= self.min_size: f *= 2
+        return f
+
+
+    def view(self, r0, r1, c0, c1, max_rows, max_cols, tiles=None):
+        """Returns (image, factor, bounds) for window [r0:r1, c0:c1] of array to display on max_rows x max_cols screen pixels,
+           image pixel covers factor x factor array pixels, image covers array pixels of bounds (r0, r1, c0, c1),
+           which are aligned to level pixels and may differ from the window; pixels of the last row and column
+           of level may average incomplete blocks, then bounds exceed the array shape by less than factor.
+        """
+        f = self.factor_for(r1-r0, c1-c0, max(1, max_rows), max(1, max_cols))
+        if f < self.factor_min: # fine zoom - from the array with stride
+            window = (r0, r1, c0, c1, f)
+            img = tiles.get(self.arr, window) if tiles is not None else\
+                  np.ascontiguousarray(window_view(self.arr, *window))
+            return img, f, (r0, r0+img.shape[0]*f, c0, c0+img.shape[1]*f)
+        lev = self.level(f)
+        lr0, lc0 = min(r0//f, lev.shape[0]-1), min(c0//f, lev.shape[1]-1)
+        lr1, lc1 = min(lev.shape[0], max(lr0+1, -(-r1//f))), min(lev.shape[1], max(lc0+1, -(-c1//f)))
+        return lev[lr0:lr1, lc0:lc1], f, (lr0*f, lr1*f, lc0*f, lc1*f)
+
+
+    def nbytes(self):
+        return sum(nbytes_of(lev) for lev in self.levels.values())
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    from time import time
+
+    fname = os.path.join(tempfile.mkdtemp(), 'frames.npy')
+    rows, cols = 16384, 16384 # 1 GB of float32
+    a = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float32, shape=(rows, cols))
+    for r in range(0, rows, 1024): a[r:r+1024] = np.random.standard_normal((min(1024, rows-r), cols))
+    a.flush()
+    del a
+
+    t0 = time()
+    arr = open_array(fname)
+    tiles = TileCache(max_bytes=64<<20)
+    r0, r1, c0, c1 = window_slices(arr.shape)
+    step = window_step(r1-r0, c1-c0)
+    win = tiles.get(arr, (r0, r1, c0, c1, step))
+    sample, scale = hist_sample(win)
+    counts, edges = np.histogram(sample, bins=100)
+    t1 = time()
+    print('full view: %s step %d window %s, hist entries %.0f, %.3f sec' % (str(arr.shape), step, str(win.shape), counts.sum()*scale*step*step, t1-t0))
+
+    r0, r1, c0, c1 = window_slices(arr.shape, 1000, 1500, 2000, 2600)
+    step = window_step(r1-r0, c1-c0)
+    roi = tiles.get(arr, (r0, r1, c0, c1, step))
+    t2 = time()
+    roi = tiles.get(arr, (r0, r1, c0, c1, step))
+    t3 = time()
+    print('ROI: step %d shape %s, first %.4f sec, cached %.6f sec, tiles %d, %.1f MB, hits %d misses %d' %\
+          (step, str(roi.shape), t2-t1, t3-t2, len(tiles.tiles), tiles.nbytes/1e6, tiles.nhits, tiles.nmisses))
+    print('full resolution ROI is identical: %s' % np.array_equal(roi, arr[2000:2600, 1000:1500]))
+    t0 = time()
+    vrange = window_min_max(arr, 0, rows, 0, cols)
+    print('exact min, max of full view: %s in %.3f sec, of sample: %s' % (str(vrange), time()-t0, str((sample.min(), sample.max()))))
+    assert window_min_max(arr, 2000, 2600, 1000, 1500, npix_chunk=1<<16) == (float(roi.min()), float(roi.max()))
+    print('window for flipped y: %s' % str(window_slices((100, 200), 10, 20, 30, 50, y_is_flip=True)))
+
+    pyr = ImagePyramid(arr)
+    t0 = time()
+    img, f, bounds = pyr.view(0, rows, 0, cols, 600, 800, tiles)
+    t1 = time()
+    print('pyramid: finest stored level %d, full view %s factor %d built in %.3f sec' % (pyr.factor_min, str(img.shape), f, t1-t0))
+    for win in ((0, 8000, 0, 8000), (4000, 6000, 4000, 6000), (5000, 5400, 5000, 5600), (1003, 7001, 2005, 9999),\
+                (5001, 5403, 5003, 7003), (5001, 6003, 5003, 6503), (0, rows, 0, cols)):
+        t0 = time()
+        img, f, bounds = pyr.view(*win, max_rows=600, max_cols=800, tiles=tiles)
+        print('  window %-28s -> image %-12s factor %2d bounds %-28s %.4f sec' % (str(win), str(img.shape), f, str(bounds), time()-t0))
+        assert (bounds[1]-bounds[0], bounds[3]-bounds[2]) == (img.shape[0]*f, img.shape[1]*f)
+        assert bounds[0] <= win[0] and bounds[2] <= win[2] and bounds[1] > win[1]-f and bounds[3] > win[3]-f
+    print('  levels %s, %.1f MB' % (sorted(pyr.levels), pyr.nbytes()/1e6))
+    print('  level is block mean: %s' % np.allclose(pyr.level(pyr.factor_min)[1,2],\
+          arr[pyr.factor_min:2*pyr.factor_min, 2*pyr.factor_min:3*pyr.factor_min].mean(), atol=1e-5))
+
+    odd = np.random.standard_normal((1001, 1003)).astype(np.float32)
+    pyr = ImagePyramid(odd, max_bytes=1<<16, min_size=8)
+    lev = pyr.level(64)
+    print('odd shape %s: finest level %d, level 64 %s, edge pixel is mean of incomplete block: %s' % (str(odd.shape), pyr.factor_min,\
+          str(lev.shape), np.allclose(lev[-1,-1], odd[960:, 960:].mean(), atol=1e-5) and np.allclose(lev[3,-1], odd[192:256, 960:].mean(), atol=1e-5)))
+    img, f, bounds = pyr.view(0, 1001, 0, 1003, max_rows=20, max_cols=20)
+    print('  full view %s factor %d bounds %s cover the whole array' % (str(img.shape), f, str(bounds)))
+    assert bounds[1] >= 1001 and bounds[3] >= 1003
+    sys.exit('End of test')
+
+# EOF
@@ -26,6 +26,8 @@ from   matplotlib.ticker import MaxNLocator, NullFormatter
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from .ConfigParametersForApp import cp
+from . import PlotImgSpeData as imgdata
+from .HistStats import CumulativeHistogram, proc_stat, add_stat_text
 
 
 def arr_rot_n90(arr, rot_ang_n90=0):
@@ -36,71 +38,6 @@ def arr_rot_n90(arr, rot_ang_n90=0):
     else                 : return arr
 
 
-def add_stat_text(axhi, weights, bins, fmt='Mean=%.6f%s%.6f\nRMS=%.6f%s%.6f\n'):
-    mean, rms, err_mean, err_rms, neff, skew, kurt, err_err, sum_w = proc_stat(weights,bins)
-    pm = r'$\pm$'
-    txt = 'Entries=%d\n' % sum_w\
-        + fmt % (mean, pm, err_mean, rms, pm, err_rms)\
-        + r'$\gamma1$=%.3f  $\gamma2$=%.3f' % (skew, kurt)
-    xb,xe = axhi.get_xlim()
-    yb,ye = axhi.get_ylim()
-    #x = xb + (xe-xb)*0.84
-    #y = yb + (ye-yb)*0.66
-    #axhi.text(x, y, txt, fontsize=10, color='k', ha='center', rotation=0)
-    x = xb + (xe-xb)*0.98
-    y = yb + (ye-yb)*0.95
-
-    if axhi.get_yscale() == 'log':
-        #print 'axhi.get_yscale():', axhi.get_yscale()
-        log_yb, log_ye = log10(yb), log10(ye)
-        log_y = log_yb + (log_ye-log_yb)*0.95
-        y = 10**log_y
-
-    axhi.text(x, y, txt, fontsize=10, color='k',
-              horizontalalignment='right',
-              verticalalignment='top',
-              rotation=0)
-
-
-def proc_stat(weights, bins):
-    center = np.array([0.5*(bins[i] + bins[i+1]) for i,w in enumerate(weights)])
-
-    sum_w  = weights.sum()
-    if sum_w <= 0: return  0, 0, 0, 0, 0, 0, 0, 0, 0
-
-    sum_w2 = (weights*weights).sum()
-    neff   = sum_w*sum_w/sum_w2 if sum_w2>0 else 0
-    sum_1  = (weights*center).sum()
-    mean = sum_1/sum_w
-    d      = center - mean
-    d2     = d * d
-    wd2    = weights*d2
-    m2     = (wd2)   .sum() / sum_w
-    m3     = (wd2*d) .sum() / sum_w
-    m4     = (wd2*d2).sum() / sum_w
-
-    #sum_2  = (weights*center*center).sum()
-    #err2 = sum_2/sum_w - mean*mean
-    #err  = math.sqrt(err2)
-
-    rms  = math.sqrt(m2) if m2>0 else 0
-    rms2 = m2
-
-    err_mean = rms/math.sqrt(neff)
-    err_rms  = err_mean/math.sqrt(2)
-
-    skew, kurt, var_4 = 0, 0, 0
-
-    if rms>0 and rms2>0:
-        skew  = m3/(rms2 * rms)
-        kurt  = m4/(rms2 * rms2) - 3
-        var_4 = (m4 - rms2*rms2*(neff-3)/(neff-1))/neff if neff>1 else 0
-    err_err = math.sqrt(math.sqrt(var_4)) if var_4>0 else 0
-    #print  'mean:%f, rms:%f, err_mean:%f, err_rms:%f, neff:%f' % (mean, rms, err_mean, err_rms, neff)
-    #print  'skew:%f, kurt:%f, err_err:%f' % (skew, kurt, err_err)
-    return mean, rms, err_mean, err_rms, neff, skew, kurt, err_err, sum_w
-
-
 class PlotImgSpeWidget(QtWidgets.QWidget):
     """Plots image and spectrum for 2d numpy array."""
 
@@ -110,6 +47,13 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         self.y_is_flip = y_is_flip
         self.rot_ang_n90 = int(rot_ang_n90)
         self.arr = arr_rot_n90(arr, self.rot_ang_n90)
+        self.tiles = imgdata.TileCache() # LRU of displayed windows, arr may be memory-mapped
+        self.pyramid = None # image levels for rendering at screen resolution, built on first draw
+        self.hstat = None # cumulative histogram of displayed window
+        self.hstat_key = None
+        self.background = None # canvas without cursor artists for blitting
+        self.curstext = None
+        self.cursline = None
         self.fig = plt.figure(figsize=(5,10), dpi=100, facecolor='w', edgecolor='w', frameon=True)
         self.canvas = self.fig.canvas
         self.vbox = QtWidgets.QVBoxLayout()     # <=== Begin to combine layout
@@ -119,6 +63,8 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         self.canvas.mpl_connect('axes_leave_event',     self.processAxesLeaveEvent)
         self.canvas.mpl_connect('axes_enter_event',     self.processAxesEnterEvent)
         self.canvas.mpl_connect('figure_leave_event',   self.processFigureLeaveEvent)
+        self.canvas.mpl_connect('draw_event',           self.processDrawEvent)
+        self.canvas.mpl_connect('resize_event',         self.processResizeEvent)
 
         self.connectZoomMode()
         self.cid_digi_motion  = self.canvas.mpl_connect('motion_notify_event',  self.onMouseMotion)
@@ -181,7 +127,7 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
 
     def get_xy_img_center(self):
-        xmin,xmax,ymin,ymax = self.imsh.get_extent()
+        xmin,xmax,ymin,ymax = self.range # displayed window, image extent may be larger
         return abs(ymin-ymax)//2, abs(xmax-xmin)//2  # return in terms of row, column ????
 
 
@@ -199,6 +145,9 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
 
     def set_image_array(self,arr):
+        self.tiles.clear()
+        self.pyramid = None
+        self.hstat = None
         self.arr = arr_rot_n90(arr, self.rot_ang_n90)
         self.processDraw()
 
@@ -206,6 +155,9 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
     def set_image_array_new(self, arr, rot_ang_n90=0, y_is_flip=False):
         self.y_is_flip = y_is_flip
         self.rot_ang_n90 = int(rot_ang_n90)
+        self.tiles.clear()
+        self.pyramid = None
+        self.hstat = None
         self.arr = arr_rot_n90(arr, self.rot_ang_n90)
         self.on_draw()
 
@@ -213,6 +165,9 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
     def subtract_from_image_array(self, arr_sub):
         arr_sub_rot = arr_rot_n90(arr_sub, self.rot_ang_n90)
         self.arr -= arr_sub_rot
+        self.tiles.clear()
+        self.pyramid = None
+        self.hstat = None
         self.on_draw()
 
 
@@ -226,11 +181,33 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         """Redraws the figure"""
 
         rows,cols = self.arr.shape
+        # window is displayed with at most MAX_SIZE_DISPLAY pixels per dimension,
+        # zoomed ROI is read in full resolution, large window - with stride
+        r0, r1, c0, c1 = imgdata.window_slices(self.arr.shape, xmin, xmax, ymin, ymax, self.y_is_flip)
+        self.step = imgdata.window_step(r1-r0, c1-c0)
+        self.arrwin = self.tiles.get(self.arr, (r0, r1, c0, c1, self.step))
+
+        # histograms for any bins and color limits of the window are derived from its cumulative histogram
+        hstat_key = (id(self.arrwin), r0, r1, c0, c1, self.step)
+        if self.hstat is None or self.hstat_key != hstat_key:
+            sample, scale = imgdata.hist_sample(self.arrwin)
+            vrange = imgdata.window_min_max(self.arrwin, 0, self.arrwin.shape[0], 0, self.arrwin.shape[1]) if self.step == 1 else\
+                     imgdata.window_min_max(self.arr, r0, r1, c0, c1) # exact limits of the window, not of the sample
+            self.hstat = CumulativeHistogram(sample, weight=scale*self.step*self.step, vrange=vrange)
+            self.hstat_key = hstat_key
+
+        # image is rendered from pyramid level with about one pixel per screen pixel
+        if self.pyramid is None: self.pyramid = imgdata.ImagePyramid(self.arr)
+        self.window = (r0, r1, c0, c1)
+        # pixels are centered at integer coordinates if y is not flipped, the last row and column are half-visible
+        rv1, cv1 = (r1, c1) if self.y_is_flip else (min(rows, r1+1), min(cols, c1+1))
+        self.arrimg, self.factor, bounds = self.pyramid.view(r0, rv1, c0, cv1, *self.screen_size_of_image(), tiles=self.tiles)
+        self.extent = self.image_extent(bounds) # rendered image may cover a bit more than the window
+
         #if xmin is None or xmax is None or ymin is None or ymax is None:
         if None in (xmin, xmax, ymin, ymax):
-            self.arrwin  = self.arr
-            if self.y_is_flip: self.range = [0,cols,0,rows] # original image range in pixels
-            else             : self.range = None # original image range in pixels
+            if self.y_is_flip    : self.range = [0,cols,0,rows] # original image range in pixels
+            else                 : self.range = [-0.5, cols-0.5, rows-0.5, -0.5] # default extent of imshow for full array
         else:
             xmin = int(xmin)
             xmax = int(xmax)
@@ -241,11 +218,8 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
             if self.y_is_flip:
                 self.range = [xmin, xmax, ymin, ymax]
-                self.arrwin =  self.arr[rows-ymax:rows-ymin,xmin:xmax]
-                #self.arrwin =  self.arr[ymin:ymax,xmin:xmax]
             else:
                 self.range = [xmin, xmax, ymax, ymin]
-                self.arrwin =  self.arr[ymin:ymax,xmin:xmax]
 
         zmin = self.floatOrNone(zmin)
         zmax = self.floatOrNone(zmax)
@@ -269,6 +243,10 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
         self.axhi.clear()
         self.axcb.clear()
+        self.curstext = None
+        self.cursline = None
+        try: self.imsh.remove() # previous image is replaced, not stacked
+        except: pass
 
         #   self.plots_in_log10_scale_for_img_and_xhist()
         if self.fig.myLogXIsOn:
@@ -286,11 +264,11 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
     def plots_in_log10_scale_for_img_and_yhist(self):
 
-        self.arr2d = np.log10(self.arrwin)
+        self.arr2d = np.log10(self.arrimg)
         # self.arr2d = self.arrwin
 
         if self.range_his is None:
-            vmin, vmax = np.min(self.arrwin), np.max(self.arrwin)
+            vmin, vmax = self.hstat.vmin, self.hstat.vmax
         else:
             vmin, vmax = self.range_his
 
@@ -312,15 +290,13 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         self.axhi.xaxis.set_major_locator(MaxNLocator(5))
         self.axhi.xaxis.set_major_formatter(NullFormatter())
 
-        weights, bins, patches = self.axhi.hist(self.arrwin.flatten(), bins=self.nbins, range=self.range_his, log=self.fig.myLogYIsOn)
+        weights, bins, patches = self.hist_of_window(bins=self.nbins, range=self.range_his, log=self.fig.myLogYIsOn)
         add_stat_text(self.axhi, weights, bins)
 
         if not self.fig.myLogYIsOn:
             self.set_hist_yticks()
 
-        self.imsh = self.axim.imshow(self.arr2d, origin='upper', \
-                                          interpolation='nearest', \
-                                          extent=self.range, aspect='auto')
+        self.imsh = self.imshow_window()
         self.imsh.set_clim(log_vmin,log_vmax)
 
 #        self.colb = self.fig.colorbar(self.imsh, orientation='vertical')#, cax=self.axim, \
@@ -348,11 +324,11 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
 
     def plots_in_log10_scale_for_img_and_xhist(self):
-        self.arr2d = np.log10(self.arrwin)
+        self.arr2d = np.log10(self.arrimg)
         #self.arr2d = self.arrwin
 
         if self.range_his is None:
-            vmin, vmax = np.min(self.arrwin), np.max(self.arrwin)
+            vmin, vmax = self.hstat.vmin, self.hstat.vmax
         else:
             vmin, vmax = self.range_his
 
@@ -376,12 +352,10 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         #print 'logbins =', logbins
         #self.axhi.hist(self.arr2d.flatten(), bins=self.nbins, range=self.range_his)
 
-        self.axhi.hist(self.arrwin.flatten(), bins=logbins )
+        self.hist_of_window(bins=logbins)
         self.set_hist_yticks()
 
-        self.imsh = self.axim.imshow(self.arr2d, origin='upper', \
-                                          interpolation='nearest', \
-                                          extent=self.range, aspect='auto')
+        self.imsh = self.imshow_window()
         self.imsh.set_clim(log_vmin,log_vmax)
 
         #self.axcb = self.fig.add_axes([0.15, 0.95, 0.78, 0.05])
@@ -396,7 +370,7 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
 
     def plots_in_linear_scale(self):
-        self.arr2d = self.arrwin
+        self.arr2d = self.arrimg
 
         #msg = 'self.nbins: %s  self.range_his: %s' % (self.nbins, self.range_his)
         #print 'plots_in_linear_scale: ' + msg
@@ -404,7 +378,7 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         if self.fig.myLogYIsOn:
             self.axhi.yaxis.set_major_locator(MaxNLocator(4))
 
-        weights, bins, patches = self.axhi.hist(self.arrwin.flatten(), bins=self.nbins, range=self.range_his, log=self.fig.myLogYIsOn)
+        weights, bins, patches = self.hist_of_window(bins=self.nbins, range=self.range_his, log=self.fig.myLogYIsOn)
         add_stat_text(self.axhi, weights, bins)
 
         if not self.fig.myLogYIsOn:
@@ -419,9 +393,7 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         self.fig.myZmin, self.fig.myZmax = cmin, cmax
         #print('XXXX cmin, cmax, self.range_his =', cmin, cmax, self.range_his)
 
-        self.imsh = self.axim.imshow(self.arr2d, origin='upper', \
-                                          interpolation='nearest', \
-                                          extent=self.range, aspect='auto')
+        self.imsh = self.imshow_window()
         self.imsh.set_clim(cmin,cmax)
         try   : del self.colb
         except: pass
@@ -444,6 +416,68 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         #self.colb.set_clim(zmin,zmax)
 
 
+    def image_extent(self, bounds):
+        """Returns imshow extent of rendered image covering array pixels of bounds (r0, r1, c0, c1)"""
+        r0, r1, c0, c1 = bounds
+        if self.y_is_flip: rows = self.arr.shape[0]; return [c0, c1, rows-r1, rows-r0]
+        return [c0-0.5, c1-0.5, r1-0.5, r0-0.5]
+
+
+    def imshow_window(self):
+        """Draws rendered image at its extent and limits axes to the displayed window range"""
+        imsh = self.axim.imshow(self.arr2d, origin='upper', interpolation='nearest', extent=self.extent, aspect='auto')
+        self.axim.set_xlim(self.range[0], self.range[1])
+        self.axim.set_ylim(self.range[2], self.range[3])
+        return imsh
+
+
+    def screen_size_of_image(self):
+        """Returns (rows, cols) of screen pixels in the image axes"""
+        bb = self.axim.bbox
+        return int(bb.height)+1, int(bb.width)+1
+
+
+    def processResizeEvent(self, event):
+        """Re-renders image if resized axes need another pyramid level"""
+        if self.pyramid is None: return
+        r0, r1, c0, c1 = self.window
+        if self.pyramid.factor_for(r1-r0, c1-c0, *self.screen_size_of_image()) != self.factor:
+            self.processDraw()
+
+
+    def processDrawEvent(self, event):
+        """Saves canvas after full draw as background for blitting of cursor artists"""
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox) if self.canvas.supports_blit else None
+
+
+    def blitCursorArtists(self):
+        """Draws cursor text and line over saved background, without full redraw of canvas"""
+        artists = [a for a in (self.curstext, self.cursline) if a is not None and a.axes is not None]
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        for a in artists: a.axes.draw_artist(a)
+        self.canvas.blit(self.fig.bbox)
+
+
+    def removeCursorArtists(self, *names):
+        for name in names:
+            a = getattr(self, name)
+            if a is None: continue
+            try: a.remove()
+            except: pass
+            setattr(self, name, None)
+
+
+    def hist_of_window(self, bins, range=None, log=False):
+        """Fills histogram of window pixel intensities from its cumulative histogram, bins narrower than its fine bin
+           are counted exactly from the sample, counts are scaled to the number of pixels in the window at full resolution.
+        """
+        counts, edges = self.hstat.histogram(bins, range)
+        return self.axhi.hist(edges[:-1], bins=edges, weights=counts, log=log)
+
+
     def set_hist_yticks(self):
         Nmin, Nmax = self.axhi.get_ylim()
         #print 'Nmin, Nmax =', Nmin, Nmax
@@ -459,10 +493,9 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
         #ymin, ymax = axes.get_ylim()
         x, y = event.xdata, event.ydata
         s = '%6.1f' % (event.xdata)
-        try: self.curstext.remove()
-        except: pass
-        self.curstext = axes.text(x, y, s, fontsize=10) #, ha='center')
-        self.canvas.draw()
+        self.removeCursorArtists('curstext')
+        self.curstext = axes.text(x, y, s, fontsize=10, animated=True) #, ha='center')
+        self.blitCursorArtists()
 
 
     def drawXYCoordinateOfCoursor(self, event):
@@ -478,34 +511,19 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
                '%.6f' if abs(v)>0.00001 else\
                '%.f'
         s = ('%d, %d\nv=' + vfmt) % (x, y, v)
-        try: self.curstext.remove()
-        except: pass
-        self.curstext = axes.text(x, y, s, fontsize=10) #, ha='center')
-        self.canvas.draw()
+        self.removeCursorArtists('curstext', 'cursline')
+        self.curstext = axes.text(x, y, s, fontsize=10, animated=True) #, ha='center')
+        self.blitCursorArtists()
 
 
     def drawVerticalLineThroughCoursor(self, event):
-        axes   = event.inaxes
-        fb     = self.canvas.figure.bbox
-        bb     = axes.bbox
-        #print bb
-
-        bbx0, bby0, bbh, bbw = bb.x0, bb.y0, bb.height, bb.width
-        fbx0, fby0, fbh, fbw = fb.x0, fb.y0, fb.height, fb.width
-
-        #xd = event.xdata
-        #yd = event.ydata
-        x = event.x
-        y = event.y
-
-        h  = bbh
-        x0 = bbx0
-        y0 = fbh - bby0 - h
-        w  = x - x0
-
-        rect = [x0, y0, w, h]
-        self.line_ver = self.fig.canvas.drawRectangle(rect)
-        #self.fig.canvas.draw()
+        axes = event.inaxes
+        if self.cursline is None or self.cursline.axes is not axes:
+            self.removeCursorArtists('cursline')
+            self.cursline = axes.axvline(event.xdata, color='k', linewidth=0.5, animated=True)
+        else:
+            self.cursline.set_xdata([event.xdata, event.xdata])
+        self.blitCursorArtists()
 
 
     def drawHorizontalLineThroughCoursor(self, event):
@@ -545,8 +563,8 @@ class PlotImgSpeWidget(QtWidgets.QWidget):
 
     def processAxesLeaveEvent(self, event):
         #print 'AxesLeaveEvent'
-        try: self.curstext.remove()
-        except: pass
+        self.removeCursorArtists('curstext', 'cursline')
+        self.blitCursorArtists()
         QtWidgets.QApplication.setOverrideCursor(QtGui.QCursor(QtCore.Qt.ArrowCursor))
 
 
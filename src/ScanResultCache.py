@@ -0,0 +1,194 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module ScanResultCache
+#
+#------------------------------------------------------------------------
+
+"""ScanResultCache - persistent cache of detector discovery results per (exp, run, dsname)
+
+Dark processing needs the list of (data type, source) in run. It used to be evaluated for each run
+by the scan of xtc files (event_keys subprocess or psana loop in CommandLineCalib.scan_event_keys)
+and parsing of the scan log. This cache keeps parsed lists in json file (FileNameManager.path_scan_cache())
+keyed by experiment, run and dataset string. Missing entry is pre-filled from the RegDB list of detectors
+in run, so that the scan is needed only when RegDB is not available or does not know the run.
+RegDB does not provide data types: types of RegDB entries are patterns of cp.dict_of_det_data_types
+labeled by TYPE_PATTERN_MARK, e.g. 'CsPad::DataV*', they match detectors as the scanned types do.
+Entries of scan have priority over RegDB entries.
+
+File is re-loaded if it was changed by other process (mtime), updates are serialized by flock
+and file is replaced atomically.
+
+Usage ::
+
+    from CalibManager.ScanResultCache import scan_result_cache
+
+    cache = scan_result_cache('./work/scan-cache.json')
+    lst = cache.get('xpptut15', 54, 'exp=xpptut15:run=54')    # [('CsPad::DataV2', 'XppGon.0:Cspad.0'), ...] or None,
+                                                               # types of RegDB entries are patterns, e.g. 'CsPad::DataV*'
+    cache.put('xpptut15', 54, 'exp=xpptut15:run=54', lst, origin='scan')
+    lst = cache.get_or_prefill('xpptut15', 54, 'exp=xpptut15:run=54',\
+                               list_of_sources=lambda : ru.list_of_sources_in_run('xpp', 'xpptut15', 54),\
+                               dict_of_det_data_types=cp.dict_of_det_data_types)
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import json
+import fcntl
+from time import time
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+TYPE_PATTERN_MARK = '*' # labels data type pattern of RegDB entry, e.g. 'CsPad::DataV*', real type is known after scan
+
+def is_type_pattern(dtype) :
+    return dtype.endswith(TYPE_PATTERN_MARK)
+
+def device_of_source(src) :
+    """Returns lower case device name of source, e.g. 'XppGon.0:Cspad.0' -> 'cspad'"""
+    return src.rsplit(':', 1)[-1].rsplit('.', 1)[0].lower()
+
+def type_sources_for_regdb_sources(srcs, dict_of_det_data_types) :
+    """Returns list of (type pattern, src) for sources of known detectors,
+       e.g. 'XppGon.0:Cspad.0' -> ('CsPad::DataV*', 'XppGon.0:Cspad.0'), sources of unknown devices are skipped.
+    """
+    dict_of_dev_types = dict((det.lower(), dtype + TYPE_PATTERN_MARK) for det, dtype in dict_of_det_data_types.items())
+    return [(dict_of_dev_types[device_of_source(src)], src) for src in srcs if device_of_source(src) in dict_of_dev_types]
+
+def has_sources_of_detectors(type_srcs, det_names) :
+    """Returns True if list of (type, src) has source for each detector name, e.g. ['CSPAD', 'Epix100a']"""
+    devs = set(device_of_source(src) for t, src in type_srcs)
+    return all(det.lower() in devs for det in det_names)
+
+#------------------------------
+
+class ScanResultCache(object) :
+    """Persistent json cache of lists of (type, src) keyed by (exp, run, dsname)"""
+
+    def __init__(self, fname) :
+        self.fname = fname
+        self.entries = {}
+        self.mtime = None
+        self.regdb_failed = set() # keys for which RegDB is not available in this process
+
+    @staticmethod
+    def key(exp, run, dsname) :
+        return '%s:%04d:%s' % (exp, int(run), dsname)
+
+    def _reload(self) :
+        """Re-loads file if it was modified after the last load"""
+        try :
+            mtime = os.path.getmtime(self.fname)
+        except OSError :
+            self.entries, self.mtime = {}, None
+            return
+        if mtime == self.mtime : return
+        try :
+            with open(self.fname, 'r') as f : self.entries = json.load(f)
+            self.mtime = mtime
+        except (IOError, ValueError) as err :
+            logger.warning('scan cache %s is ignored: %s' % (self.fname, err), __name__)
+            self.entries, self.mtime = {}, None
+
+    def get(self, exp, run, dsname) :
+        """Returns list of (type, src) or None if there is no entry"""
+        self._reload()
+        entry = self.entries.get(self.key(exp, run, dsname))
+        if entry is None : return None
+        return [tuple(ts) for ts in entry['type_srcs']]
+
+    def origin(self, exp, run, dsname) :
+        """Returns 'scan', 'regdb' or None"""
+        self._reload()
+        entry = self.entries.get(self.key(exp, run, dsname))
+        return None if entry is None else entry['origin']
+
+    def put(self, exp, run, dsname, type_srcs, origin='scan') :
+        """Adds or replaces entry, scan entry is not replaced by regdb entry"""
+        dname = os.path.dirname(self.fname)
+        if dname and not os.path.exists(dname) : os.makedirs(dname)
+        with open(self.fname + '.lock', 'w') as flock :
+            fcntl.flock(flock, fcntl.LOCK_EX) # serialize read-modify-write of concurrent processes
+            self._reload()
+            k = self.key(exp, run, dsname)
+            if origin != 'scan' and self.entries.get(k, {}).get('origin') == 'scan' : return
+            self.entries[k] = {'type_srcs' : [list(ts) for ts in type_srcs], 'origin' : origin, 'time' : time()}
+            tmp = '%s.%d.tmp' % (self.fname, os.getpid())
+            with open(tmp, 'w') as f : json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.fname)
+            self.mtime = os.path.getmtime(self.fname)
+        logger.debug('scan cache %s: %d sources from %s for %s' % (self.fname, len(type_srcs), origin, k), __name__)
+
+    def get_or_prefill(self, exp, run, dsname, list_of_sources=None, dict_of_det_data_types={}) :
+        """Returns cached list of (type, src), if entry is missing it is pre-filled from RegDB.
+           @param list_of_sources - callable returning list of RegDB sources in run, e.g. ['XppGon.0:Cspad.0', ...]
+           Returns None if entry is missing and RegDB is not available.
+        """
+        lst = self.get(exp, run, dsname)
+        if lst is not None or list_of_sources is None : return lst
+        k = self.key(exp, run, dsname)
+        if k in self.regdb_failed : return None
+        try :
+            srcs = list_of_sources()
+        except Exception as err : # RegDB may be unavailable in many ways
+            logger.debug('RegDB list of sources is not available for %s run %s: %s' % (exp, str(run), err), __name__)
+            srcs = None
+        if not srcs :
+            self.regdb_failed.add(k)
+            return None
+        lst = type_sources_for_regdb_sources(srcs, dict_of_det_data_types)
+        self.put(exp, run, dsname, lst, origin='regdb')
+        logger.info('scan cache is pre-filled from RegDB for %s run %s: %s' % (exp, str(run), ' '.join(s for t, s in lst)), __name__)
+        return lst
+
+#------------------------------
+
+_caches = {}
+
+def scan_result_cache(fname) :
+    """Returns shared ScanResultCache object for file name"""
+    if fname not in _caches : _caches[fname] = ScanResultCache(fname)
+    return _caches[fname]
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    fname = os.path.join(tempfile.mkdtemp(), 'work', 'scan-cache.json')
+    dict_of_det_data_types = {'CSPAD' : 'CsPad::DataV', 'CSPAD2x2' : 'CsPad2x2::ElementV', 'Andor' : 'Andor::FrameV', 'DualAndor' : 'Andor3d::FrameV'}
+    regdb_srcs = ['XppGon.0:Cspad.0', 'XppGon.0:Cspad2x2.1', 'XppEndstation.0:DualAndor.0', 'XppGon.0:Wave8.0']
+
+    cache = scan_result_cache(fname)
+    print('get before prefill: %s' % cache.get('xpptut15', 54, 'exp=xpptut15:run=54'))
+    print('prefill: %s' % cache.get_or_prefill('xpptut15', 54, 'exp=xpptut15:run=54', lambda : regdb_srcs, dict_of_det_data_types))
+    def regdb_is_down() : raise IOError('RegDB is down')
+    print('has CSPAD and DualAndor: %s, has Epix100a: %s' % (has_sources_of_detectors(cache.get('xpptut15', 54, 'exp=xpptut15:run=54'), ['CSPAD', 'DualAndor']),\
+                                                             has_sources_of_detectors(cache.get('xpptut15', 54, 'exp=xpptut15:run=54'), ['Epix100a'])))
+    print('prefill without RegDB: %s' % cache.get_or_prefill('xpptut15', 55, 'exp=xpptut15:run=55', regdb_is_down, dict_of_det_data_types))
+
+    cache.put('xpptut15', 54, 'exp=xpptut15:run=54', [('CsPad::DataV1', 'XppGon.0:Cspad.0')], origin='scan')
+    cache.put('xpptut15', 54, 'exp=xpptut15:run=54', [], origin='regdb') # does not replace scan
+    other = ScanResultCache(fname) # as in other process
+    print('other process: %s origin: %s' % (other.get('xpptut15', 54, 'exp=xpptut15:run=54'), other.origin('xpptut15', 54, 'exp=xpptut15:run=54')))
+
+    t0 = time()
+    for i in range(1000) : cache.get('xpptut15', 54, 'exp=xpptut15:run=54')
+    print('time per cached get: %.1f us' % ((time()-t0)*1000))
+    sys.exit('End of test')
+
+#------------------------------
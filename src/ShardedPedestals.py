@@ -0,0 +1,261 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module ShardedPedestals
+#
+#------------------------------------------------------------------------
+
+"""ShardedPedestals - event-range sharded averaging of dark runs with mergeable partial accumulators
+
+Event range [evskip, events) is split in nshards contiguous shards, each shard is processed
+by its own job (command calibpeds_shard submitted through BatchExecutor) which saves
+partial accumulators (count, sum, sum of squares, min, max, ...) of PedestalEngine for each source
+in npz files. Shard job reads its event range by indexed access to the dataset, without reading
+events of preceding shards. Events are selected by EVR codes evcodes as by option -c of det_ndarr_raw_proc.
+Failed shards are re-submitted individually up to max_retries times,
+re-submitted shard resumes from its checkpoint saved every nevts_ckpt events.
+When some shard fails max_retries+1 times or waiting exceeds timeout, the rest of shard jobs are killed.
+Shard records can be saved in DarkProcState and restored, completed shards are not re-processed.
+When all shards are done the merge stage combines partials and saves final constants
+in the same clb-#exp-#run-peds-#type-#src.txt files as a single-pass averaging.
+
+Usage ::
+
+    from CalibManager.ShardedPedestals import ShardedPedestals
+    from CalibManager.BatchExecutor import get_executor
+
+    sp = ShardedPedestals('exp=xpptut15:run=54', 'XppGon.0:Cspad.0,XppGon.0:Cspad2x2.0', evskip=0, events=1000, nshards=4,\
+                          fntmpl='./work/clb-#exp-#run-peds-#type-#src.txt', exp='xpptut15', run=54,\
+                          pars=dict(int_lo=0.1, int_hi=16000, rms_lo=0.1, rms_hi=10000, intnlo=5, intnhi=5, rmsnlo=5, rmsnhi=5))
+    ex = get_executor('local', ncores=4)
+    sp.submit(ex, queue='psanaq', logbase='./work/log')
+    status = sp.poll(ex)       # 'RUN', 'DONE', or 'EXIT' if some shard failed max_retries times
+    status = sp.wait(ex, timeout_sec=2000)
+    sp.merge_and_save()        # returns list of saved files
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import shlex
+from time import time, sleep
+
+from CalibManager.Logger import logger
+from CalibManager.PedestalEngine import PedestalEngine, fname_from_template, fname_checkpoint,\
+                                        accumulate_from_psana, remove_checkpoints
+
+#------------------------------
+
+def shard_ranges(evskip, events, nshards) :
+    """Returns list of (evskip_i, events_i) for nshards contiguous event ranges covering [evskip, events)"""
+    n = max(events - evskip, 0)
+    nshards = max(min(nshards, n), 1)
+    edges = [evskip + (n * i) // nshards for i in range(nshards + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+def fname_partial(fntmpl, exp, run, src, ishard, nshards) :
+    """Returns file name of partial accumulator like ./work/clb-xpptut15-r0054-peds-part01of04-XppGon.0:Cspad.0.npz"""
+    fname = fname_from_template(fntmpl, exp, run, 'part%02dof%02d' % (ishard, nshards), src)
+    return os.path.splitext(fname)[0] + '.npz'
+
+def process_shard(dsname, srcs, evskip, events, fnames, int_lo, int_hi, nevts_ckpt=0, evcodes=None,\
+                  nrecs1=0, intnlo=5, intnhi=5, gate_range=None) :
+    """Accumulates events evskip <= i < events for list of sources in one pass over dataset,
+       saves partial accumulators in the list of fnames, returns number of accumulated events of the first source.
+       If nevts_ckpt > 0 checkpoints are saved every nevts_ckpt events, processing resumes from existing checkpoints.
+       @param evcodes - str of comma separated EVR codes for event selection, None - all events
+       @param nrecs1, intnlo, intnhi - parameters of stage 1 gate of PedestalEngine, 0 - gate [int_lo, int_hi]
+       @param gate_range - (evskip, events) of the whole event range of all shards, stage 1 gate is evaluated
+                           on its first nrecs1 selected events, so that all shards use the same gate
+    """
+    fnames_ckpt = [fname_checkpoint(fname) for fname in fnames]
+    pars = dict(int_lo=int_lo, int_hi=int_hi, intnlo=intnlo, intnhi=intnhi, nrecs1=nrecs1)
+    engines = accumulate_from_psana(dsname, srcs, events, evskip, pars,\
+                                    fnames_ckpt=fnames_ckpt if nevts_ckpt else None, nevts_ckpt=nevts_ckpt, evcodes=evcodes,\
+                                    gate_range=gate_range)
+    for src, pe, fname in zip(srcs, engines, fnames) :
+        if not pe.nevt : logger.warning('no data found for source %s in events %d-%d of %s' % (src, evskip, events, dsname), __name__)
+        pe.save_partial(fname) # empty partial is skipped at merge
+    remove_checkpoints(fnames_ckpt)
+    return engines[0].nevt
+
+#------------------------------
+
+class Shard(object) :
+    __slots__ = ('index', 'evskip', 'events', 'fnames', 'job_id', 'status', 'attempts', 'log')
+
+    def __init__(self, index, evskip, events, fnames) :
+        self.index    = index
+        self.evskip   = evskip
+        self.events   = events
+        self.fnames   = fnames
+        self.job_id   = None
+        self.status   = None
+        self.attempts = 0
+        self.log      = None
+
+    def is_done(self) :
+        return self.status == 'DONE' and all(os.path.exists(f) for f in self.fnames)
+
+
+class ShardedPedestals(object) :
+    """Submits shard jobs, re-submits failed shards, merges partial accumulators"""
+
+    command_shard = 'calibpeds_shard'
+
+    def __init__(self, dsname, str_sources, evskip, events, nshards, fntmpl, exp, run, pars, max_retries=2, nevts_ckpt=0, evcodes=None) :
+        """Constructor.
+        @param str_sources - comma separated sources
+        @param pars - dict of PedestalEngine parameters int_lo, int_hi, rms_lo, rms_hi, intnlo, intnhi, rmsnlo, rmsnhi, nrecs1
+        @param nevts_ckpt - number of events between checkpoints of shard job, 0 - no checkpoints
+        @param evcodes - str of comma separated EVR codes for event selection, None or 'None' - all events
+        """
+        self.dsname  = dsname
+        self.srcs    = [s for s in str_sources.split(',') if s]
+        self.fntmpl  = fntmpl
+        self.exp     = exp
+        self.run     = int(run)
+        self.pars    = pars
+        self.max_retries = max_retries
+        self.nevts_ckpt  = nevts_ckpt
+        self.evcodes = None if evcodes in (None, '', 'None') else str(evcodes)
+        self.evskip  = evskip
+        self.events  = events
+        ranges = shard_ranges(evskip, events, nshards)
+        self.shards  = [Shard(i, b, e, [fname_partial(fntmpl, exp, run, src, i, len(ranges)) for src in self.srcs])\
+                        for i, (b, e) in enumerate(ranges)]
+        self.t_submit = None
+        self.merged   = False
+
+    def shard_command(self, shard) :
+        cmd = shlex.split(self.command_shard) + ['-d', self.dsname, '-s', ','.join(self.srcs),\
+               '-m', str(shard.evskip), '-n', str(shard.events),\
+               '-b', repr(self.pars['int_lo']), '-t', repr(self.pars['int_hi']), '-o', ','.join(shard.fnames)]
+        if self.nevts_ckpt : cmd += ['-k', str(self.nevts_ckpt)]
+        if self.evcodes is not None : cmd += ['-c', self.evcodes]
+        if self.pars.get('nrecs1', 0) > 0 :
+            cmd += ['-r', str(self.pars['nrecs1']), '-l', repr(self.pars.get('intnlo', 5)), '-u', repr(self.pars.get('intnhi', 5)),\
+                    '-g', str(self.evskip), '-e', str(self.events)]
+        return ' '.join(shlex.quote(s) for s in cmd)
+
+    def _submit_shard(self, executor, shard) :
+        for fname in shard.fnames :
+            if os.path.exists(fname) : os.remove(fname)
+        shard.attempts += 1
+        shard.status = None
+        shard.job_id, out, err = executor.submit(self.shard_command(shard), self.queue, shard.log)
+        logger.info('shard %d events %d-%d attempt %d job id: %s' % (shard.index, shard.evskip, shard.events, shard.attempts, shard.job_id), __name__)
+
+    def submit(self, executor, queue='psanaq', logbase='./log') :
+        """Submits jobs for all shards which are not done"""
+        self.queue = queue
+        self.t_submit = time()
+        for shard in self.shards :
+            shard.log = '%s_shard%02dof%02d.txt' % (logbase, shard.index, len(self.shards))
+            if shard.is_done() :
+                logger.info('shard %d events %d-%d is done earlier, partials: %s' % (shard.index, shard.evskip, shard.events, ','.join(shard.fnames)), __name__)
+                continue
+            self._submit_shard(executor, shard)
+
+    def shard_records(self) :
+        """Returns list of dicts with shard status for DarkProcState"""
+        return [{'index' : s.index, 'evskip' : s.evskip, 'events' : s.events,\
+                 'status' : s.status, 'attempts' : s.attempts, 'job_id' : s.job_id} for s in self.shards]
+
+    def restore(self, records) :
+        """Restores status of shards from records saved by shard_records, returns number of completed shards.
+           Shard is considered completed if its record status is DONE and all its partial files exist.
+        """
+        for rec in records :
+            i = rec['index']
+            if not i < len(self.shards) : continue
+            shard = self.shards[i]
+            if (rec['evskip'], rec['events']) != (shard.evskip, shard.events) : continue
+            shard.attempts = rec['attempts']
+            shard.status = rec['status']
+            if not shard.is_done() : shard.status = None
+        return len([shard for shard in self.shards if shard.is_done()])
+
+    def poll(self, executor) :
+        """Updates status of shards, re-submits failed shards,
+           returns 'DONE' when all shards are done, 'EXIT' if some shard failed max_retries+1 times, or 'RUN'.
+           On 'EXIT' jobs of the rest of shards are killed.
+        """
+        if self.merged : return 'DONE'
+        for shard in self.shards :
+            if shard.is_done() : continue
+            shard.status = executor.status(shard.job_id)
+            if shard.status is None and shard.job_id is not None and all(os.path.exists(f) for f in shard.fnames) :
+                shard.status = 'DONE' # job is completed and purged by the batch system, partials are saved atomically
+            if shard.status == 'EXIT' or (shard.status == 'DONE' and not shard.is_done()) :
+                if shard.attempts > self.max_retries :
+                    logger.warning('shard %d failed %d times, see log %s' % (shard.index, shard.attempts, shard.log), __name__)
+                    self.kill(executor)
+                    return 'EXIT'
+                logger.warning('shard %d failed, re-submit, see log %s' % (shard.index, shard.log), __name__)
+                self._submit_shard(executor, shard)
+        return 'DONE' if all(shard.is_done() for shard in self.shards) else 'RUN'
+
+    def kill(self, executor) :
+        """Kills jobs of shards which are not done"""
+        for shard in self.shards :
+            if shard.is_done() or shard.job_id is None or shard.status == 'EXIT' : continue
+            logger.info('kill job %s of shard %d: %s' % (shard.job_id, shard.index, executor.kill(shard.job_id).strip()), __name__)
+            shard.status = 'EXIT'
+
+    def wait(self, executor, dt_sec=2, on_poll=None, timeout_sec=None) :
+        """Blocks until all shards are done or failed, returns status,
+           on_poll(self) is called after each poll, e.g. to save shard records.
+           If shards are not done in timeout_sec, their jobs are killed and 'EXIT' is returned, None - no timeout.
+        """
+        t0 = time()
+        while True :
+            status = self.poll(executor)
+            if status == 'RUN' and timeout_sec is not None and time() - t0 > timeout_sec :
+                logger.warning('shards are not done in %d sec, kill shard jobs' % timeout_sec, __name__)
+                self.kill(executor)
+                status = 'EXIT'
+            if on_poll is not None : on_poll(self)
+            if status != 'RUN' : return status
+            sleep(dt_sec)
+
+    def merge_and_save(self, save_txt=None) :
+        """Merges partial accumulators of all shards, saves final constants, returns list of saved files"""
+        list_of_fnames = []
+        for isrc, src in enumerate(self.srcs) :
+            pe = PedestalEngine(**self.pars)
+            for shard in self.shards : pe.load_partial(shard.fnames[isrc]) # empty partials are skipped
+            if not pe.nevt : raise IOError('no data found for source %s in events %d-%d of %s' % (src, self.evskip, self.events, self.dsname))
+            list_of_fnames += pe.save(self.fntmpl, self.exp, self.run, src, save_txt=save_txt)
+        for shard in self.shards :
+            for fname in shard.fnames : os.remove(fname)
+        self.merged = True
+        msg = 'merged %d shards for sources %s' % (len(self.shards), ','.join(self.srcs))
+        if self.t_submit is not None : msg += ' in %.1f sec since submission' % (time() - self.t_submit)
+        logger.info(msg, __name__)
+        return list_of_fnames
+
+    def summary(self) :
+        return '\n'.join('shard %2d events %6d-%6d attempts %d status %s job %s' %\
+                         (s.index, s.evskip, s.events, s.attempts, s.status, s.job_id) for s in self.shards)
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    print(shard_ranges(0, 1000, 4))
+    print(shard_ranges(9, 12, 8))
+    print(fname_partial('./work/clb-#exp-#run-peds-#type-#src.txt', 'xpptut15', 54, 'XppGon.0:Cspad.0', 1, 4))
+    sys.exit('End of test')
+
+#------------------------------
@@ -0,0 +1,219 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module SubprocSupervisor
+#
+#------------------------------------------------------------------------
+
+"""SubprocSupervisor - selector-based supervision of subprocess
+
+Output of subprocess (stdout and stderr) is streamed to the log file as it arrives,
+supervisor returns as soon as the child exits, on timeout the whole process group
+of the child is terminated (SIGTERM, then SIGKILL after grace period).
+Wall time, CPU time (user+sys of the child and its waited descendants) and max RSS are reported.
+
+Method poll(timeout=0) does not block and can be called from the GUI timer or ThreadWorker,
+method wait() blocks until completion.
+
+Usage ::
+
+    from CalibManager.SubprocSupervisor import SubprocSupervisor, run_in_log
+
+    sp = SubprocSupervisor(['event_keys', '-d', 'exp=xpptut15:run=54', '-n', '10'], 'log.txt', tmax_sec=500)
+    sp.start()
+    while sp.poll(timeout=0.1) is None : pass # or: rc = sp.wait()
+    print(sp.returncode, sp.timed_out, sp.usage())
+
+    rc, msg = run_in_log(['ls', '-l'], 'log.txt', tmax_sec=10) # msg is '' for successful completion
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import signal
+import selectors
+import subprocess
+from time import time, sleep
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+class SubprocSupervisor(object) :
+    """Supervises subprocess: streams output to log, enforces timeout, reports resource usage"""
+
+    def __init__(self, command_seq, logname=None, env=None, shell=False, tmax_sec=500, grace_sec=5, on_output=None) :
+        """Constructor.
+        @param command_seq - command as a list of arguments (or str for shell=True)
+        @param logname - log file name for subprocess output, None - output is not saved
+        @param tmax_sec - timeout, process group is killed when it is exceeded, None - no timeout
+        @param grace_sec - time between SIGTERM and SIGKILL on timeout
+        @param on_output - callback(bytes) for each chunk of output
+        """
+        self.command_seq = command_seq
+        self.logname     = logname
+        self.env         = env
+        self.shell       = shell
+        self.tmax_sec    = tmax_sec
+        self.grace_sec   = grace_sec
+        self.on_output   = on_output
+        self.proc        = None
+        self.log         = None
+        self.sel         = None
+        self.returncode  = None
+        self.rusage      = None
+        self.timed_out   = False
+        self.t_start     = None
+        self.t_end       = None
+        self.t_term      = None
+
+    def start(self) :
+        self.log = open(self.logname, 'wb') if self.logname is not None else None
+        self.proc = subprocess.Popen(self.command_seq, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,\
+                                     stdin=subprocess.DEVNULL, env=self.env, shell=self.shell, start_new_session=True)
+        self.t_start = time()
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.proc.stdout, selectors.EVENT_READ)
+        return self
+
+    def _read_output(self, timeout) :
+        """Waits up to timeout sec for output, writes available output to log"""
+        if self.sel is None : return
+        for key, events in self.sel.select(timeout) :
+            try : data = os.read(key.fd, 65536)
+            except BlockingIOError : continue
+            if not data :
+                self._close_pipe()
+                return
+            if self.log is not None :
+                self.log.write(data)
+                self.log.flush()
+            if self.on_output is not None : self.on_output(data)
+
+    def _close_pipe(self) :
+        if self.sel is None : return
+        self.sel.unregister(self.proc.stdout)
+        self.sel.close()
+        self.sel = None
+        self.proc.stdout.close()
+
+    def _reap(self) :
+        """Returns True if the child has exited, collects its exit code and resource usage"""
+        if self.returncode is not None : return True
+        pid, status, rusage = os.wait4(self.proc.pid, os.WNOHANG)
+        if pid == 0 : return False
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self.proc.returncode = self.returncode
+        self.rusage = rusage
+        self.t_end = time()
+        return True
+
+    def _kill_group(self, sig) :
+        try : os.killpg(self.proc.pid, sig)
+        except OSError : pass
+
+    def _check_timeout(self) :
+        if self.tmax_sec is None : return
+        t = time()
+        if self.t_term is None and t - self.t_start > self.tmax_sec :
+            logger.warning('subprocess %d is working longer than %g sec - terminate process group' % (self.proc.pid, self.tmax_sec), __name__)
+            self.timed_out = True
+            self.t_term = t
+            self._kill_group(signal.SIGTERM)
+        elif self.t_term is not None and t - self.t_term > self.grace_sec :
+            self._kill_group(signal.SIGKILL)
+
+    def poll(self, timeout=0) :
+        """Streams output for up to timeout sec, returns exit code or None if subprocess is still running"""
+        if self.returncode is not None : return self.returncode
+        self._read_output(timeout if self.sel is not None else 0)
+        if not self._reap() :
+            self._check_timeout()
+            if self.sel is None and timeout : sleep(min(timeout, 0.05)) # output is closed, avoid busy loop
+            return None
+        # child has exited, drain pipe without blocking on descendants which may hold it open
+        while self.sel is not None and self.sel.select(0) : self._read_output(0)
+        if self.sel is not None : self._close_pipe()
+        if self.timed_out : self._kill_group(signal.SIGKILL) # remaining descendants
+        if self.log is not None : self.log.close()
+        logger.debug(self.summary(), __name__)
+        return self.returncode
+
+    def wait(self, dt_sec=0.5, on_tick=None) :
+        """Blocks until subprocess is completed, returns exit code,
+           on_tick() is called every dt_sec, e.g. QCoreApplication.processEvents to keep GUI responsive.
+        """
+        while self.poll(dt_sec) is None :
+            if on_tick is not None : on_tick()
+        return self.returncode
+
+    def usage(self) :
+        """Returns dict of wall time, CPU time and max RSS of the completed subprocess"""
+        d = {'wall_sec' : (self.t_end if self.t_end is not None else time()) - self.t_start}
+        if self.rusage is not None :
+            d['cpu_sec']   = self.rusage.ru_utime + self.rusage.ru_stime
+            d['maxrss_mb'] = self.rusage.ru_maxrss / 1024. # kB on Linux
+        return d
+
+    def summary(self) :
+        d = self.usage()
+        s = 'subprocess %d exit code: %s  wall: %.2f sec' % (self.proc.pid, str(self.returncode), d['wall_sec'])
+        if 'cpu_sec' in d : s += '  cpu: %.2f sec  max rss: %.1f MB' % (d['cpu_sec'], d['maxrss_mb'])
+        if self.timed_out : s += '  TERMINATED ON TIMEOUT %g sec' % self.tmax_sec
+        return s
+
+#------------------------------
+
+def run_in_log(command_seq, logname, env=None, shell=False, tmax_sec=500, on_tick=None) :
+    """Executes command_seq, streams output in log file, returns (exit code, error message),
+       error message is empty for successful completion.
+    """
+    sp = SubprocSupervisor(command_seq, logname, env=env, shell=shell, tmax_sec=tmax_sec)
+    try :
+        sp.start()
+    except OSError as err :
+        return None, 'ERROR: subprocess %s is not started: %s' % (str(command_seq), err)
+    rc = sp.wait(dt_sec=0.5 if on_tick is None else 0.05, on_tick=on_tick)
+    logger.info(sp.summary(), __name__)
+    if sp.timed_out : return rc, 'ERROR: subprocess is terminated on timeout %.0f sec, see log %s' % (tmax_sec, logname)
+    if rc != 0      : return rc, 'ERROR: subprocess exit code %d, see log %s' % (rc, logname)
+    return rc, ''
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    d = tempfile.mkdtemp()
+    log = os.path.join(d, 'log.txt')
+
+    t0 = time()
+    rc, msg = run_in_log(['sh', '-c', 'echo out; echo err 1>&2; sleep 0.2; echo done'], log)
+    print('rc=%s msg="%s" time %.3f sec, log:\n%s' % (rc, msg, time()-t0, open(log).read()))
+
+    t0 = time()
+    rc, msg = run_in_log(['sh', '-c', 'sleep 100 & sleep 100'], log, tmax_sec=0.5)
+    print('rc=%s msg="%s" time %.3f sec' % (rc, msg, time()-t0))
+
+    rc, msg = run_in_log([sys.executable, '-c', 'import numpy as np; a=np.ones(50000000); print(a.sum())'], log)
+    print('rc=%s msg="%s" log: %s' % (rc, msg, open(log).read().strip()))
+
+    sp = SubprocSupervisor(['sh', '-c', 'for i in 1 2 3; do echo line $i; sleep 0.1; done'], None,\
+                           on_output=lambda data : sys.stdout.write('  streamed: %s' % data.decode())).start()
+    npolls = 0
+    while sp.poll(timeout=0) is None : npolls += 1
+    print('non-blocking polls: %d, %s' % (npolls, sp.summary()))
+    sys.exit('End of test')
+
+#------------------------------
@@ -28,24 +28,33 @@ import random
 from PyQt5 import QtCore
 from .ConfigParametersForApp import confpars as cp
 from .FileNameManager        import fnm
+from .XtcDirWatcher          import XtcDirWatcher
 
 #---------------------
 #  Class definition --
 #---------------------
 
 class ThreadCheckNewXtcFiles (QtCore.QThread) :
+    """Emits signal update(QString) for each new run in the xtc directory of current experiment.
+       New runs are detected by XtcDirWatcher (inotify or directory mtime check every dt_check_sec),
+       the directory is unconditionally re-listed every dt_sec.
+    """
     update = QtCore.pyqtSignal('QString')
 
-    def __init__ ( self, parent=None, dt_sec=60, print_bits=0 ) :
+    def __init__ ( self, parent=None, dt_sec=60, print_bits=0, dt_check_sec=0.5, backend='auto' ) :
         QtCore.QThread.__init__(self, parent)
 
-        self.dt_sec     = dt_sec
-        self.print_bits = print_bits
-        self.thread_id  = random.random()
+        self.dt_sec       = dt_sec
+        self.dt_check_sec = dt_check_sec
+        self.backend      = backend
+        self.print_bits   = print_bits
+        self.thread_id    = random.random()
 
         self.exp_name   = cp.exp_name.value()
         self.counter = 0
         self.list_of_runs_old = []
+        self.watcher = None
+        self.xtc_dir = None
 
         cp.thread_check_new_xtc_files = self
         self.update['QString'].connect(self.testConnection)
@@ -59,35 +68,42 @@ class ThreadCheckNewXtcFiles (QtCore.QThread) :
         while True :
             self.counter += 1
             if self.print_bits & 2 : print('ThreadCheckNewXtcFiles id: %f, counter: %d' % (self.thread_id, self.counter))
-            if self.newXtcFileIsAvailable() :
-                self.emitSignalNewXtc()
-            self.sleep(self.dt_sec)
+            for run in self.newXtcRuns() :
+                self.emitSignalNewXtc(run)
 
 
-    def newXtcFileIsAvailable( self ) :
-        list_of_runs = fnm.get_list_of_xtc_run_nums()
-        if self.print_bits & 4 : print('list_of_runs    : %s' % list_of_runs)
-        if self.print_bits & 8 : print('list_of_runs_old: %s' % self.list_of_runs_old)
+    def setWatcher( self ) :
+        """(Re-)creates watcher for the xtc directory of current experiment, known runs are not reported as new"""
+        if self.watcher is not None : self.watcher.close()
+        self.exp_name = cp.exp_name.value()
+        self.xtc_dir  = fnm.path_to_xtc_dir()
+        self.watcher  = XtcDirWatcher(self.xtc_dir, dt_check_sec=self.dt_check_sec,\
+                                      backend=self.backend, dt_rescan_sec=self.dt_sec)
+        self.list_of_runs_old = sorted(self.watcher.known_runs())
+
 
+    def newXtcRuns( self ) :
+        """Waits up to dt_check_sec and returns the list of new runs, including out-of-order runs"""
         # If the experiment name has changed, it does not mean that new xtc is availble...
-        if cp.exp_name.value() != self.exp_name :
-            self.exp_name = cp.exp_name.value()
-            self.list_of_runs_old = list(list_of_runs)            
-            return False
+        if self.watcher is None or cp.exp_name.value() != self.exp_name or fnm.path_to_xtc_dir() != self.xtc_dir :
+            self.setWatcher()
+            return []
 
-        if list_of_runs != [] :
-            if self.list_of_runs_old != []:
-                if list_of_runs[-1] != self.list_of_runs_old[-1] :
-                     self.list_of_runs_old = list(list_of_runs)
-                     return True
-            else :
-                self.list_of_runs_old = list(list_of_runs)
+        new_runs = self.watcher.wait_new_runs(timeout=self.dt_check_sec)
+        if new_runs :
+            self.list_of_runs_old = sorted(set(self.list_of_runs_old) | set(new_runs))
+            if self.print_bits & 4 : print('new runs        : %s' % new_runs)
+            if self.print_bits & 8 : print('list_of_runs_old: %s' % self.list_of_runs_old)
+        return new_runs
 
-        return False
+
+    def newXtcFileIsAvailable( self ) :
+        return len(self.newXtcRuns()) > 0
 
 
-    def emitSignalNewXtc( self ) :
-        msg = 'thread_id:%f counter:%d last_run:%d' %(self.thread_id, self.counter, self.list_of_runs_old[-1])       
+    def emitSignalNewXtc( self, run=None ) :
+        if run is None : run = self.list_of_runs_old[-1]
+        msg = 'thread_id:%f counter:%d last_run:%d' %(self.thread_id, self.counter, run)       
         self.update.emit(msg)
         if self.print_bits & 1 : print('New xtc file is available, msg: %s' % msg)
 
@@ -0,0 +1,218 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module XtcDirWatcher
+#
+#------------------------------------------------------------------------
+
+"""XtcDirWatcher - detects new runs in the xtc directory
+
+Two backends are available:
+    - 'inotify' - uses Linux inotify (through ctypes) to wake up immediately on file creation/renaming,
+    - 'scandir' - checks the directory mtime every dt_check_sec and re-lists directory by os.scandir only if it has changed.
+Inotify does not see files created by other clients of network file systems (NFS, Lustre),
+therefore the inotify backend also checks the directory mtime at each timeout as the scandir backend does.
+Backend 'auto' selects inotify if it is available and falls back to scandir.
+
+Usage ::
+
+    from CalibManager.XtcDirWatcher import XtcDirWatcher
+
+    w = XtcDirWatcher('/reg/d/psdm/XPP/xpptut15/xtc', dt_check_sec=0.5, backend='auto')
+    runs = w.known_runs()                  # set of runs available at start
+    while True :
+        for run in w.wait_new_runs(timeout=1) : # list of new run numbers, including out-of-order runs
+            print('new run %d' % run)
+    w.close()
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import re
+import select
+import struct
+from time import time, sleep
+
+from CalibManager.Logger import logger
+
+#------------------------------
+
+# xtc file name like e170-r0003-s00-c00.xtc or detdaq18-r0145-s01-c19.xtc
+xtc_fname_pattern = re.compile(r'^[^-]+-r(\d+)-s(\d+)-c(\d+)\.xtc$')
+
+def xtc_run_number(fname) :
+    """Returns integer run number for xtc file name or None"""
+    m = xtc_fname_pattern.match(fname)
+    return None if m is None else int(m.group(1))
+
+#------------------------------
+
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_IGNORED     = 0x00008000
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+class _Inotify(object) :
+    """Minimal ctypes wrapper of Linux inotify for a single directory"""
+
+    def __init__(self, dirname) :
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0 : raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+        self.wd = libc.inotify_add_watch(self.fd, dirname.encode(), mask)
+        if self.wd < 0 :
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed for %s' % dirname)
+
+    def read_names(self, timeout) :
+        """Waits for events up to timeout sec, returns (list of file names, flag of lost events)"""
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r : return [], False
+        try : buf = os.read(self.fd, 65536)
+        except BlockingIOError : return [], False
+        names, lost = [], False
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(buf) :
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos:pos+length].split(b'\0', 1)[0].decode(errors='replace')
+            pos += length
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED) : lost = True
+            if name : names.append(name)
+        return names, lost
+
+    def close(self) :
+        if self.fd >= 0 :
+            os.close(self.fd)
+            self.fd = -1
+
+#------------------------------
+
+class XtcDirWatcher(object) :
+    """Detects new runs in the xtc directory"""
+
+    list_of_backends = ['auto', 'inotify', 'scandir']
+
+    def __init__(self, dirname, dt_check_sec=0.5, backend='auto', dt_rescan_sec=60) :
+        """Constructor.
+        @param dirname - path to the xtc directory
+        @param dt_check_sec - interval between checks of the directory mtime
+        @param backend - 'auto', 'inotify', or 'scandir'
+        @param dt_rescan_sec - interval of unconditional re-listing of directory (for file systems with unreliable mtime)
+        """
+        self.dirname       = dirname
+        self.dt_check_sec  = dt_check_sec
+        self.dt_rescan_sec = dt_rescan_sec
+        self.mtime         = None
+        self.t_scan        = 0
+        self.names         = set()
+        self.runs          = set()
+        self.inotify       = None
+
+        if backend not in self.list_of_backends :
+            raise ValueError('Unknown backend "%s", use one of %s' % (backend, str(self.list_of_backends)))
+
+        if backend in ('auto', 'inotify') and dirname is not None and os.path.isdir(dirname) :
+            try :
+                self.inotify = _Inotify(dirname)
+            except (OSError, AttributeError) as err :
+                if backend == 'inotify' : raise
+                logger.debug('inotify is not available for %s: %s' % (dirname, err), __name__)
+        self.backend = 'inotify' if self.inotify is not None else 'scandir'
+
+        self._scan_if_changed() # known runs at start are not reported as new
+        logger.debug('XtcDirWatcher for %s uses backend %s, known runs: %d' % (dirname, self.backend, len(self.runs)), __name__)
+
+    def known_runs(self) :
+        return set(self.runs)
+
+    def _add_names(self, names) :
+        """Adds names to the set of known names, returns sorted list of new runs"""
+        new_runs = set()
+        for name in names :
+            if name in self.names : continue
+            self.names.add(name)
+            run = xtc_run_number(name)
+            if run is not None and run not in self.runs : new_runs.add(run)
+        self.runs |= new_runs
+        return sorted(new_runs)
+
+    def _scan_if_changed(self, force=False) :
+        """Re-lists the directory if its mtime has changed, returns sorted list of new runs"""
+        if self.dirname is None : return []
+        try : mtime = os.stat(self.dirname).st_mtime
+        except OSError : return []
+        t = time()
+        # directory modified within the mtime resolution may be changed again with the same mtime
+        if not force and mtime == self.mtime and t - mtime > 2 and t - self.t_scan < self.dt_rescan_sec : return []
+        self.mtime, self.t_scan = mtime, t
+        try :
+            with os.scandir(self.dirname) as it : names = [entry.name for entry in it]
+        except OSError : return []
+        return self._add_names(names)
+
+    def wait_new_runs(self, timeout=1) :
+        """Waits up to timeout sec for new runs, returns sorted list of new run numbers (may be empty)"""
+        t_end = time() + timeout
+        while True :
+            dt = max(0, min(self.dt_check_sec, t_end - time()))
+            if self.inotify is not None :
+                names, lost = self.inotify.read_names(dt)
+                new_runs = self._add_names(names)
+                if lost :
+                    self.inotify.close()
+                    self.inotify = None
+                    self.backend = 'scandir'
+                    logger.warning('inotify watch for %s is lost, fall back to scandir' % self.dirname, __name__)
+                new_runs = sorted(set(new_runs) | set(self._scan_if_changed(force=lost)))
+            else :
+                sleep(dt)
+                new_runs = self._scan_if_changed()
+            if new_runs or time() >= t_end : return new_runs
+
+    def close(self) :
+        if self.inotify is not None : self.inotify.close()
+        self.inotify = None
+
+    def __del__(self) :
+        try : self.close()
+        except Exception : pass
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    import tempfile
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'auto'
+    d = tempfile.mkdtemp()
+    open(os.path.join(d, 'e1-r0010-s00-c00.xtc'), 'w').close()
+    w = XtcDirWatcher(d, backend=backend)
+    print('backend: %s  known runs: %s' % (w.backend, str(sorted(w.known_runs()))))
+    for run in (12, 11, 12, 15) :
+        t0 = time()
+        open(os.path.join(d, 'e1-r%04d-s00-c00.xtc' % run), 'w').close()
+        print('created run %d, new runs: %s, latency %.3f sec' % (run, str(w.wait_new_runs(timeout=2)), time()-t0))
+    w.close()
+    sys.exit('End of test')
+
+#------------------------------
@@ -0,0 +1,216 @@
+#--------------------------------------------------------------------------
+# File and Version Information:
+#  $Id$
+#
+# Description:
+#  Module XtcInventory
+#
+#------------------------------------------------------------------------
+
+"""XtcInventory - inventory of xtc files in directory built from a single os.scandir pass
+
+Inventory maps run -> stream -> chunk -> (size, mtime, file name) and is cached per directory,
+cached object is re-built only if the directory mtime has changed. Chunks being written (*.xtc.inprogress)
+and small data chunks in subdirectory smalldata (*.smd.xtc, *.smd.xtc.inprogress) are listed per run.
+
+Usage ::
+
+    from CalibManager.XtcInventory import get_xtc_inventory
+
+    inv = get_xtc_inventory('/reg/d/psdm/XPP/xpptut15/xtc')
+    inv.list_of_files()       # ['e665-r0001-s00-c00.xtc', ...]
+    inv.list_of_runs()        # ['0001', '0002', ...]
+    inv.list_of_run_nums()    # [1, 2, ...]
+    inv.files_for_run('0001') # sorted list of file names
+    inv.all_files_for_run('0001') # + *.xtc.inprogress and smalldata/*.smd.xtc[.inprogress] file names
+    inv.path_for_run('0001')  # '/reg/d/psdm/XPP/xpptut15/xtc/e665-r0001-*.xtc'
+    inv.streams('0001')       # ['00', '01', ...]
+    inv.chunks('0001', '00')  # ['00', '01', ...]
+    inv.total_bytes('0001')   # total size of xtc files for run
+    inv.runs_growing()        # runs with *.xtc.inprogress files or recently modified chunks
+
+This software was developed for the LCLS project.  If you use all or
+part of it, please give an appropriate acknowledgment.
+
+@version $Id$
+"""
+from __future__ import print_function
+
+#--------------------------------
+__version__ = "$Revision$"
+#--------------------------------
+
+import os
+import re
+from time import time
+
+from CalibManager.XtcDirWatcher import xtc_fname_pattern
+
+#------------------------------
+
+INPROGRESS_EXT = '.inprogress'
+SMD_SUBDIR = 'smalldata'
+smd_fname_pattern = re.compile(r'^[^-]+-r(\d+)-s(\d+)-c(\d+)\.smd\.xtc(%s)?$' % re.escape(INPROGRESS_EXT))
+
+class XtcInventory(object) :
+    """Inventory of xtc files in directory"""
+
+    def __init__(self, dirname) :
+        """Constructor.
+        @param dirname - path to the xtc directory
+        """
+        self.dirname = dirname
+        self.mtime   = None
+        self.mtime_smd = None
+        self.t_scan  = 0
+        self.files   = []  # sorted list of *.xtc file names
+        self.runs    = {}  # run : {stream : {chunk : (size, mtime, fname)}}
+        self.exps    = {}  # run : experiment prefix of the file name, i.e. 'e170'
+        self.inprogress = {} # run : list of *.xtc.inprogress file names
+        self.smd     = {}  # run : list of smalldata/*.smd.xtc[.inprogress] file names relative to dirname
+        self.scan()
+
+    def scan(self) :
+        """Lists directory in one os.scandir pass"""
+        self.files, self.runs, self.exps, self.inprogress, self.smd = [], {}, {}, {}, {}
+        if self.dirname is None or not os.path.isdir(self.dirname) : return
+        self.scan_smd()
+        self.mtime  = os.stat(self.dirname).st_mtime
+        self.t_scan = time()
+        with os.scandir(self.dirname) as it :
+            for entry in it :
+                name = entry.name
+                if name.endswith(INPROGRESS_EXT) :
+                    m = xtc_fname_pattern.match(name[:-len(INPROGRESS_EXT)])
+                    if m is not None : self.inprogress.setdefault(m.group(1), []).append(name)
+                    continue
+                if not name.endswith('.xtc') : continue
+                self.files.append(name)
+                m = xtc_fname_pattern.match(name)
+                if m is None : continue
+                run, stream, chunk = m.groups()
+                try : st = entry.stat()
+                except OSError : continue
+                self.runs.setdefault(run, {}).setdefault(stream, {})[chunk] = (st.st_size, st.st_mtime, name)
+                self.exps.setdefault(run, name.split('-', 1)[0])
+        self.files.sort()
+
+    def scan_smd(self) :
+        """Lists small data subdirectory"""
+        dir_smd = os.path.join(self.dirname, SMD_SUBDIR)
+        try :
+            self.mtime_smd = os.stat(dir_smd).st_mtime
+            with os.scandir(dir_smd) as it :
+                for entry in it :
+                    m = smd_fname_pattern.match(entry.name)
+                    if m is not None : self.smd.setdefault(m.group(1), []).append(os.path.join(SMD_SUBDIR, entry.name))
+        except OSError : # no small data
+            self.mtime_smd = None
+
+    def is_stale(self) :
+        """Returns True if directory mtime has changed since scan
+           or directory was modified within the mtime resolution before scan.
+        """
+        if self.dirname is None : return False
+        try : mtime = os.stat(self.dirname).st_mtime
+        except OSError : return self.mtime is not None
+        try : mtime_smd = os.stat(os.path.join(self.dirname, SMD_SUBDIR)).st_mtime
+        except OSError : mtime_smd = None
+        return mtime != self.mtime or self.t_scan - mtime < 2 or mtime_smd != self.mtime_smd
+
+#------------------------------
+
+    def list_of_files(self) :
+        """Returns sorted list of *.xtc file names"""
+        return list(self.files)
+
+    def list_of_runs(self) :
+        """Returns sorted list of run strings, for example:  ['0001', '0202', '0203', '0204',...]"""
+        return sorted(self.runs)
+
+    def list_of_run_nums(self) :
+        """Returns sorted list of integer run numbers:  [1, 202, 203, 204,...]"""
+        return [int(run) for run in self.list_of_runs()]
+
+    def has_run(self, run) :
+        return run in self.runs
+
+    def files_for_run(self, run) :
+        """Returns sorted list of xtc file names for run string"""
+        return sorted(fname for chunks in self.runs.get(run, {}).values() for (size, mtime, fname) in chunks.values())
+
+    def inprogress_files_for_run(self, run) :
+        """Returns sorted list of *.xtc.inprogress file names for run string"""
+        return sorted(self.inprogress.get(run, []))
+
+    def smd_files_for_run(self, run) :
+        """Returns sorted list of small data file names relative to directory, e.g. 'smalldata/e665-r0001-s00-c00.smd.xtc'"""
+        return sorted(self.smd.get(run, []))
+
+    def all_files_for_run(self, run) :
+        """Returns list of xtc, *.xtc.inprogress and small data file names relative to directory for run string"""
+        return sorted(self.files_for_run(run) + self.inprogress_files_for_run(run)) + self.smd_files_for_run(run)
+
+    def path_for_run(self, run) :
+        """Returns somthing like /reg/d/psdm/CXI/cxitut13/xtc/e304-r0022-*.xtc or None"""
+        if run not in self.runs : return None
+        return os.path.join(self.dirname, '%s-r%s-*.xtc' % (self.exps[run], run))
+
+    def streams(self, run) :
+        return sorted(self.runs.get(run, {}))
+
+    def chunks(self, run, stream) :
+        return sorted(self.runs.get(run, {}).get(stream, {}))
+
+    def total_bytes(self, run, refresh=False) :
+        """Returns total size of xtc files for run, refresh=True re-stats files of the run"""
+        if refresh : self.refresh_run(run)
+        return sum(size for chunks in self.runs.get(run, {}).values() for (size, mtime, fname) in chunks.values())
+
+    def refresh_run(self, run) :
+        """Re-stats xtc files of run, growing files do not change the directory mtime"""
+        for chunks in self.runs.get(run, {}).values() :
+            for chunk, (size, mtime, fname) in list(chunks.items()) :
+                try : st = os.stat(os.path.join(self.dirname, fname))
+                except OSError : continue
+                chunks[chunk] = (st.st_size, st.st_mtime, fname)
+
+    def _modified_within(self, run, dt_sec, t) :
+        return any(t - mtime < dt_sec for chunks in self.runs.get(run, {}).values() for (size, mtime, fname) in chunks.values())
+
+    def runs_growing(self, dt_sec=60) :
+        """Returns sorted list of runs which have *.xtc.inprogress files or chunks modified within dt_sec,
+           files of candidate runs (and of the last run) are re-stated.
+        """
+        t = time()
+        candidates = set(self.inprogress) | set(run for run in self.runs if self._modified_within(run, dt_sec, t))
+        if self.runs : candidates.add(max(self.runs))
+        for run in candidates : self.refresh_run(run)
+        return sorted(run for run in candidates if run in self.inprogress or self._modified_within(run, dt_sec, t))
+
+#------------------------------
+
+_inventories = {} # dirname : XtcInventory
+
+def get_xtc_inventory(dirname) :
+    """Returns cached XtcInventory for directory, it is re-built if the directory mtime has changed"""
+    inv = _inventories.get(dirname)
+    if inv is None or inv.is_stale() :
+        inv = _inventories[dirname] = XtcInventory(dirname)
+    return inv
+
+#------------------------------
+
+if __name__ == "__main__" :
+    import sys
+    dirname = sys.argv[1] if len(sys.argv) > 1 else '/reg/d/psdm/XPP/xpptut15/xtc'
+    t0 = time(); inv = get_xtc_inventory(dirname); print('Scan time %.3f sec' % (time()-t0))
+    t0 = time(); inv = get_xtc_inventory(dirname); print('Cached   %.6f sec' % (time()-t0))
+    for run in inv.list_of_runs() :
+        print('run %s  streams: %s  files: %d  in progress: %d  smd: %d  total bytes: %d  path: %s' %\
+              (run, ' '.join(inv.streams(run)), len(inv.files_for_run(run)), len(inv.inprogress_files_for_run(run)),\
+               len(inv.smd_files_for_run(run)), inv.total_bytes(run), inv.path_for_run(run)))
+    print('runs growing: %s' % str(inv.runs_growing()))
+    sys.exit('End of test')
+
+#------------------------------